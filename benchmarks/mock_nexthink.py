@@ -0,0 +1,408 @@
+#!/usr/bin/python
+# Copyright (C) 2017 Nexthink SA, Switzerland
+
+"""Local stand-in of a Nexthink Portal and its Engines, for the benchmarks
+
+The Portal serves the list of its Engines on /api/configuration/v1/engines
+and each Engine serves the NXQL queries sent by the tagger on /2/query
+(select of the ids, clean, check of the clean, updates), on its own port.
+The objects of an Engine and their keywords are kept in memory.
+
+Run it on its own to try the tagger by hand:
+    python benchmarks/mock_nexthink.py --engines 3 --objects 10000 --latency 0.005
+then point the tagger at it with <Portal>http://127.0.0.1:18080</Portal> in the
+configuration file and --engine-url-template "http://{}/2/query".
+"""
+
+# Library import
+import argparse
+import hashlib
+import json
+import random
+import re
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class MockEngine(object):
+    """Summary of class MockEngine.
+
+    In memory Engine answering the NXQL queries of the tagger. As on an
+    Engine, the where clauses of a from clause are ANDed and the conditions
+    of one where clause are ORed.
+
+    Object Attributes:
+        names: names of the objects of the Engine
+        latency: time (in seconds) taken by every query
+        latency_per_object: time (in seconds) added per object returned or updated
+        error_rate: share of the queries answered with a 503 (busy) error
+        update_error_rate: share of the update queries answered with a 500 error
+        clear_delay: time (in seconds) before a clean of a category is seen by the check queries
+        max_concurrency: number of queries run at the same time above which the Engine slows down (0: never)
+
+    """
+
+    TOKENS = re.compile(r'\(|\)|#"[^"]*"|"[^"]*"|[^\s()"]+')
+
+    def __init__(self, names, latency=0.0, latency_per_object=0.0, error_rate=0.0, update_error_rate=0.0,
+                 clear_delay=0.0, max_concurrency=0):
+        self.names = list(names)
+        self.latency = latency
+        self.latency_per_object = latency_per_object
+        self.error_rate = error_rate
+        self.update_error_rate = update_error_rate
+        self.clear_delay = clear_delay
+        self.max_concurrency = max_concurrency
+        self.keywords = {}
+        self.stats = {"queries": 0, "updates": 0, "errors": 0, "max_in_flight": 0}
+        self._index = {name.casefold(): name for name in self.names}
+        self._positions = {name: number for number, name in enumerate(self.names)}
+        self._hashes = {hashlib.md5(name.encode()).hexdigest(): name for name in self.names}
+        self._cleared_at = {}
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def get_keywords(self, category):
+        """Get the keyword of each object having one in a category"""
+
+        with self._lock:
+            return dict(self.keywords.get(category, {}))
+
+    @classmethod
+    def parse(cls, query):
+        """Parse an NXQL query into nested lists of tokens (None if it is not balanced)"""
+
+        stack = [[]]
+        for token in cls.TOKENS.findall(query):
+            if token == '(':
+                stack.append([])
+            elif token == ')':
+                if len(stack) < 2:
+                    return None
+                expression = stack.pop()
+                stack[-1].append(expression)
+            else:
+                stack[-1].append(token)
+        if len(stack) != 1 or len(stack[0]) != 1 or not isinstance(stack[0][0], list):
+            return None
+        return stack[0][0]
+
+    @staticmethod
+    def unquote(token):
+        return token[1:-1] if len(token) > 1 and token[0] == token[-1] == '"' else token
+
+    def _match_condition(self, condition):
+        """Get the names of the objects matching one condition of a where clause"""
+
+        if len(condition) == 3 and condition[0] == 'ne' and condition[2] == 'nil' and isinstance(condition[1], str):
+            # Objects having a keyword in the category (lookups of the differential mode and checks of the cleans)
+            category = self.unquote(condition[1][1:])
+            if time.monotonic() < self._cleared_at.get(category, 0):
+                # The clean is not applied yet
+                return set(self.names[:1])
+            return set(self.keywords.get(category, {}))
+        if len(condition) == 3 and condition[0] == 'eq' and isinstance(condition[2], list) and len(condition[2]) == 2:
+            field, (kind, value) = condition[1], condition[2]
+            value = self.unquote(value)
+            if field in ('name', 'executable_name') and kind == 'pattern':
+                if '*' not in value and '?' not in value:
+                    name = self._index.get(value.casefold())
+                    return {name} if name is not None else set()
+                regex = re.compile(re.escape(value).replace(r'\*', '.*').replace(r'\?', '.'), re.I | re.S)
+                return {name for name in self.names if regex.fullmatch(name)}
+            if field == 'id' and kind == 'identifier':
+                return {self.names[int(value)]} if value.isdigit() and int(value) < len(self.names) else set()
+            if field == 'hash' and kind == 'md5':
+                name = self._hashes.get(value.lower())
+                return {name} if name is not None else set()
+        # Other conditions (object properties the mock does not have) match all the objects
+        return set(self.names)
+
+    def _match_where(self, from_clause):
+        """Get the names of the objects matching the where clauses of a from clause (in their order)
+
+        The where clauses are ANDed, the conditions of a where clause ORed.
+        """
+
+        names = None
+        for clause in from_clause[2:]:
+            if not isinstance(clause, list) or not clause or clause[0] != 'where':
+                continue
+            matched = set()
+            for condition in clause[2:]:
+                if isinstance(condition, list):
+                    matched |= self._match_condition(condition)
+            names = matched if names is None else names & matched
+        if names is None:
+            return list(self.names)
+        return sorted(names, key=self._positions.get)
+
+    def _update(self, query):
+        parsed = self.parse(query)
+        if (parsed is None or len(parsed) != 3 or parsed[0] != 'update' or not isinstance(parsed[1], list)
+                or len(parsed[1]) != 3 or parsed[1][0] != 'set' or not isinstance(parsed[2], list) or parsed[2][0] != 'from'):
+            return 400, b'invalid update query', 0
+        if self.update_error_rate and random.random() < self.update_error_rate:
+            return 500, b'update failed', 0
+        category = self.unquote(parsed[1][1][1:])
+        value = parsed[1][2]
+        keyword = self.unquote(value[1]) if isinstance(value, list) and value[0] == 'enum' else None
+        where_clauses = any(isinstance(clause, list) and clause[:1] == ['where'] for clause in parsed[2][2:])
+        with self._lock:
+            self.stats["updates"] += 1
+            keywords = self.keywords.setdefault(category, {})
+            if not where_clauses and keyword is None:
+                # Clean of the category (seen by the check queries after clear_delay)
+                keywords.clear()
+                self._cleared_at[category] = time.monotonic() + self.clear_delay
+                return 200, b'', len(self.names)
+            names = self._match_where(parsed[2])
+            for name in names:
+                if keyword is None:
+                    keywords.pop(name, None)
+                else:
+                    keywords[name] = keyword
+        return 200, b'', len(names)
+
+    def _select(self, query, response_format):
+        parsed = self.parse(query)
+        if parsed is None or len(parsed) < 3 or parsed[0] != 'select' or not isinstance(parsed[2], list):
+            return 400, b'invalid select query', 0
+        fields = parsed[1] if isinstance(parsed[1], list) else [parsed[1]]
+        limit = None
+        for clause in parsed[3:]:
+            if isinstance(clause, list) and clause[:1] == ['limit']:
+                limit = int(clause[1])
+
+        with self._lock:
+            names = self._match_where(parsed[2])
+            if limit is not None:
+                names = names[:limit]
+            rows = []
+            for name in names:
+                row = {}
+                for field in fields:
+                    if field.startswith('#'):
+                        category = self.unquote(field[1:])
+                        row[field] = self.keywords.get(category, {}).get(name)
+                    elif field == 'id':
+                        row[field] = self._positions[name]
+                    else:
+                        row[field] = name
+                rows.append(row)
+
+        if response_format == 'csv':
+            lines = ['\t'.join(fields)]
+            lines.extend('\t'.join('' if row[field] is None else str(row[field]) for field in fields) for row in rows)
+            return 200, ('\n'.join(lines) + '\n').encode(), len(rows)
+        return 200, json.dumps(rows).encode(), len(rows)
+
+    def handle(self, query, response_format):
+        """Answer an NXQL query
+
+        Return:
+            status code, body and execution time (in seconds) of the query
+        """
+
+        with self._lock:
+            self.stats["queries"] += 1
+            self._in_flight += 1
+            in_flight = self._in_flight
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], in_flight)
+        try:
+            start = time.monotonic()
+            if self.error_rate and random.random() < self.error_rate:
+                status, body, num_objects = 503, b'busy', 0
+            elif query.startswith('(update'):
+                status, body, num_objects = self._update(query)
+            elif query.startswith('(select'):
+                status, body, num_objects = self._select(query, response_format)
+            else:
+                status, body, num_objects = 400, b'unsupported query', 0
+            delay = self.latency + self.latency_per_object * num_objects
+            if self.max_concurrency and in_flight > self.max_concurrency:
+                # Overloaded: the queries slow down with the square of the overload
+                delay *= (in_flight / self.max_concurrency) ** 2
+            delay -= time.monotonic() - start
+            if delay > 0:
+                time.sleep(delay)
+            if status != 200:
+                with self._lock:
+                    self.stats["errors"] += 1
+            return status, body, time.monotonic() - start
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+
+def make_engine_handler(engine):
+    """Create the request handler of the query endpoint of an Engine"""
+
+    class EngineHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/2/query':
+                return self.send_body(404, b'not found')
+            parameters = parse_qs(url.query)
+            status, body, exec_time = engine.handle(parameters.get('query', [''])[0],
+                                                    parameters.get('format', ['xml'])[0])
+            self.send_body(status, body, {'NX_EXEC_TIME': '{:.6f}'.format(exec_time)})
+
+        def send_body(self, status, body, headers=None):
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+    return EngineHandler
+
+
+def make_portal_handler(get_engines):
+    """Create the request handler of the Portal API (get_engines gives the list of the Engines)"""
+
+    class PortalHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if urlparse(self.path).path != '/api/configuration/v1/engines':
+                body, status = b'not found', 404
+            else:
+                body, status = json.dumps(get_engines()).encode(), 200
+            etag = '"{}"'.format(hash(body) & 0xffffffff)
+            if status == 200 and self.headers.get('If-None-Match') == etag:
+                body, status = b'', 304
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+    return PortalHandler
+
+
+class MockNexthink(object):
+    """Summary of class MockNexthink.
+
+    Runs the Portal and the Engines on local ports, each on its own thread.
+
+    Object Attributes:
+        engines: list of MockEngine
+        host: address to listen on
+        base_port: port of the first Engine (the next ones use the next ports)
+        portal_port: port of the Portal
+        certfile: certificate (PEM, with its key unless keyfile) to serve https (None for http)
+        keyfile: key of the certificate
+
+    """
+
+    def __init__(self, engines, host='127.0.0.1', base_port=18000, portal_port=18080, certfile=None, keyfile=None):
+        self.engines = engines
+        self.host = host
+        self.base_port = base_port
+        self.portal_port = portal_port
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self._servers = []
+
+    @property
+    def scheme(self):
+        return 'https' if self.certfile else 'http'
+
+    @property
+    def portal_url(self):
+        return '{}://{}:{}'.format(self.scheme, self.host, self.portal_port)
+
+    @property
+    def engine_url_template(self):
+        return self.scheme + '://{}/2/query'
+
+    def get_engine_addresses(self):
+        return ['{}:{}'.format(self.host, self.base_port + number) for number in range(len(self.engines))]
+
+    def get_engines_json(self):
+        return [{"name": "engine-{}".format(number), "address": address, "status": "CONNECTED"}
+                for number, address in enumerate(self.get_engine_addresses())]
+
+    def _serve(self, port, handler):
+        server = ThreadingHTTPServer((self.host, port), handler)
+        server.daemon_threads = True
+        if self.certfile:
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(self.certfile, self.keyfile)
+            server.socket = context.wrap_socket(server.socket, server_side=True)
+        threading.Thread(target=server.serve_forever, name='mock-{}'.format(port), daemon=True).start()
+        self._servers.append(server)
+
+    def start(self):
+        """Start serving the Portal and the Engines"""
+
+        self._serve(self.portal_port, make_portal_handler(self.get_engines_json))
+        for number, engine in enumerate(self.engines):
+            self._serve(self.base_port + number, make_engine_handler(engine))
+
+    def stop(self):
+        """Stop serving"""
+
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+
+
+def create_engines(num_engines, num_objects, **options):
+    """Create Engines holding num_objects objects each (device-<engine>-<number>), options of MockEngine"""
+
+    return [MockEngine(['device-{}-{:07d}'.format(engine, number) for number in range(num_objects)], **options)
+            for engine in range(num_engines)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in of a Nexthink Portal and its Engines")
+    parser.add_argument("--engines", help="number of Engines (default: 3)", type=int, default=3)
+    parser.add_argument("--objects", help="number of objects per Engine (default: 10000)", type=int, default=10000)
+    parser.add_argument("--latency", help="seconds taken by every query (default: 0.005)", type=float, default=0.005)
+    parser.add_argument("--latency-per-object", help="seconds added per object returned or updated (default: 0)",
+                        type=float, default=0.0)
+    parser.add_argument("--error-rate", help="share of the queries failing with a 503 (default: 0)", type=float, default=0.0)
+    parser.add_argument("--update-error-rate", help="share of the update queries failing with a 500 (default: 0)",
+                        type=float, default=0.0)
+    parser.add_argument("--clear-delay", help="seconds before a clean is seen by the check queries (default: 0)",
+                        type=float, default=0.0)
+    parser.add_argument("--max-concurrency", help="queries at the same time above which an Engine slows down (default: 0, never)",
+                        type=int, default=0)
+    parser.add_argument("--host", help="address to listen on (default: 127.0.0.1)", default='127.0.0.1')
+    parser.add_argument("--base-port", help="port of the first Engine (default: 18000)", type=int, default=18000)
+    parser.add_argument("--portal-port", help="port of the Portal (default: 18080)", type=int, default=18080)
+    parser.add_argument("--certfile", help="PEM certificate to serve https (default: http)", default=None)
+    parser.add_argument("--keyfile", help="key of the certificate (if not in --certfile)", default=None)
+    args = parser.parse_args()
+
+    engines = create_engines(args.engines, args.objects, latency=args.latency, latency_per_object=args.latency_per_object,
+                             error_rate=args.error_rate, update_error_rate=args.update_error_rate,
+                             clear_delay=args.clear_delay, max_concurrency=args.max_concurrency)
+    mock = MockNexthink(engines, args.host, args.base_port, args.portal_port, args.certfile, args.keyfile)
+    mock.start()
+    print('Portal: {} - Engine url template: {} - Engines: {}'.format(
+        mock.portal_url, mock.engine_url_template, mock.get_engine_addresses()))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == "__main__":
+    main()
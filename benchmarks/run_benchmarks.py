@@ -0,0 +1,270 @@
+#!/usr/bin/python
+# Copyright (C) 2017 Nexthink SA, Switzerland
+
+"""Offline benchmarks of the tagger against the local mock Portal and Engines
+
+Each scenario starts the mock Nexthink (benchmarks/mock_nexthink.py) with its
+Engines and objects, writes a tag file and runs multi-engine-tagger.py on it
+in a child process, as a scheduled run would. The throughput, the latency
+percentiles and the time per phase come from the JSON run report of the
+tagger; the peak RSS from the resource usage of the child process. The
+keywords left on the mock Engines are checked against the tag file.
+
+    python benchmarks/run_benchmarks.py                      # all the scenarios
+    python benchmarks/run_benchmarks.py baseline many-tags   # some of them
+    python benchmarks/run_benchmarks.py --scale 0.1 -- --transport asyncio
+    python benchmarks/run_benchmarks.py --baseline benchmarks/results/<previous>.json
+
+The results are written to benchmarks/results/ (one JSON file per run of the
+benchmarks), so that they can be compared with --baseline over time.
+"""
+
+# Library import
+import argparse
+import base64
+import csv
+import datetime
+import glob
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_nexthink import MockNexthink, create_engines
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+TAGGER_PATH = os.path.dirname(BENCHMARKS_PATH)
+
+CATEGORY = "VIP - Track Key Indicators"
+
+# engines: number of Engines, objects: objects per Engine, tags: rows of the tag file
+# (missing: share of the rows whose object is on no Engine, tagged: share of the rows
+# already having their keyword before the run), the other keys are options of MockEngine
+SCENARIOS = {
+    "baseline": {"engines": 3, "objects": 10000, "tags": 2000, "latency": 0.005},
+    "many-engines": {"engines": 20, "objects": 2000, "tags": 2000, "latency": 0.005},
+    "large-id-sets": {"engines": 3, "objects": 200000, "tags": 1000, "latency": 0.005},
+    "many-tags": {"engines": 3, "objects": 20000, "tags": 30000, "latency": 0.005, "args": ["--batch-size", "50"]},
+    "flaky-engines": {"engines": 3, "objects": 10000, "tags": 2000, "latency": 0.005, "error_rate": 0.05,
+                      "args": ["--retry-delay", "0.05"]},
+    "overloaded-engines": {"engines": 3, "objects": 10000, "tags": 4000, "latency": 0.01, "max_concurrency": 2},
+    "slow-clean": {"engines": 3, "objects": 10000, "tags": 2000, "latency": 0.005, "clear_delay": 2},
+    "differential": {"engines": 3, "objects": 10000, "tags": 4000, "latency": 0.005, "tagged": 0.9,
+                     "args": ["--diff"]},
+}
+
+ENGINE_OPTIONS = ("latency", "latency_per_object", "error_rate", "update_error_rate", "clear_delay", "max_concurrency")
+
+
+def write_tag_file(file_name, engines, scenario, scale, rng):
+    """Write the tag file of a scenario
+
+    Return:
+        number of rows of the file
+        dict of object name -> keyword expected on the Engines after the run
+    """
+
+    names = [name for engine in engines for name in engine.names]
+    num_tags = min(max(1, int(scenario["tags"] * scale)), len(names))
+    num_missing = int(num_tags * scenario.get("missing", 0.05))
+    expected = {}
+    with open(file_name, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Object Type', 'Object ID', 'Category', 'Keyword'])
+        for number, name in enumerate(rng.sample(names, num_tags - num_missing)):
+            keyword = 'Key{}'.format(number % 4)
+            # The case of the ids differs between the tag files and the Engines
+            writer.writerow(['device', name.upper() if number % 2 else name, CATEGORY, keyword])
+            expected[name] = keyword
+        for number in range(num_missing):
+            writer.writerow(['device', 'missing-{:07d}'.format(number), CATEGORY, 'Key0'])
+    return num_tags, expected
+
+
+def write_config_file(file_name, mock, tags_path, log_path):
+    credentials = base64.b64encode(b'bench:bench').decode()
+    with open(file_name, 'w') as file:
+        file.write('<?xml version="1.0"?>\n<configuration>\n'
+                   '\t<Credentials>{}</Credentials>\n\t<Portal>{}</Portal>\n\t<Port>{}</Port>\n'
+                   '\t<Tags>{}</Tags>\n\t<LogPath>{}</LogPath>\n</configuration>\n'.format(
+                       credentials, mock.portal_url, mock.portal_port, tags_path, log_path))
+
+
+def run_tagger(args):
+    """Run the tagger in a child process
+
+    Return:
+        exit code, wall time (in seconds) and peak RSS (in MB) of the child
+    """
+
+    start = time.monotonic()
+    process = subprocess.Popen([sys.executable, os.path.join(TAGGER_PATH, 'multi-engine-tagger.py')] + args,
+                               stdout=subprocess.DEVNULL)
+    # wait4 gives the resource usage of this child only
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux
+    return process.returncode, time.monotonic() - start, usage.ru_maxrss / 1024
+
+
+def run_scenario(name, scenario, options, tagger_args):
+    """Run one scenario
+
+    Return:
+        dict of the results of the scenario
+    """
+
+    rng = random.Random(options.seed)
+    num_objects = max(1, int(scenario["objects"] * options.scale))
+    engines = create_engines(scenario["engines"], num_objects,
+                             **{key: value for key, value in scenario.items() if key in ENGINE_OPTIONS})
+    mock = MockNexthink(engines, base_port=options.base_port, portal_port=options.portal_port)
+    mock.start()
+    try:
+        with tempfile.TemporaryDirectory(prefix='tagger-bench-') as work_path:
+            tags_path = os.path.join(work_path, 'tags') + os.sep
+            log_path = os.path.join(work_path, 'logs') + os.sep
+            os.makedirs(tags_path)
+            os.makedirs(log_path)
+            num_tags, expected = write_tag_file(os.path.join(tags_path, 'bench.csv'), engines, scenario, options.scale, rng)
+            # Keywords already set before the run (differential mode)
+            for engine in engines:
+                keywords = engine.keywords.setdefault(CATEGORY, {})
+                for object_name in engine.names:
+                    if object_name in expected and rng.random() < scenario.get("tagged", 0):
+                        keywords[object_name] = expected[object_name]
+                    elif rng.random() < 0.01:
+                        keywords[object_name] = 'Stale'
+            config_file = os.path.join(work_path, 'config.xml')
+            write_config_file(config_file, mock, tags_path, log_path)
+
+            exit_code, wall_time, peak_rss = run_tagger(
+                [config_file, os.path.join(TAGGER_PATH, 'tagger_queries.xml'),
+                 '--engine-url-template', mock.engine_url_template] + scenario.get("args", []) + tagger_args)
+
+            reports = glob.glob(os.path.join(log_path, 'run.*.report.json'))
+            report = None
+            if reports:
+                with open(reports[0]) as file:
+                    report = json.load(file)
+            actual = {}
+            for engine in engines:
+                actual.update(engine.get_keywords(CATEGORY))
+    finally:
+        mock.stop()
+
+    result = {"scenario": name, "engines": scenario["engines"], "objects_per_engine": num_objects,
+              "tags": num_tags, "exit_code": exit_code, "process_time": wall_time,
+              "peak_rss_mb": peak_rss, "correct": actual == expected,
+              "engine_queries": sum(engine.stats["queries"] for engine in engines),
+              "engine_max_in_flight": max(engine.stats["max_in_flight"] for engine in engines)}
+    if report is not None:
+        num_updates = sum(values["result"].get("num_updates", 0) for values in report["engines"].values())
+        update_requests = report["requests"].get("update", {})
+        result.update({
+            "wall_time": report["wall_time"],
+            "updates": num_updates,
+            "updates_per_second": num_updates / report["wall_time"] if report["wall_time"] > 0 else 0,
+            "update_requests": update_requests.get("count", 0),
+            "update_latency": update_requests.get("latency"),
+            "bytes_received": sum(requests["bytes_received"] for requests in report["requests"].values()),
+            "phases": report["phases"],
+        })
+    return result
+
+
+def compare(results, baseline_file, threshold):
+    """Compare the results with the ones of a previous run of the benchmarks
+
+    Return:
+        list of the regressions found (descriptions)
+    """
+
+    with open(baseline_file) as file:
+        baseline = {result["scenario"]: result for result in json.load(file)["results"]}
+    regressions = []
+    for result in results:
+        previous = baseline.get(result["scenario"])
+        if not previous or "updates_per_second" not in previous or "updates_per_second" not in result:
+            continue
+        checks = [("updates/s", result["updates_per_second"], previous["updates_per_second"], False),
+                  ("peak RSS MB", result["peak_rss_mb"], previous["peak_rss_mb"], True)]
+        if result.get("update_latency") and previous.get("update_latency"):
+            checks.append(("update p95 s", result["update_latency"]["p95"], previous["update_latency"]["p95"], True))
+        for label, value, previous_value, lower_is_better in checks:
+            if not previous_value:
+                continue
+            change = (value - previous_value) / previous_value
+            if (change > threshold) if lower_is_better else (change < -threshold):
+                regressions.append('{}: {} {:.4g} -> {:.4g} ({:+.0%})'.format(
+                    result["scenario"], label, previous_value, value, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the tagger against a local mock Portal and Engines",
+                                     epilog="Arguments after -- are passed to multi-engine-tagger.py")
+    parser.add_argument("scenarios", help="scenarios to run (default: all): {}".format(', '.join(SCENARIOS)),
+                        nargs="*")
+    parser.add_argument("--scale", help="factor applied to the number of objects and tags (default: 1)",
+                        type=float, default=1.0)
+    parser.add_argument("--seed", help="seed of the random tags (default: 1)", type=int, default=1)
+    parser.add_argument("--base-port", help="port of the first mock Engine (default: 18000)", type=int, default=18000)
+    parser.add_argument("--portal-port", help="port of the mock Portal (default: 18080)", type=int, default=18080)
+    parser.add_argument("--output", help="results file (default: benchmarks/results/<date>.json)", default=None)
+    parser.add_argument("--baseline", help="results file of a previous run to compare with", default=None)
+    parser.add_argument("--threshold", help="change counted as a regression against the baseline (default: 0.1)",
+                        type=float, default=0.1)
+    argv = sys.argv[1:]
+    tagger_args = []
+    if '--' in argv:
+        tagger_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    options = parser.parse_args(argv)
+
+    unknown = [name for name in options.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(unknown)))
+
+    results = []
+    print('{:<20} {:>7} {:>9} {:>9} {:>10} {:>9} {:>9} {:>9} {:>8} {:>8}'.format(
+        'scenario', 'engines', 'objects', 'tags', 'updates/s', 'p50 ms', 'p95 ms', 'p99 ms', 'RSS MB', 'correct'))
+    for name in options.scenarios or list(SCENARIOS):
+        result = run_scenario(name, SCENARIOS[name], options, tagger_args)
+        results.append(result)
+        latency = result.get("update_latency") or {}
+        print('{:<20} {:>7} {:>9} {:>9} {:>10.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>8.1f} {:>8}'.format(
+            name, result["engines"], result["objects_per_engine"], result["tags"], result.get("updates_per_second", 0),
+            latency.get("p50", 0) * 1000, latency.get("p95", 0) * 1000, latency.get("p99", 0) * 1000,
+            result["peak_rss_mb"], str(result["correct"]) if result["exit_code"] == 0 else 'exit {}'.format(result["exit_code"])))
+
+    output = options.output
+    if output is None:
+        os.makedirs(os.path.join(BENCHMARKS_PATH, 'results'), exist_ok=True)
+        output = os.path.join(BENCHMARKS_PATH, 'results', '{}.json'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S')))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=TAGGER_PATH, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    with open(output, 'w') as file:
+        json.dump({"date": datetime.datetime.now().isoformat(timespec='seconds'), "commit": commit,
+                   "python": platform.python_version(), "platform": platform.platform(), "scale": options.scale,
+                   "tagger_args": tagger_args, "results": results}, file, indent=1)
+    print('Results written to {}'.format(output))
+
+    failed = [result["scenario"] for result in results if not result["correct"] or result["exit_code"] != 0]
+    if failed:
+        print('Incorrect results: {}'.format(', '.join(failed)))
+    regressions = compare(results, options.baseline, options.threshold) if options.baseline else []
+    for regression in regressions:
+        print('Regression: {}'.format(regression))
+    return 1 if failed or regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,9 @@ import requests
 import base64
 import logging
 import json
+import os
+import threading
+import time
 import urllib3
 import sys
 
@@ -14,14 +17,25 @@ urllib3.disable_warnings()
 
 class Appliance:
 
+    # A cached list of engines older than this (in seconds) is refreshed before it is used
+    MAX_STALE_AGE = 86400
     
-    def __init__(self, hostname_fqdn, name, port, credentials,session, logger):
+    def __init__(self, hostname_fqdn, name, port, credentials,session, logger, cache_path=None, cache_ttl=0, timeout=30):
         self.logger = logger
         self._hostname_fqdn = hostname_fqdn
         self._name = name
         self._port = port
         self._credentials = credentials
         self._session = session
+        # Last known good list of engines, kept in memory and in cache_path (if any)
+        self.cache_path = cache_path
+        self.cache_ttl = cache_ttl
+        self.timeout = timeout
+        self._cache = None
+        self._cache_lock = threading.Lock()
+        self._refresh_thread = None
+        if cache_path:
+            self._load_cache()
         
         
         
@@ -32,6 +46,14 @@ class Appliance:
 
 
 
+    def get_base_url(self):
+        """ Base url of the appliance API: https://<FQDN>, unless the FQDN is already a url (e.g. http://localhost:8080 for a test Portal) """
+        if "://" in self._hostname_fqdn:
+            return self._hostname_fqdn.rstrip("/")
+        return "https://" + self._hostname_fqdn
+
+
+
     def _get_engines_json(self):
         """ Private method that queries the portal API and gets a list of all available engines
 
@@ -43,38 +65,156 @@ class Appliance:
         # We get the session attribute
         session = self._session
 
+        # Only get the list again if it changed since the cached one
+        headers = {}
+        with self._cache_lock:
+            cache = self._cache
+        if cache is not None:
+            if cache.get("etag"):
+                headers["If-None-Match"] = cache["etag"]
+            if cache.get("last_modified"):
+                headers["If-Modified-Since"] = cache["last_modified"]
 
         try:
             self.logger.debug("Querying the API to get a list of all engines...")
-            response = session.get(f"https://"+self._hostname_fqdn+"/api/configuration/v1/engines", verify=True)
+            response = session.get(self.get_base_url()+"/api/configuration/v1/engines", headers=headers,
+                                   verify=True, timeout=self.timeout)
+            if response.status_code == 304 and cache is not None:
+                self.logger.debug("List of engines not modified since the cached one")
+                self._json = cache["engines"]
+                self._store_cache(self._json, response)
+                return self._json
             response.raise_for_status()
 
         except requests.exceptions.HTTPError as err:
             self.logger.error(err)
             raise SystemExit(err)
 
-        except requests.exceptions.HTTPError as HTTPerr:
-            self.logger.error("HTTP Error : " + HTTPerr)
-            self.logger.error("Program will close")
-            raise SystemExit(HTTPerr)
-
         except requests.exceptions.SSLError as SSLerr:
-            self.logger.error("SLL Error : " + SSLerr)
+            self.logger.error("SSL Error : " + str(SSLerr))
             self.logger.error("Program will close")
             raise SystemExit(SSLerr)
 
         else:
             self.logger.debug("Succesfully executed API Call - JSON retrieved")
             self._json = response.json()
+            self._store_cache(self._json, response)
             return self._json
 
 
 
+    def _load_cache(self):
+        """ Private method that loads the last known good list of engines from cache_path """
+        if not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, "r") as cache_file:
+                cache = json.load(cache_file)
+            if not isinstance(cache, dict) or "time" not in cache or "engines" not in cache:
+                raise ValueError("time or engines missing")
+        except (OSError, ValueError) as err:
+            self.logger.warning(f"Ignoring invalid engine cache file {self.cache_path}: {err!r}")
+            return
+        self._cache = cache
+
+
+
+    def _store_cache(self, engines_json, response):
+        """ Private method that keeps a list of engines returned by the API (in memory and in cache_path) """
+        cache = {"time": time.time(),
+                 "etag": response.headers.get("ETag"),
+                 "last_modified": response.headers.get("Last-Modified"),
+                 "engines": engines_json}
+        with self._cache_lock:
+            self._cache = cache
+            if self.cache_path:
+                try:
+                    temp_path = self.cache_path + ".tmp"
+                    with open(temp_path, "w") as cache_file:
+                        json.dump(cache, cache_file)
+                    os.replace(temp_path, self.cache_path)
+                except OSError as err:
+                    self.logger.warning(f"Unable to write the engine cache file {self.cache_path}: {err!r}")
+
+
+
+    def _refresh_engines_json(self):
+        """ Private method that gets the list of engines from the API, or the last known good one if the API fails
+
+        Return:
+            JSON object with engines hostnames
+        """
+        try:
+            return self._get_engines_json()
+        except (SystemExit, requests.exceptions.RequestException) as err:
+            with self._cache_lock:
+                cache = self._cache
+            if cache is None:
+                raise
+            self.logger.warning(f"Unable to refresh the list of engines ({err!r}) - "
+                                f"using the one cached {time.time() - cache['time']:.0f}s ago")
+            return cache["engines"]
+
+
+
+    def _background_refresh(self, previous_json):
+        try:
+            engines_json = self._refresh_engines_json()
+        except (SystemExit, Exception) as err:
+            self.logger.error(f"Background refresh of the list of engines failed: {err!r}")
+            return
+        if engines_json != previous_json:
+            self.logger.info("The list of engines changed since it was cached - it will be used from the next request")
+        else:
+            self.logger.debug("The cached list of engines is still valid")
+
+
+
+    def start_refresh(self):
+        """ Refresh the cached list of engines in the background (unless a refresh is already running)
+
+        The refresh thread is a daemon: a Portal that does not answer does not
+        hold the end of the run (the cache file is replaced atomically).
+        """
+        with self._cache_lock:
+            if self._refresh_thread is not None and self._refresh_thread.is_alive():
+                return
+            previous_json = self._cache["engines"] if self._cache is not None else None
+            self._refresh_thread = threading.Thread(target=self._background_refresh, args=(previous_json,),
+                                                    name="engine-refresh", daemon=True)
+            self._refresh_thread.start()
+
+
+
+    def _get_cached_engines_json(self):
+        """ Private method that gets the list of engines from the cache when it is recent enough
+
+        A cached list older than cache_ttl is still used right away (and
+        refreshed in the background) unless it is older than MAX_STALE_AGE.
+
+        Return:
+            JSON object with engines hostnames
+        """
+        with self._cache_lock:
+            cache = self._cache
+        if cache is None:
+            return self._refresh_engines_json()
+        age = time.time() - cache["time"]
+        if age < self.cache_ttl:
+            self.logger.debug(f"Using the list of engines cached {age:.0f}s ago")
+            return cache["engines"]
+        if age < self.MAX_STALE_AGE and self.cache_ttl > 0:
+            self.logger.info(f"Using the list of engines cached {age:.0f}s ago while it is refreshed")
+            self.start_refresh()
+            return cache["engines"]
+        return self._refresh_engines_json()
+
+
 
     def get_engines_list(self):
-        # if we get a list of engines from the API query
-        if self._get_engines_json():
-            list_jsons = self._get_engines_json()
+        # if we get a list of engines from the API query (or the cache)
+        list_jsons = self._get_cached_engines_json()
+        if list_jsons:
             # We keep only "connected" engines
             engines_list = [item["address"] for item in list_jsons if item["status"] == "CONNECTED"]
             # if there are engines connected
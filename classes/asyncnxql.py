@@ -0,0 +1,437 @@
+#!/usr/bin/python
+# Copyright (C) 2017 Nexthink SA, Switzerland
+
+# Library import
+import asyncio
+import concurrent.futures
+import json
+import time
+from urllib.parse import urlparse
+
+from classes.retry import EngineUnavailableError
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncNxql(object):
+    """Summary of class AsyncNxql.
+
+    Asyncio version of the multi-engine process of a prepared Nxql object,
+    giving the same result dictionaries as Nxql.process_engine_objects().
+
+    Object Attributes:
+        nxql: the prepared Nxql object
+        logger: this is to log INFO/WARNING/ERROR/DEBUG messages
+        max_workers: maximum number of requests running at the same time
+        max_engine_requests: maximum number of requests running at the same time on one Engine
+                             (the current limit of the adaptive limiter of the Nxql object, if any)
+
+    """
+
+    def __init__(self, nxql):
+        if aiohttp is None:
+            raise ImportError("The asyncio transport needs the aiohttp library (pip install aiohttp)")
+        self.nxql = nxql
+        self.logger = nxql.logger
+        self.max_workers = nxql.max_workers
+        self.max_engine_requests = nxql.max_engine_requests
+
+    async def _acquire_budget(self):
+        """Wait for a slot of the request budget shared with the other threads (if any)
+
+        The budget is a threading semaphore: when it is exhausted, the wait
+        runs in a thread of the budget executor so the event loop goes on.
+        """
+
+        budget = self.nxql._websession.request_budget
+        if budget is None or budget.acquire(blocking=False):
+            return budget
+        waiter = self._budget_executor.submit(budget.acquire)
+        try:
+            await asyncio.wrap_future(waiter)
+        except asyncio.CancelledError:
+            # Give the slot back once the wait is over, if it had started
+            if not waiter.cancel():
+                waiter.add_done_callback(lambda future: budget.release())
+            raise
+        return budget
+
+    async def _run_blocking(self, func, *args):
+        """Run a CPU bound function (parsing, indexing, matching) off the event loop"""
+
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def _acquire_engine(self, url):
+        """Wait until a request can run on an Engine"""
+
+        limiter = self.nxql.limiter
+        condition = self._engine_conditions[url]
+        async with condition:
+            await condition.wait_for(lambda: self._in_flight[url] < (
+                limiter.get_limit(url) if limiter else self.max_engine_requests))
+            self._in_flight[url] += 1
+
+    async def _release_engine(self, url):
+        condition = self._engine_conditions[url]
+        async with condition:
+            self._in_flight[url] -= 1
+            condition.notify_all()
+
+    async def _request(self, url, params, result, read_response, sample_latency=False, phase=None):
+        """Run a get request within the concurrency limits, with the retry policy and the circuit breaker
+
+        Args:
+            url: url of the Engine
+            params: parameters of the request (query, format, hr)
+            result: result dictionary of the Engine (for the retry and breaker counters)
+            read_response: coroutine function reading the response (called with the response)
+            sample_latency: give the latency of the request to the adaptive limiter
+            phase: phase of the request in the metrics (see RunMetrics.PHASES)
+
+        Return:
+            status code of the response and value returned by read_response (the last ones if the retries are exhausted)
+
+        Raise:
+            EngineUnavailableError if the Engine cannot be reached or is parked by the circuit breaker
+
+        """
+
+        nxql = self.nxql
+        attempt = 0
+        while True:
+            nxql.check_breaker(url, result)
+            status, value, error, retry_after, exec_time = None, None, None, None, None
+            bytes_sent, bytes_received = 0, 0
+            # The slot of the Engine first: the requests queued on a busy Engine must not hold
+            # the global slots that the requests of the other Engines are waiting for
+            await self._acquire_engine(url)
+            try:
+                async with self._global_limit:
+                    budget = await self._acquire_budget()
+                    start = time.monotonic()
+                    timing = {}
+                    try:
+                        async with self._session.get(url, params=params, ssl=False,
+                                                     trace_request_ctx=timing) as response:
+                            status = response.status
+                            retry_after = response.headers.get('Retry-After')
+                            exec_time = response.headers.get('NX_EXEC_TIME')
+                            value = await read_response(response)
+                            bytes_sent = len(str(response.request_info.url))
+                            bytes_received = response.content.total_bytes
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                        status, error = None, err
+                    finally:
+                        if budget is not None:
+                            budget.release()
+            finally:
+                await self._release_engine(url)
+            latency = time.monotonic() - start
+            if sample_latency:
+                # The limiter is given the time spent by the Engine, not the time waiting for a connection
+                connected = timing.get('connected')
+                nxql.record_latency(url, latency if connected is None else time.monotonic() - connected, exec_time,
+                                    error is not None or nxql.retry_policy.is_transient_status(status))
+            nxql.record_request(url, phase, latency, status, bytes_sent, bytes_received, exec_time)
+            delay = nxql.retry_delay(url, result, attempt, status, error, retry_after)
+            if delay is None:
+                return status, value
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    async def _on_connection(session, context, params):
+        """Note the time at which a request got its connection (in its trace_request_ctx)"""
+
+        if isinstance(context.trace_request_ctx, dict):
+            context.trace_request_ctx['connected'] = time.monotonic()
+
+    @staticmethod
+    async def _read_body(response):
+        return await response.read()
+
+    async def _get(self, url, params, result=None, sample_latency=False, phase=None):
+        """Run a get request within the global and Engine concurrency limits
+
+        Args:
+            url: url of the Engine
+            params: parameters of the request (query, format, hr)
+            result: result dictionary of the Engine (for the retry and breaker counters)
+            sample_latency: give the latency of the request to the adaptive limiter
+            phase: phase of the request in the metrics (see RunMetrics.PHASES)
+
+        Return:
+            status code and body of the response
+
+        """
+
+        return await self._request(url, params, result, self._read_body, sample_latency, phase)
+
+    async def get_engine_index(self, url, query=None, stats=None, engine_index=None, result=None):
+        """Run the id query on an Engine and build its hash index
+
+        The response is parsed chunk by chunk when stream_ids is set or the
+        id format is csv.
+
+        Args:
+            url: url of the Engine
+            query: the id query to run (default: the full scan id query)
+            stats: dictionary in which the number of bytes read is added (if any)
+            engine_index: index to add the objects to (a new one is created if None)
+            result: result dictionary of the Engine (for the retry and breaker counters)
+
+        Return:
+            status code of the response and index of the Engine (None if the query failed)
+
+        """
+
+        nxql = self.nxql
+        params = {'query': query or nxql._id_query, 'format': nxql.id_format, 'hr': nxql.hr}
+        if stats is None:
+            stats = {"bytes": 0}
+
+        async def read_index(response):
+            if response.status != 200:
+                return None
+            if nxql.id_format == 'json' and not nxql.stream_ids:
+                body = await response.read()
+                stats["bytes"] += len(body)
+                return await self._run_blocking(lambda: nxql.index_engine_objects(json.loads(body), engine_index))
+            parser = nxql.new_object_parser()
+            index = nxql.index_engine_objects([], engine_index)
+            async for chunk in response.content.iter_chunked(nxql.stream_chunk_size):
+                stats["bytes"] += len(chunk)
+                await self._run_blocking(lambda: nxql.index_engine_objects(parser.feed(chunk), index))
+            await self._run_blocking(lambda: nxql.index_engine_objects(parser.close(), index))
+            return index
+
+        return await self._request(url, params, result, read_index, phase="fetch")
+
+    async def get_planned_engine_index(self, url, result=None):
+        """Asyncio version of Nxql.fetch_planned_engine_index()"""
+
+        nxql = self.nxql
+        engine = urlparse(url).netloc
+        num_lookups = len(nxql._lookup_queries) if nxql._lookup_queries is not None else None
+        plan, estimate = nxql.planner.plan(engine, nxql._id_query, len(nxql._tag_index), num_lookups)
+        queries = nxql._lookup_queries if plan == "targeted" else [nxql._id_query]
+
+        stats = {"bytes": 0}
+        start = time.monotonic()
+        engine_index = None
+        for query in queries:
+            status, engine_index = await self.get_engine_index(url, query, stats, engine_index, result)
+            if status != 200:
+                return status, None
+        nxql.planner.record(engine, nxql._id_query, plan, estimate, stats["bytes"], time.monotonic() - start,
+                            len(engine_index), len(queries))
+        if plan == "full" and nxql.snapshot_cache is not None:
+            nxql.snapshot_cache.put(url, nxql._id_query, nxql._id_column, engine_index)
+        return status, engine_index
+
+    async def get_routed_engine_index(self, url, result=None):
+        """Asyncio version of Nxql.fetch_routed_index()"""
+
+        nxql = self.nxql
+        engine_index = set(nxql._routes[url])
+        status = 200
+        if nxql._unrouted_queries:
+            with nxql.measure_phase(url, "fetch"):
+                for query in nxql._unrouted_queries:
+                    status, engine_index = await self.get_engine_index(url, query, engine_index=engine_index,
+                                                                       result=result)
+                    if status != 200:
+                        break
+        return status, engine_index
+
+    async def get_cached_engine_index(self, url):
+        """Asyncio version of SnapshotCache.get() (waiting for the download of another file off the event loop)"""
+
+        nxql = self.nxql
+        while True:
+            engine_index, pending = nxql.snapshot_cache.claim(url, nxql._id_query, nxql._id_column)
+            if pending is None:
+                return engine_index
+            await asyncio.get_running_loop().run_in_executor(None, pending.wait)
+
+    async def clear_engine_category(self, url, result=None):
+        """Asyncio version of Nxql.clear_engine_category()"""
+
+        nxql = self.nxql
+        clean_query = nxql.clean_category_query(nxql._clear_category, nxql._object_type)
+        with nxql.measure_phase(url, "clear"):
+            status, body = await self._get(url, {'query': clean_query}, result, phase="clear")
+        if status != 200:
+            self.logger.error('Unable to clean tags for Category "{}" on Engine: {} (response code {})'.format(
+                nxql._clear_category, url, status))
+            return False
+
+        # Wait for the Engine to apply the clean instead of sleeping a fixed time
+        check_query = nxql.cleared_check_query(nxql._clear_category, nxql._object_type)
+        deadline = time.monotonic() + nxql.clear_timeout
+        with nxql.measure_phase(url, "clear_wait"):
+            while True:
+                status, body = await self._get(url, {'query': check_query, 'format': 'json', 'hr': nxql.hr}, result,
+                                               phase="clear_wait")
+                if status != 200:
+                    self.logger.warning('Unable to verify the clean of Category "{}" on Engine: {} (response code {})'.format(
+                        nxql._clear_category, url, status))
+                    break
+                if not json.loads(body):
+                    self.logger.info('Tags successfully cleaned for Category "{}" on Engine: {}'.format(nxql._clear_category, url))
+                    break
+                if time.monotonic() >= deadline:
+                    self.logger.warning('Category "{}" still not clean after {}s on Engine: {} - continuing'.format(
+                        nxql._clear_category, nxql.clear_timeout, url))
+                    break
+                await asyncio.sleep(nxql.clear_poll_interval)
+
+        return True
+
+    async def _update(self, url, result, upd_query, batch_tags):
+        """Send one update query and account its outcome"""
+
+        try:
+            status, body = await self._get(url, {'query': upd_query}, result, sample_latency=True, phase="update")
+        except EngineUnavailableError as err:
+            self.logger.error('process_engine_object({}): {}'.format(url, err))
+            status = None
+        if status == 200:
+            self.nxql.record_applied(url, batch_tags)
+        self.nxql.record_update(result, upd_query, batch_tags, status)
+
+    async def process_engine_object(self, url):
+        """Asyncio version of Nxql.process_engine_object()
+
+        The update queries of the Engine are sent concurrently, up to
+        max_engine_requests at a time.
+
+        Args:
+            an url
+
+        Return:
+            the result dictionary of the Engine
+
+        """
+
+        nxql = self.nxql
+        result = nxql.new_engine_result(url)
+        try:
+            await self._process_engine_object(url, result)
+        except (EngineUnavailableError, aiohttp.ClientError, asyncio.TimeoutError) as err:
+            # The other Engines carry on, the file is reported as failed
+            self.logger.error('process_engine_object({}): {!r}'.format(url, err))
+            result["available"] = False
+        return result
+
+    async def _process_engine_object(self, url, result):
+        nxql = self.nxql
+
+        # Nothing left to do on the Engines completed by the interrupted run
+        if nxql.resume_done_engine(url, result):
+            return
+
+        # Clean the category on this Engine first (end if not successful)
+        if nxql.needs_clear(url):
+            if not await self.clear_engine_category(url, result):
+                result["cleared"] = False
+                return
+            if nxql.journal is not None:
+                nxql.journal.record_cleared(url)
+
+        # Then get the list of object identifiers from the current Engine (unless routed or cached)
+        engine_index = None
+        if url in nxql._routes:
+            status, engine_index = await self.get_routed_engine_index(url, result)
+            if status != 200:
+                self.logger.error('process_engine_object({}): Unexpected response from id query: {}'.format(url, status))
+                result["available"] = False
+                return
+            self.logger.debug('Engine "%s" has %d routed ids', url, len(engine_index))
+        elif nxql.snapshot_cache is not None:
+            engine_index = await self.get_cached_engine_index(url)
+            if engine_index is not None:
+                self.logger.debug('Engine "%s" has %d cached ids', url, len(engine_index))
+        if engine_index is None:
+            self.logger.debug('Requesting list of objects from Engine with URL "%s".', url)
+            # Build a hash index of the normalized id_column values of this engine
+            try:
+                with nxql.measure_phase(url, "fetch"):
+                    if nxql.planner:
+                        status, engine_index = await self.get_planned_engine_index(url, result)
+                    else:
+                        status, engine_index = await self.get_engine_index(url, result=result)
+                        if status == 200 and nxql.snapshot_cache is not None:
+                            nxql.snapshot_cache.put(url, nxql._id_query, nxql._id_column, engine_index)
+            finally:
+                # Let the other files waiting for this index download it if it was not stored
+                if nxql.snapshot_cache is not None:
+                    nxql.snapshot_cache.release(url, nxql._id_query, nxql._id_column)
+            if status != 200:
+                self.logger.error('process_engine_object({}): Unexpected response from id query: {}'.format(url, status))
+                result["available"] = False
+                return
+            self.logger.debug('Engine "%s" returned %d ids', url, len(engine_index))
+
+        with nxql.measure_phase(url, "match"):
+            rounds = await self._run_blocking(nxql.plan_engine_updates, engine_index, result)
+        with nxql.measure_phase(url, "update"):
+            # The rounds are sent one after another (see Nxql.plan_engine_updates())
+            for batches in rounds:
+                await asyncio.gather(*[self._update(url, result, upd_query, batch_tags) for upd_query, batch_tags in batches])
+        if nxql.journal is not None and result["num_failures"] == 0:
+            nxql.journal.record_done(url)
+
+        self.logger.debug('Engine "%s" matched %d ids, missed %d ids, skipped %d unchanged ids',
+                          url, result["num_matches"], result["num_misses"], result["num_unchanged"])
+
+    async def _process_engine_objects(self):
+        """Run the process of all the Engines on one event loop"""
+
+        self._global_limit = asyncio.Semaphore(self.max_workers)
+        # At most max_workers requests wait for the shared budget (they hold a global slot)
+        self._budget_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers,
+                                                                      thread_name_prefix="budget-wait")
+        self._engine_conditions = {url: asyncio.Condition() for url in self.nxql.urls}
+        self._in_flight = {url: 0 for url in self.nxql.urls}
+        # The connections of an Engine must hold the requests its concurrency limit lets run on it
+        limiter = self.nxql.limiter
+        connector = aiohttp.TCPConnector(limit=self.max_workers, limit_per_host=max(
+            self.max_engine_requests, limiter.max_limit if limiter else 0))
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self._on_connection)
+        trace_config.on_connection_reuseconn.append(self._on_connection)
+        headers = self.nxql._websession.get_default_headers()
+        # The same limits as the threads transport: no total limit, so the long id scans are not cut
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.nxql.connect_timeout,
+                                        sock_read=self.nxql.read_timeout)
+
+        result_list = []
+        try:
+            async with aiohttp.ClientSession(connector=connector, headers=headers, timeout=timeout,
+                                             trace_configs=[trace_config]) as self._session:
+                results = await asyncio.gather(*[self.process_engine_object(url) for url in self.nxql.urls],
+                                               return_exceptions=True)
+                for url, result in zip(self.nxql.urls, results):
+                    if isinstance(result, Exception):
+                        self.logger.error('{} generated an exception: {!r}'.format(url, result))
+                    else:
+                        self.logger.debug('%s returned %s', url, result)
+                        result_list.append(result)
+        finally:
+            self._budget_executor.shutdown(wait=False, cancel_futures=True)
+
+        return result_list
+
+    def process_engine_objects(self):
+        """Function to run the process of all the Engines with asyncio
+
+        Return:
+            list of the result dictionaries of the Engines
+
+        """
+
+        return asyncio.run(self._process_engine_objects())
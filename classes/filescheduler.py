@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# Copyright (C) 2017 Nexthink SA, Switzerland
+
+# Library import
+import concurrent.futures
+import os
+
+import classes.functions as functions
+
+
+class FileScheduler(object):
+    """Summary of class FileScheduler.
+
+    Runs the tag files of a run at the same time, one after another within
+    a group of files updating the same Category.
+
+    Object Attributes:
+        max_files: maximum number of files processed at the same time
+        logger: this is to log INFO/WARNING/ERROR/DEBUG messages
+
+    """
+
+    def __init__(self, max_files, logger):
+        self.max_files = max_files
+        self.logger = logger
+
+    @staticmethod
+    def get_file_key(file_name):
+        """Get the (Category, Object Type) updated by a tag file
+
+        Args:
+            file_name: the name of the CSV file
+
+        Return:
+            the (Category, Object Type) of the first row
+
+        """
+
+        tags = functions.stream_csv_file(file_name)
+        try:
+            first_tag = next(tags)
+        finally:
+            tags.close()
+        return first_tag.category, first_tag.object_type
+
+    def group_files(self, file_names):
+        """Group the tag files updating the same Category
+
+        Return:
+            list of the groups (lists of file names, oldest first), the group of the oldest file first
+
+        """
+
+        groups = {}
+        for file_name in sorted(file_names, key=os.path.getmtime):
+            try:
+                key = self.get_file_key(file_name)
+            except functions.TagFileError:
+                # A group of its own: the file fails when it is processed
+                key = (None, file_name)
+            groups.setdefault(key, []).append(file_name)
+        for key, group in groups.items():
+            self.logger.debug('Category "{}" of {} objects: {} files to process in order: {}'.format(
+                key[0], key[1], len(group), group))
+        return list(groups.values())
+
+    def _run_group(self, group, func):
+        for file_name in group:
+            try:
+                func(file_name)
+            except Exception as exc:
+                self.logger.error('Processing of {} generated an exception: {!r}'.format(file_name, exc))
+
+    def run(self, file_names, func):
+        """Process the tag files
+
+        Args:
+            file_names: list of the CSV files to process
+            func: function processing one file (called with the file name)
+
+        """
+
+        groups = self.group_files(file_names)
+        self.logger.info('Processing {} files in {} independent groups, up to {} at the same time'.format(
+            len(file_names), len(groups), self.max_files))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_files) as executor:
+            futures = [executor.submit(self._run_group, group, func) for group in groups]
+            for future in futures:
+                # Re-raise the program exits of the workers
+                future.result()
@@ -15,8 +15,18 @@ import subprocess
 import sys
 import xml.etree.ElementTree as Xml
 
+from classes.tagrow import TagRow
+
 logger = logging.getLogger('nxql')
 
+class TagFileError(Exception):
+    """Raised when a tag file cannot be read (only this file fails, the other files carry on)"""
+
+    def __init__(self, file_name, reason):
+        super().__init__('Invalid tag file "{}": {}'.format(file_name, reason))
+        self.file_name = file_name
+        self.reason = reason
+
 def send_mail(subject, text, attachment, recipients):
     """Send email function (FROM PREVOUS CODE)
 
@@ -253,6 +263,66 @@ def read_csv_file(file_name):
         logger.error(message)
         sys.exit(1)
 
+def stream_csv_file(file_name, mixed=False):
+    """ Function to stream the rows of a CSV tag file
+
+    Generator that reads a CSV tag file row by row and yields compact TagRow
+    objects instead of building a list of dictionaries.
+    All rows must have the same Object Type and Category as the first one,
+    unless the file is a mixed one.
+
+    Args:
+        file_name: the name of the CSV file
+        mixed: accept rows of several Object Types and Categories
+
+    Return:
+        an iterator of TagRow objects
+
+    Raise:
+        TagFileError if the file is missing, empty or has an invalid header or row
+
+    """
+    try:
+        with open(file_name, 'r', newline='') as file:
+
+            csv_file = csv.reader(file)
+            header = next(csv_file, None)
+            if not header:
+                raise TagFileError(file_name, 'No tags found')
+            # Position of each column in the rows
+            columns = {name: header.index(name) for name in ("Object Type", "Object ID", "Category", "Keyword")
+                       if name in header}
+            if len(columns) < 4:
+                raise TagFileError(file_name, 'Missing column in header: {}'.format(header))
+            type_index = columns["Object Type"]
+            id_index = columns["Object ID"]
+            category_index = columns["Category"]
+            keyword_index = columns["Keyword"]
+            num_columns = max(columns.values()) + 1
+
+            first = None
+            for line_number, row in enumerate(csv_file, start=2):
+                if not row:
+                    continue
+                if len(row) < num_columns:
+                    raise TagFileError(file_name, 'Line {}: {} columns instead of {}'.format(
+                        line_number, len(row), len(header)))
+                tag = TagRow(row[type_index], row[id_index], row[category_index], row[keyword_index])
+                if first is None:
+                    first = tag
+                # Interned strings, so identity is enough to check the row matches the first one
+                elif not mixed and (tag.object_type is not first.object_type or tag.category is not first.category):
+                    raise TagFileError(file_name, 'Line {}: Object Type "{}" and Category "{}" differ from the first row ("{}", "{}")'.format(
+                        line_number, tag.object_type, tag.category, first.object_type, first.category))
+                yield tag
+
+        # If the file is empty or has only headers
+        if first is None:
+            raise TagFileError(file_name, 'No tags found')
+
+    except (OSError, UnicodeDecodeError, csv.Error) as ex:
+        raise TagFileError(file_name, repr(ex)) from ex
+
 def get_credentials(file_name, logger):
     """Function to get the username and password from a file
 
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# Copyright (C) 2017 Nexthink SA, Switzerland
+
+# Library import
+import json
+import os
+import threading
+
+
+class TagJournal(object):
+    """Summary of class TagJournal.
+
+    Append-only checkpoint journal of the processing of a tag file, read
+    back to resume an interrupted run.
+
+    Object Attributes:
+        path: path of the journal file
+        run: identifier of the run (rundate)
+        resume: continue from the journal of an interrupted run (if it matches the file)
+        logger: this is to log INFO/WARNING/ERROR/DEBUG messages
+
+    """
+
+    def __init__(self, path, run, resume, logger):
+        self.path = path
+        self.run = run
+        self.resume = resume
+        self.logger = logger
+        self._file = None
+        self._lock = threading.Lock()
+        self._cleared = set()
+        self._done = set()
+        self._applied = {}
+
+    @staticmethod
+    def get_file_signature(file_name):
+        """Get the (size, mtime) of a tag file, to check that a resumed run processes the same file"""
+
+        stat = os.stat(file_name)
+        return [stat.st_size, stat.st_mtime]
+
+    def _load(self, start):
+        """Read the records of the journal of an interrupted run
+
+        Return:
+            True if the journal is for the same file, mode and Category as start
+
+        """
+
+        records = []
+        valid_size = 0
+        with open(self.path, 'rb') as file:
+            for line in file:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('incomplete record')
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Last record cut by the interruption
+                    break
+                valid_size += len(line)
+        if not records or records[0].get("event") != "start":
+            return False
+        first = records[0]
+        if any(first.get(key) != start[key] for key in ("file", "signature", "mode", "category", "object_type")):
+            return False
+        # Drop the cut record so that the next records are appended after a complete line
+        os.truncate(self.path, valid_size)
+        for record in records:
+            event = record.get("event")
+            if event == "cleared":
+                self._cleared.add(record["engine"])
+            elif event == "applied":
+                self._applied.setdefault(record["engine"], set()).update(record["ids"])
+            elif event == "done":
+                self._done.add(record["engine"])
+        self.logger.info('Resuming {} from run {}: {} Engines done, {} cleaned, {} ids applied'.format(
+            start["file"], first.get("run"), len(self._done), len(self._cleared),
+            sum(len(ids) for ids in self._applied.values())))
+        return True
+
+    def open(self, file_name, mode, category, object_type):
+        """Open the journal of a tag file
+
+        Args:
+            file_name: the tag file
+            mode: 'clear' or 'diff'
+            category: the Category of the tags
+            object_type: the Object Type of the tags
+
+        """
+
+        start = {"event": "start", "run": self.run, "file": os.path.basename(file_name),
+                 "signature": self.get_file_signature(file_name), "mode": mode, "category": category,
+                 "object_type": object_type}
+        if self.resume and os.path.exists(self.path):
+            if self._load(start):
+                self._file = open(self.path, 'a')
+                self._write({"event": "resume", "run": self.run}, sync=True)
+                return
+            self.logger.warning('Journal {} does not match {} - starting from the beginning'.format(self.path, file_name))
+        elif self.resume:
+            self.logger.info('No journal to resume for {} - starting from the beginning'.format(file_name))
+        self._file = open(self.path, 'w')
+        self._write(start, sync=True)
+
+    def _write(self, record, sync=False):
+        with self._lock:
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def is_cleared(self, engine):
+        return engine in self._cleared
+
+    def is_done(self, engine):
+        return engine in self._done
+
+    def get_applied(self, engine):
+        """Get the normalized ids already applied on an Engine"""
+
+        return self._applied.get(engine, set())
+
+    def record_cleared(self, engine):
+        self._write({"event": "cleared", "engine": engine}, sync=True)
+
+    def record_applied(self, engine, keys):
+        self._write({"event": "applied", "engine": engine, "ids": keys})
+
+    def record_done(self, engine):
+        self._write({"event": "done", "engine": engine}, sync=True)
+
+    def close(self):
+        """Close the journal"""
+
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
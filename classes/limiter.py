@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# Copyright (C) 2017 Nexthink SA, Switzerland
+
+# Library import
+import threading
+
+
+class AdaptiveLimiter(object):
+    """Summary of class AdaptiveLimiter.
+
+    AIMD limit of the requests running at the same time on each Engine,
+    driven by the round-trip latency and the NX_EXEC_TIME of its requests.
+
+    Object Attributes:
+        initial_limit: limit of an Engine before its first sample
+        min_limit: floor of the limit
+        max_limit: ceiling of the limit
+        logger: this is to log INFO/WARNING/ERROR/DEBUG messages
+        tolerance: ratio of the recent latency (or execution time) to its baseline above which the limit decreases
+        backoff: factor applied to the limit when it decreases
+
+    """
+
+    # Weight of a sample in the recent averages
+    RECENT_WEIGHT = 0.2
+    # Weight of a recent average above the baseline in the baseline
+    BASELINE_WEIGHT = 0.01
+
+    def __init__(self, initial_limit, min_limit, max_limit, logger, tolerance=2.0, backoff=0.7):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.initial_limit = min(max(initial_limit, self.min_limit), self.max_limit)
+        self.logger = logger
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self._engines = {}
+        self._lock = threading.Lock()
+
+    def _get(self, engine):
+        return self._engines.setdefault(engine, {
+            "limit": float(self.initial_limit), "samples": 0, "since_decrease": 0,
+            "latency": None, "latency_base": None, "exec_time": None, "exec_time_base": None})
+
+    def _average(self, state, name, value):
+        """Update the recent average and the baseline of a measure"""
+
+        if value is None:
+            return
+        recent = state[name]
+        recent = value if recent is None else (1 - self.RECENT_WEIGHT) * recent + self.RECENT_WEIGHT * value
+        state[name] = recent
+        base = state[name + "_base"]
+        if base is None or recent < base:
+            state[name + "_base"] = recent
+        else:
+            state[name + "_base"] = (1 - self.BASELINE_WEIGHT) * base + self.BASELINE_WEIGHT * recent
+
+    def _is_slow(self, state, name):
+        recent, base = state[name], state[name + "_base"]
+        return recent is not None and base and recent > self.tolerance * base
+
+    def get_limit(self, engine):
+        """Get the current limit of the requests running at the same time on an Engine"""
+
+        with self._lock:
+            return int(self._get(engine)["limit"])
+
+    def record(self, engine, latency, exec_time=None, failed=False):
+        """Adjust the limit of an Engine with the outcome of a request
+
+        Args:
+            engine: the Engine (its url)
+            latency: round-trip time of the request (in seconds)
+            exec_time: execution time returned by the Engine in NX_EXEC_TIME (if any)
+            failed: the request failed with a transient error
+
+        """
+
+        with self._lock:
+            state = self._get(engine)
+            state["samples"] += 1
+            state["since_decrease"] += 1
+            if not failed:
+                self._average(state, "latency", latency)
+                self._average(state, "exec_time", exec_time)
+            previous = state["limit"]
+
+            if failed or self._is_slow(state, "latency") or self._is_slow(state, "exec_time"):
+                # Decrease once per round of requests, the requests already running saw the same load
+                if state["since_decrease"] < previous:
+                    return
+                state["limit"] = max(self.min_limit, previous * self.backoff)
+                state["since_decrease"] = 0
+                reason = "failed request" if failed else "latency {:.3f}s (baseline {:.3f}s), execution time {} (baseline {})".format(
+                    state["latency"], state["latency_base"], state["exec_time"], state["exec_time_base"])
+            else:
+                state["limit"] = min(self.max_limit, previous + 1 / previous)
+                reason = "latency {:.3f}s (baseline {:.3f}s)".format(state["latency"], state["latency_base"])
+
+            if int(state["limit"]) != int(previous):
+                self.logger.info('Engine "{}": concurrency limit {} -> {} after {} requests - {}'.format(
+                    engine, int(previous), int(state["limit"]), state["samples"], reason))
+
+    def get_stats(self):
+        """Get the current limit of each Engine
+
+        Return:
+            dict of Engine -> limit
+
+        """
+
+        with self._lock:
+            return {engine: int(state["limit"]) for engine, state in self._engines.items()}
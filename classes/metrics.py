@@ -0,0 +1,222 @@
+#!/usr/bin/python
+# Copyright (C) 2017 Nexthink SA, Switzerland
+
+# Library import
+import contextlib
+import datetime
+import json
+import os
+import threading
+import time
+
+
+class RunMetrics(object):
+    """Summary of class RunMetrics.
+
+    Timing and request measures of a tag file or a run, per Engine and
+    per phase, written as a JSON report.
+
+    Object Attributes:
+        name: what is measured (the tag file or the run)
+        run: identifier of the run (rundate)
+
+    """
+
+    PHASES = ("clear", "clear_wait", "fetch", "match", "update")
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, name, run):
+        self.name = name
+        self.run = run
+        self.started = datetime.datetime.now()
+        self._start = time.monotonic()
+        self._engines = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def _get(self, url):
+        return self._engines.setdefault(url, {"phases": {}, "requests": {}, "result": {}})
+
+    @staticmethod
+    def _new_requests():
+        return {"count": 0, "errors": 0, "status_codes": {}, "bytes_sent": 0, "bytes_received": 0,
+                "latencies": [], "exec_times": []}
+
+    def _get_requests(self, url, phase):
+        return self._get(url)["requests"].setdefault(phase, self._new_requests())
+
+    @staticmethod
+    def _add_requests(total, requests):
+        for key in ("count", "errors", "bytes_sent", "bytes_received"):
+            total[key] += requests[key]
+        for code, count in requests["status_codes"].items():
+            total["status_codes"][code] = total["status_codes"].get(code, 0) + count
+        total["latencies"].extend(requests["latencies"])
+        total["exec_times"].extend(requests["exec_times"])
+
+    def add_phase_time(self, url, phase, seconds):
+        """Add to the wall time of a phase on an Engine"""
+
+        with self._lock:
+            timing = self._get(url)["phases"].setdefault(phase, {"wall_time": 0.0, "count": 0})
+            timing["wall_time"] += seconds
+            timing["count"] += 1
+
+    @contextlib.contextmanager
+    def phase(self, url, phase):
+        """Measure the wall time of a phase on an Engine (with statement)"""
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase_time(url, phase, time.monotonic() - start)
+
+    def record_request(self, url, phase, latency, status_code, bytes_sent=0, bytes_received=0, exec_time=None):
+        """Record a request (an attempt) sent to an Engine
+
+        Args:
+            url: url of the Engine
+            phase: phase of the request (one of PHASES)
+            latency: round-trip time of the request (in seconds)
+            status_code: status code of the response (None if no response)
+            bytes_sent: length of the request url
+            bytes_received: length of the response body (if downloaded with the response)
+            exec_time: value of the NX_EXEC_TIME header of the response (if any)
+
+        """
+
+        try:
+            exec_time = float(exec_time)
+        except (TypeError, ValueError):
+            exec_time = None
+        with self._lock:
+            requests = self._get_requests(url, phase)
+            requests["count"] += 1
+            if status_code is None:
+                requests["errors"] += 1
+            else:
+                key = str(status_code)
+                requests["status_codes"][key] = requests["status_codes"].get(key, 0) + 1
+            requests["bytes_sent"] += bytes_sent
+            requests["bytes_received"] += bytes_received
+            requests["latencies"].append(latency)
+            if exec_time is not None:
+                requests["exec_times"].append(exec_time)
+
+    def add_bytes_received(self, url, phase, num_bytes):
+        """Add the bytes of a response body read after its request was recorded (streamed responses)"""
+
+        with self._lock:
+            self._get_requests(url, phase)["bytes_received"] += num_bytes
+
+    def record_results(self, results):
+        """Keep the counters of the result dictionaries of the Engines"""
+
+        with self._lock:
+            for result in results:
+                self._get(result["url"])["result"] = {key: value for key, value in result.items()
+                                                      if not isinstance(value, list) and key != "url"}
+
+    def add_counter(self, name, value=1):
+        """Add to a counter of the file or the run"""
+
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def merge(self, other):
+        """Add the measures of another RunMetrics (the ones of a file to the ones of the run)"""
+
+        with self._lock, other._lock:
+            for url, engine in other._engines.items():
+                target = self._get(url)
+                for phase, timing in engine["phases"].items():
+                    total = target["phases"].setdefault(phase, {"wall_time": 0.0, "count": 0})
+                    total["wall_time"] += timing["wall_time"]
+                    total["count"] += timing["count"]
+                for phase, requests in engine["requests"].items():
+                    self._add_requests(self._get_requests(url, phase), requests)
+                for key, value in engine["result"].items():
+                    if isinstance(value, bool):
+                        target["result"][key] = target["result"].get(key, True) and value
+                    else:
+                        target["result"][key] = target["result"].get(key, 0) + value
+            for name, value in other._counters.items():
+                self._counters[name] = self._counters.get(name, 0) + value
+
+    @classmethod
+    def get_distribution(cls, samples):
+        """Get the percentiles (nearest rank), the mean and the maximum of samples"""
+
+        if not samples:
+            return None
+        samples = sorted(samples)
+        distribution = {"p{}".format(percentile): samples[max(0, -(-percentile * len(samples) // 100) - 1)]
+                        for percentile in cls.PERCENTILES}
+        distribution["mean"] = sum(samples) / len(samples)
+        distribution["max"] = samples[-1]
+        return distribution
+
+    def _report_requests(self, requests):
+        report = {key: value for key, value in requests.items() if key not in ("latencies", "exec_times")}
+        report["latency"] = self.get_distribution(requests["latencies"])
+        report["exec_time"] = self.get_distribution(requests["exec_times"])
+        return report
+
+    def get_phase_times(self):
+        """Get the wall time of each phase, summed over the Engines
+
+        Return:
+            dict of phase -> seconds
+        """
+
+        with self._lock:
+            totals = {}
+            for engine in self._engines.values():
+                for phase, timing in engine["phases"].items():
+                    totals[phase] = totals.get(phase, 0.0) + timing["wall_time"]
+            return totals
+
+    def get_report(self, **extra):
+        """Get the report of the measures
+
+        Args:
+            extra: other values to put in the report
+
+        Return:
+            a dictionary that can be serialized to JSON
+        """
+
+        with self._lock:
+            engines = {}
+            all_requests = {}
+            for url, engine in sorted(self._engines.items()):
+                engines[url] = {"phases": {phase: dict(timing) for phase, timing in engine["phases"].items()},
+                                "result": dict(engine["result"]),
+                                "requests": {phase: self._report_requests(requests)
+                                             for phase, requests in engine["requests"].items()}}
+                for phase, requests in engine["requests"].items():
+                    self._add_requests(all_requests.setdefault(phase, self._new_requests()), requests)
+            report = {"name": self.name, "run": self.run, "started": self.started.isoformat(timespec='seconds'),
+                      "wall_time": time.monotonic() - self._start}
+            report["counters"] = dict(self._counters)
+            report.update(extra)
+            report["requests"] = {phase: self._report_requests(requests) for phase, requests in all_requests.items()}
+            report["engines"] = engines
+        report["phases"] = self.get_phase_times()
+        return report
+
+    def write_report(self, path, **extra):
+        """Write the JSON report (atomically)
+
+        Args:
+            path: path of the report file
+            extra: other values to put in the report
+
+        """
+
+        data = json.dumps(self.get_report(**extra), indent=1, sort_keys=True)
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w') as file:
+            file.write(data)
+        os.replace(temp_path, path)
@@ -3,7 +3,10 @@
 
 # Library import
 import concurrent.futures
+import contextlib
+import copy
 import http.client
+import itertools
 import logging
 from multiprocessing.pool import ThreadPool
 import urllib.request, urllib.parse, urllib.error
@@ -15,6 +18,14 @@ import socket
 import os
 import requests
 import sys
+import threading
+import time
+
+from classes.patternindex import PatternIndex
+from classes.retry import CircuitBreaker, EngineUnavailableError, RetryPolicy
+from classes.scheduler import UpdateScheduler
+from classes.streamparse import CsvRowParser, JsonArrayParser
+from classes.tagrow import TagRow
 
 
 
@@ -36,6 +47,31 @@ class Nxql(object):
         engine: the list of Engine on which the nxql query will run
         r_format: The return format of the query (xml, csv, json)
         hr: human readable variable (true or false)
+        batch_size: maximum number of objects updated by a single update query
+        max_query_length: maximum length (in characters) of a batched update query
+        clear_timeout: maximum time (in seconds) to wait for an Engine to apply a category clear
+        clear_poll_interval: time (in seconds) between two checks of a category clear
+        connect_timeout: time (in seconds) to wait for the connection to an Engine
+        read_timeout: time (in seconds) to wait for data from an Engine
+        transport: how the Engines are queried ('threads' or 'asyncio')
+        max_workers: maximum number of requests running at the same time
+        max_engine_requests: maximum number of update requests running at the same time on one Engine
+        update_workers: number of threads sending the update requests of all the Engines (threads)
+        id_format: format of the id query responses ('json' or the lighter 'csv')
+        stream_ids: parse the id query responses chunk by chunk instead of loading them in memory
+        stream_chunk_size: size (in bytes) of the chunks read from a streamed response
+        planner: QueryPlanner choosing between full id scans and targeted lookups (None to always scan)
+        lookup_chunk_size: maximum number of ids in a targeted lookup query
+        snapshot_cache: SnapshotCache sharing the full id scans between the files of a run (None to disable)
+        retry_policy: RetryPolicy of the requests failing with a transient error
+        breaker: CircuitBreaker parking the Engines that keep failing (None to disable)
+        journal: TagJournal of the current tag file (None to disable the checkpoints)
+        limiter: AdaptiveLimiter of the update requests running at the same time on one Engine
+                 (None for a fixed max_engine_requests)
+        metrics: RunMetrics of the current tag file (None to disable the timing)
+        engine_url_template: url of the query endpoint of an Engine, {} being replaced by the Engine address
+        trace_sample: with DEBUG logging, log one in trace_sample of the per object trace messages (0 for none)
+        scheduler: started UpdateScheduler shared by the tag files of the run (None to start one per call)
         logger: this is to log INFO/WARNING/ERROR/DEBUG messages
         urls: list of prepared url that will be fetched by urllib2 library
 
@@ -80,6 +116,35 @@ class Nxql(object):
         self.engine = []
         self.urls = []
         self.opener = None
+        self.batch_size = 1
+        self.max_query_length = 4000
+        self.clear_timeout = 30
+        self.clear_poll_interval = 1
+        self.connect_timeout = 10
+        self.read_timeout = 120
+        self.transport = 'threads'
+        self.max_workers = 40
+        self.max_engine_requests = 4
+        self.update_workers = 40
+        self.id_format = 'json'
+        self.stream_ids = False
+        self.stream_chunk_size = 65536
+        self.planner = None
+        self.lookup_chunk_size = 100
+        self.snapshot_cache = None
+        self.retry_policy = RetryPolicy()
+        self.breaker = None
+        self.journal = None
+        self.limiter = None
+        self.metrics = None
+        self.engine_url_template = 'https://{}:1671/2/query'
+        self.trace_sample = 1
+        self.scheduler = None
+        self._trace_count = itertools.count()
+        self._run_scheduler = None
+        self._result_lock = threading.Lock()
+        self._tag_index = {}
+        self._pattern_index = PatternIndex({})
         self.logger = logger
         self._websession = websession
 
@@ -131,6 +196,57 @@ class Nxql(object):
         else:
             self._hr = h
 
+    def copy(self):
+        """Copy the nxql object to process another tag file at the same time
+
+        The copy keeps the settings, the web session, the logger, the planner,
+        the update scheduler and the snapshot cache of the nxql object, with
+        its own Engine list, tags and urls.
+
+        Return:
+            the new nxql object
+
+        """
+
+        clone = copy.copy(self)
+        clone.engine = list(self.engine)
+        clone.urls = []
+        clone._tag_index = {}
+        clone._routes = {}
+        clone._unrouted_queries = None
+        clone._run_scheduler = None
+        clone.journal = None
+        clone.metrics = None
+        clone._result_lock = threading.Lock()
+        return clone
+
+    @property
+    def tag_index(self):
+        # Normalized Object ID -> TagRow of the tags being processed
+        return self._tag_index
+
+    @property
+    def pattern_index(self):
+        # Literal ids and wildcard patterns of the tags being processed
+        return self._pattern_index
+
+    @staticmethod
+    def normalize_id(object_id):
+        """Normalize an object identifier for matching
+
+        Engines and tag files do not agree on the case of object names, so
+        every identifier is case-folded before it goes into a match index.
+
+        Args:
+            object_id: identifier as returned by the Engine or read from the tag file
+
+        Return:
+            str: the normalized identifier
+
+        """
+
+        return object_id.casefold()
+
     def add_engine(self, e):
         """Append Engine to the list of Engine
 
@@ -165,6 +281,40 @@ class Nxql(object):
         self._query = query
         return query
 
+    def cleared_check_query(self, category_name, object_type):
+        """Prepare a query checking that a category was cleaned
+
+        The query returns at most one object of the given type that still has
+        a value in the category, so an empty result means the clean query was
+        applied by the Engine.
+
+        Args:
+            category_name: Name of the category
+            object_type: Type of the object on which we have the category
+
+        """
+
+        template = "(select (id) (from {1} (where {1} (ne #\"{0}\" nil))) (limit 1))"
+        query = template.format(category_name, object_type)
+        self.logger.debug("Cleared Check Query: " + query)
+        return query
+
+    def add_select_field(self, query, field):
+        """Add a field to the fields returned by a select query
+
+        Args:
+            query: a select query, e.g. (select (name) (from device))
+            field: field to add, e.g. #"Category"
+
+        Return:
+            str: the select query returning the field as well
+
+        """
+
+        index = query.index("(select") + len("(select")
+        index = query.index("(", index) + 1
+        return query[:index] + field + " " + query[index:]
+
     def start_update_query(self, keyword, category_name, object_type):
         """Start the creation of an update query for a specific tag
 
@@ -172,15 +322,18 @@ class Nxql(object):
         object.
 
         Args:
-            keyword: one of the keyword of a category
+            keyword: one of the keyword of a category (None to remove the keyword)
             category_name: Name of the category
             object_type: Type of the object on which we have the category
 
         """
 
-        template = '(update (set #"{0}" (enum "{1}")) (from {2}'
+        if keyword is None:
+            template = '(update (set #"{0}" nil) (from {2}'
+        else:
+            template = '(update (set #"{0}" (enum "{1}")) (from {2}'
         query = template.format(category_name, keyword, object_type)
-        self.logger.debug("Update Query: " + query)
+        self.trace("Update Query: %s", query)
         self._query = query
         return query
 
@@ -197,18 +350,11 @@ class Nxql(object):
 
         """
 
-        if condition_field not in ['id', 'hash', 'name']:
+        condition = self.get_condition(condition_field, value, object_type)
+        if condition is None:
             self.logger.warn("Invalid condition field. Condition not added.")
         else:
-            if condition_field == 'id':
-                template = '(where {0} (eq id (identifier {1})))'
-            if condition_field == 'hash':
-                template = '(where {0} (eq hash (md5 {1})))'
-            if condition_field == 'name' and object_type == 'binary':
-                template = '(where {0} (eq executable_name (pattern {1})))'
-            if condition_field == 'name' and object_type != 'binary':
-                template = '(where {0} (eq name (pattern "{1}")))'
-            query = template.format(object_type, value)
+            query = self.where_clause(object_type, [condition])
             if base_query:
                 new_query = base_query + query
                 return new_query
@@ -216,6 +362,42 @@ class Nxql(object):
                 self._query += query
                 return self._query
 
+    @staticmethod
+    def get_condition(condition_field, value, object_type):
+        """Get the condition matching one object, to put in a where clause
+
+        Args:
+            condition_field: field on which we apply the condition (id, hash, name)
+            value: value of the field
+            object_type: Type of the object
+
+        Return:
+            str: the condition, or None if the condition field is invalid
+
+        """
+
+        if condition_field == 'id':
+            return '(eq id (identifier {0}))'.format(value)
+        if condition_field == 'hash':
+            return '(eq hash (md5 {0}))'.format(value)
+        if condition_field == 'name' and object_type == 'binary':
+            return '(eq executable_name (pattern {0}))'.format(value)
+        if condition_field == 'name':
+            return '(eq name (pattern "{0}"))'.format(value)
+        return None
+
+    @staticmethod
+    def where_clause(object_type, conditions):
+        """Build a where clause matching any of the conditions
+
+        The conditions of one where clause are ORed, while several where
+        clauses in a from clause are ANDed: the conditions of the objects of
+        a batch must be in one clause.
+
+        """
+
+        return '(where {0} {1})'.format(object_type, ' '.join(conditions))
+
     def finish_update_query(self, base_query=None):
         """Finish the construction of the update query
 
@@ -224,13 +406,23 @@ class Nxql(object):
         """
         if base_query:
             new_query = base_query + "))"
-            self.logger.debug("Full Update Query: " + new_query)
+            self.trace("Full Update Query: %s", new_query)
             return new_query
         else:
             self._query += "))"
-            self.logger.debug("Full Update Query: " + self.query)
+            self.trace("Full Update Query: %s", self._query)
             return self._query
 
+    def trace(self, message, *args):
+        """Log a per object debug message (one in trace_sample of them)
+
+        The message is only formatted (with args, lazily) if it is logged.
+
+        """
+
+        if self.trace_sample and self.logger.isEnabledFor(logging.DEBUG) and next(self._trace_count) % self.trace_sample == 0:
+            self.logger.debug(message, *args)
+
     def build_validating_opener(self, ca_certs):
         class VerifiedHTTPSConnection(http.client.HTTPSConnection):
             def connect(self):
@@ -285,102 +477,12 @@ class Nxql(object):
 
             for engine in self.engine:
                 self.logger.debug("Creating URL for Engine: " + engine)
-                url = 'https://' + engine + ':1671/2/query'
+                url = self.engine_url_template.format(engine)
                 request = urllib.request.Request(url, parameters)
                 request.add_header("Authorization", "Basic %s" % auth_string)
                 self.logger.debug("Request Header: " + str(request.headers))
                 self.urls.append(request)
 
-    def prepare_url_2(self):
-        """Another version of prepare_url() : Prepare the full urls to run the query later on
-
-        - Verify credentials
-        - Prepare a list of URLs for each engine to be queried
-        - if no engines found, exits the program
-
-        """
-        try :
-            """ self.logger.debug("Verifying credentials for URL preparation ...")
-            if Nxql.verify_credentials():
-                self.logger.debug("Credentials verified successfully")
-                if self.urls:
-                    self.urls = []
-                    self.logger.debug("Emptied URL list")
-                if not self.engine:
-                    raise ValueError("Engine list is empty.") """
-
-            # Empty the URLs list first
-            self.urls = []
-
-            # Populate the  URL list based on each available Engine
-            for engine in self.engine:
-                # We create a URL with each engine's hostname
-                url = 'https://' + engine + ':1671/2/query'
-                self.logger.debug("Built URL : " + url)
-                # We add all engines' URL in a list
-                self.urls.append(url)
-        
-        except ValueError as value_ex:
-            self.logger.error("No Engines available - cannot proceed, closing program")
-            sys.exit(1)
-
-    def fetch_url_2(self, url):
-        """Another version of fetch_url() that uses the Requests library
-
-        Function that runs a get request adding:
-        - the query
-        - specifing the format
-        - authentication
-        - verify : do not use SSL
-
-        Args:
-            an url
-
-        Return:
-            an http response object
-
-        """
-        try:
-            session = self._websession.create_session()
-            response = session.get(url, params={'query': self.query, 'format': self.r_format, 'hr': self.hr},
-                                stream=False, verify=False)
-            
-            response.raise_for_status()
-
-        except requests.exceptions.ConnectionError as err:
-            self.logger.error(f"An error has occured : " + str(err))
-            raise SystemExit(err)
-           
-        else:
-            return response
-
-    def run_request_2(self):
-        """Function to run requests in parallel
-
-        Function that uses a ThreadPool to run several get requests in parallel on serveral engines.
-        It will store the result made of (hostname, response text, response code) in a list
-
-        Return:
-            list of (hostname, response text, response code)
-
-        """
-        result_list = []
-        # We can use a with statement to ensure threads are cleaned up promptly
-        with concurrent.futures.ThreadPoolExecutor(max_workers=40) as executor:
-            # Start the load operations and mark each future with its URL
-            future_to_url = {executor.submit(self.fetch_url_2, url): url for url in self.urls}
-            for future in concurrent.futures.as_completed(future_to_url):
-                url = future_to_url[future]
-                try:
-                    response = future.result()
-                except Exception as exc:
-                    self.logger.error('{} generated an exception: {}'.format(url, exc))
-                else:
-                    self.logger.debug('{} returned {}'.format(url, response))
-                    result_list.append((urlparse(response.url).hostname,response.text, response.status_code))
-
-        return result_list
-
     def fetch_url(self, url):
         """Function to actually run a query for a specific url
 
@@ -450,10 +552,15 @@ class Nxql(object):
 
         return result_list
     
-    def prepare_for_engine_object_updates(self, id_query, id_column, tags):
+    def prepare_for_engine_object_updates(self, id_query, id_column, tags, clear_category=None, object_type=None,
+                                          diff_category=None):
         """Prepare the full urls to run the query later on
 
         - Preserve the condition building parameters
+        - Preserve the category to clean on each Engine before the updates (if any)
+        - Preserve the category to compare with the tags in differential mode (if any):
+          the id query also returns the current category value and only the
+          objects whose keyword must be added, changed or removed are updated
         - Prepare a list of URLs for each engine to be queried
         - if no engines found, exits the program
 
@@ -463,7 +570,22 @@ class Nxql(object):
             # Put the criteria here to be used by the threaded calls
             self._id_query = id_query
             self._id_column = id_column
-            self._tags = tags
+            self._clear_category = clear_category
+            self._object_type = object_type
+            self._diff_category = diff_category
+            self._routes = {}
+            self._unrouted_queries = None
+            if diff_category:
+                self._id_query = self.add_select_field(id_query, '#"{}"'.format(diff_category))
+
+            # Normalize the tag ids once for all Engines while consuming the rows
+            # (last row wins on duplicates)
+            self._tag_index = {Nxql.normalize_id(tag.object_id): tag for tag in tags}
+            # The name conditions of the update queries are patterns: their ids can hold wildcards
+            self._pattern_index = PatternIndex(self._tag_index, wildcards=id_column == 'name')
+            if self._pattern_index.patterns:
+                self.logger.info('{} of the {} tags are wildcard patterns'.format(len(self._pattern_index.patterns), len(self._tag_index)))
+            self._lookup_queries = self.build_lookup_queries() if self.planner else None
 
             # Empty the URLs list first
             self.urls = []
@@ -471,7 +593,7 @@ class Nxql(object):
             # Populate the  URL list based on each available Engine
             for engine in self.engine:
                 # We create a URL with each engine's hostname
-                url = 'https://' + engine + ':1671/2/query'
+                url = self.engine_url_template.format(engine)
                 self.logger.debug("Built URL : " + url)
                 # We add all engines' URL in a list
                 self.urls.append(url)
@@ -480,11 +602,774 @@ class Nxql(object):
             self.logger.error("No Engines available - cannot proceed, closing program")
             sys.exit(1)
 
+    def build_lookup_queries(self, tags=None):
+        """Build the targeted lookup queries of the current tags (or of some of them)
+
+        A where clause matching the tag ids is added to the from clause of
+        the id query, in chunks of lookup_chunk_size ids (or max_query_length
+        characters). Id queries that already have a where clause cannot be
+        targeted, as the two clauses would be ANDed.
+        In differential mode the where clause of the first query also matches
+        the objects having a keyword in the category, so that the removals are
+        still found.
+
+        Args:
+            tags: the tag rows to look up (default: all the current tags)
+
+        Return:
+            list of id queries (None if the id query cannot be targeted)
+
+        """
+
+        query = self._id_query
+        start = query.find("(from ")
+        if start < 0 or "(where" in query:
+            return None
+
+        # Find the closing parenthesis of the from clause
+        depth = 0
+        quoted = False
+        for end in range(start, len(query)):
+            if query[end] == '"':
+                quoted = not quoted
+            elif not quoted and query[end] == "(":
+                depth += 1
+            elif not quoted and query[end] == ")":
+                depth -= 1
+                if depth == 0:
+                    break
+        prefix = query[:end]
+        suffix = query[end:]
+
+        object_type = self._object_type
+        # Length of the query without its conditions: prefix, "(where <type> " ... ")" and suffix
+        empty_length = len(prefix) + len(self.where_clause(object_type, [])) + len(suffix)
+        queries = []
+        conditions = []
+        if self._diff_category:
+            conditions.append('(ne #"{0}" nil)'.format(self._diff_category))
+        length = empty_length + sum(len(condition) for condition in conditions)
+        num_ids = 0
+        for tag in self._tag_index.values() if tags is None else tags:
+            condition = self.get_condition(self._id_column, tag.object_id, object_type)
+            new_length = length + len(condition) + (1 if conditions else 0)
+            if num_ids and (num_ids >= self.lookup_chunk_size or new_length > self.max_query_length):
+                queries.append(prefix + self.where_clause(object_type, conditions) + suffix)
+                conditions = []
+                num_ids = 0
+                new_length = empty_length + len(condition)
+            conditions.append(condition)
+            length = new_length
+            num_ids += 1
+        if num_ids:
+            queries.append(prefix + self.where_clause(object_type, conditions) + suffix)
+        return queries
+
+    def set_routes(self, routes, unrouted=()):
+        """Send the tags straight to their known Engine
+
+        The full id scan is skipped: each Engine is matched with the tags
+        routed to it, and with the unrouted tags found on it by targeted
+        lookups. Must be called after prepare_for_engine_object_updates.
+
+        Args:
+            routes: dict of Engine -> set of normalized ids
+            unrouted: normalized ids without a route, looked up on every Engine
+
+        Return:
+            False if the unrouted ids cannot be looked up (the routes are not set)
+
+        """
+
+        unrouted_queries = None
+        if unrouted:
+            unrouted_queries = self.build_lookup_queries([self._tag_index[key] for key in unrouted])
+            if unrouted_queries is None:
+                return False
+        self._routes = {url: routes.get(engine, set()) for engine, url in zip(self.engine, self.urls)}
+        self._unrouted_queries = unrouted_queries
+        return True
+
+    def fetch_routed_index(self, url, result=None):
+        """Get the index of an Engine from its routed ids and the lookups of the unrouted ids
+
+        Return:
+            set of normalized ids (None if a lookup failed)
+
+        """
+
+        engine_index = set(self._routes[url])
+        if self._unrouted_queries:
+            with self.measure_phase(url, "fetch"):
+                for query in self._unrouted_queries:
+                    engine_index = self.fetch_engine_index(url, query, engine_index=engine_index, result=result)
+                    if engine_index is None:
+                        return None
+        return engine_index
+
+    def match_tags(self, engine_ids, expansions=None):
+        """Match the tags of the current file against the ids of an Engine
+
+        The literal ids are looked up in the ids of the Engine, the wildcard
+        patterns are expanded on them.
+
+        Args:
+            engine_ids: set of normalized id_column values returned by an Engine
+            expansions: dict filled with pattern -> normalized ids it matches (if any)
+
+        Return:
+            list of the tag rows whose Object ID exists in the Engine (or whose pattern matches ids of the Engine)
+
+        """
+
+        matched_tags = [tag for tag_id, tag in self._pattern_index.literals.items() if tag_id in engine_ids]
+        if self._pattern_index.patterns:
+            pattern_ids = self._pattern_index.expand(engine_ids)
+            matched_tags.extend(tag for key, tag in self._pattern_index.patterns if key in pattern_ids)
+            if expansions is not None:
+                expansions.update(pattern_ids)
+        return matched_tags
+
+    def get_category_value(self, obj, category_name):
+        """Get the current keyword of a category from an object returned by an Engine
+
+        Args:
+            obj: dictionary of an object returned by the id query
+            category_name: Name of the category
+
+        Return:
+            str: the keyword, or None if the object has no keyword in the category
+
+        """
+
+        for field in ('#"{}"'.format(category_name), '#' + category_name, category_name):
+            if field in obj:
+                return obj[field] or None
+        return None
+
+    def diff_tags(self, engine_objects, expansions=None):
+        """Compare the tags of the current file with the category values of an Engine
+
+        An object named by no literal id is compared with the wildcard
+        patterns matching it: a pattern is updated if any of its objects
+        does not have its keyword yet. A literal id takes precedence over the
+        patterns matching it: it is updated again after a pattern overwriting
+        its keyword.
+
+        Args:
+            engine_objects: dictionary of normalized id -> (id, current keyword) returned by an Engine
+            expansions: dict filled with pattern -> ids it matches (if any)
+
+        Return:
+            list of tag rows whose keyword must be added or changed
+            list of tag rows already having the right keyword
+            list of removal rows for the objects having a keyword but not in the tags
+
+        """
+
+        to_update = {}
+        unchanged = {}
+        to_remove = []
+        # Literal id -> patterns matching it (only if there are patterns)
+        covered = {}
+        literals = self._pattern_index.literals
+        for object_key, (object_id, keyword) in engine_objects.items():
+            tag = literals.get(object_key)
+            if tag is not None:
+                tags = [(object_key, tag)]
+                if self._pattern_index.patterns:
+                    covered[object_key] = self._pattern_index.match_patterns(object_key)
+            else:
+                tags = self._pattern_index.match_patterns(object_key)
+                if not tags:
+                    if keyword is not None:
+                        to_remove.append(TagRow(self._object_type, object_id, self._diff_category, None))
+                    continue
+                if expansions is not None:
+                    for key, tag in tags:
+                        expansions.setdefault(key, []).append(object_id)
+            for key, tag in tags:
+                if keyword is not None and keyword.casefold() == tag.keyword.casefold():
+                    unchanged[key] = tag
+                else:
+                    to_update[key] = tag
+        # The unchanged literal ids whose keyword is overwritten by an updated pattern are set again
+        for object_key, patterns in covered.items():
+            tag = unchanged.get(object_key)
+            if tag is not None and any(key in to_update and pattern_tag.keyword != tag.keyword
+                                       for key, pattern_tag in patterns):
+                to_update[object_key] = tag
+        return (list(to_update.values()), [tag for key, tag in unchanged.items() if key not in to_update],
+                to_remove)
+
+    def build_update_batches(self, matched_tags):
+        """Group the matched tags into batched update queries
+
+        Tags are grouped by (Category, Keyword, Object Type) and each group is
+        turned into update queries holding one where clause with one condition
+        per object. A new query is started when it would exceed batch_size
+        conditions or max_query_length characters.
+
+        Args:
+            matched_tags: list of tag rows found in an Engine
+
+        Return:
+            list of (update query, list of tag rows updated by the query)
+
+        """
+
+        groups = {}
+        for tag in matched_tags:
+            groups.setdefault((tag.category, tag.keyword, tag.object_type), []).append(tag)
+
+        batches = []
+        for (category, keyword, object_type), group_tags in groups.items():
+            start_query = self.start_update_query(keyword, category, object_type)
+            # Length of the query without its conditions: start, "(where <type> " ... ")" and "))"
+            empty_length = len(start_query) + len(self.where_clause(object_type, [])) + 2
+            conditions = []
+            batch_tags = []
+            length = empty_length
+            for tag in group_tags:
+                condition = self.get_condition(self._id_column, tag.object_id, object_type)
+                new_length = length + len(condition) + (1 if conditions else 0)
+                # Close the current batch if this condition does not fit in it
+                if batch_tags and (len(batch_tags) >= self.batch_size or new_length > self.max_query_length):
+                    batches.append((self.finish_update_query(
+                        base_query=start_query + self.where_clause(object_type, conditions)), batch_tags))
+                    conditions = []
+                    batch_tags = []
+                    new_length = empty_length + len(condition)
+                conditions.append(condition)
+                batch_tags.append(tag)
+                length = new_length
+            if batch_tags:
+                batches.append((self.finish_update_query(
+                    base_query=start_query + self.where_clause(object_type, conditions)), batch_tags))
+
+        return batches
+
+    def clear_engine_category(self, url, result=None):
+        """Clean the category of the current file on one Engine
+
+        Send the clean query to the Engine, then poll it until no object has a
+        value left in the category (or clear_timeout is reached).
+
+        Args:
+            url: url of the Engine
+            result: result dictionary of the Engine (for the retry counters)
+
+        Return:
+            True if the clean query was accepted by the Engine
+
+        """
+
+        clean_query = self.clean_category_query(self._clear_category, self._object_type)
+        with self.measure_phase(url, "clear"):
+            response = self.engine_get(url, {'query': clean_query}, result, phase="clear")
+        if response.status_code != 200:
+            self.logger.error('Unable to clean tags for Category "{}" on Engine: {} (response code {})'.format(
+                self._clear_category, url, response.status_code))
+            return False
+
+        # Wait for the Engine to apply the clean instead of sleeping a fixed time
+        check_query = self.cleared_check_query(self._clear_category, self._object_type)
+        deadline = time.monotonic() + self.clear_timeout
+        with self.measure_phase(url, "clear_wait"):
+            while True:
+                check_response = self.engine_get(url, {'query': check_query, 'format': 'json', 'hr': self.hr}, result,
+                                                 phase="clear_wait")
+                if check_response.status_code != 200:
+                    self.logger.warning('Unable to verify the clean of Category "{}" on Engine: {} (response code {})'.format(
+                        self._clear_category, url, check_response.status_code))
+                    break
+                if not check_response.json():
+                    self.logger.info('Tags successfully cleaned for Category "{}" on Engine: {}'.format(self._clear_category, url))
+                    break
+                if time.monotonic() >= deadline:
+                    self.logger.warning('Category "{}" still not clean after {}s on Engine: {} - continuing'.format(
+                        self._clear_category, self.clear_timeout, url))
+                    break
+                time.sleep(self.clear_poll_interval)
+
+        return True
+
+    def new_engine_result(self, url):
+        """Create the result dictionary of the processing of one Engine
+
+        Args:
+            an url
+
+        Return:
+            dict with the counters and the updated ids of the Engine
+
+        """
+
+        return {"url": url, "cleared": True, "available": True, "num_updates": 0, "num_failures": 0, "num_matches": 0,
+                "num_misses": 0, "num_unchanged": 0, "num_removed": 0, "num_retries": 0, "num_breaker_changes": 0,
+                "num_resumed": 0, "updated_ids": [], "failed_ids": [], "expanded_ids": []}
+
+    def needs_clear(self, url):
+        """Check if the category must be cleaned on an Engine (not done yet by the journaled run)"""
+
+        return bool(self._clear_category) and not (self.journal is not None and self.journal.is_cleared(url))
+
+    def resume_done_engine(self, url, result):
+        """Fill the result of an Engine that the journaled run completed
+
+        Return:
+            True if the Engine was completed (nothing left to do on it)
+
+        """
+
+        if self.journal is None or self._diff_category or not self.journal.is_done(url):
+            return False
+        self.add_resumed_tags(result, [self._tag_index[key] for key in self.journal.get_applied(url) if key in self._tag_index])
+        result["num_matches"] = result["num_resumed"]
+        result["num_misses"] = len(self._tag_index) - result["num_matches"]
+        self.logger.info('Engine "{}" was completed by the interrupted run - skipped'.format(url))
+        return True
+
+    def add_resumed_tags(self, result, tags):
+        """Account the tags applied on an Engine by the interrupted run"""
+
+        result["num_resumed"] += len(tags)
+        result["num_updates"] += len(tags)
+        result["updated_ids"].extend(tag.object_id for tag in tags)
+
+    def record_applied(self, url, batch_tags):
+        """Journal an update batch accepted by an Engine (if journaling)"""
+
+        if self.journal is not None:
+            self.journal.record_applied(url, [Nxql.normalize_id(tag.object_id) for tag in batch_tags])
+
+    def count_result(self, result, counter, value=1):
+        """Add to a counter of the result of an Engine (from any thread)"""
+
+        if result is not None:
+            with self._result_lock:
+                result[counter] += value
+
+    def check_breaker(self, url, result=None):
+        """Refuse a request to an Engine parked by the circuit breaker
+
+        Raise:
+            EngineUnavailableError if the breaker of the Engine is open
+
+        """
+
+        if self.breaker is not None and not self.breaker.allow_request(url):
+            raise EngineUnavailableError(url, 'circuit breaker open')
+
+    def retry_delay(self, url, result, attempt, status_code=None, error=None, retry_after=None):
+        """Account the outcome of an attempt of a request to an Engine
+
+        Args:
+            url: url of the Engine
+            result: result dictionary of the Engine (for the retry and breaker counters)
+            attempt: number of the attempt (0 for the first one)
+            status_code: status code of the response (None if no response)
+            error: the exception raised by the request (None if a response was received)
+            retry_after: value of the Retry-After header of the response (if any)
+
+        Return:
+            the time (in seconds) to wait before the next attempt, None if the response is final
+
+        Raise:
+            EngineUnavailableError if no response was received and the retries are exhausted
+
+        """
+
+        transient = error is not None or self.retry_policy.is_transient_status(status_code)
+        if self.breaker is not None:
+            # Only the requests still failing after their retries count against the Engine
+            # (or the probe request of a half open breaker)
+            state = None
+            if not transient:
+                state = self.breaker.record_success(url)
+            elif attempt >= self.retry_policy.max_retries or self.breaker.get_state(url) != CircuitBreaker.CLOSED:
+                state = self.breaker.record_failure(url)
+            if state is not None:
+                self.count_result(result, "num_breaker_changes")
+                self.logger.warning('Circuit breaker of Engine "{}" is now {}'.format(url, state))
+        if not transient:
+            return None
+        reason = repr(error) if error is not None else 'response code {}'.format(status_code)
+        if attempt >= self.retry_policy.max_retries:
+            if error is not None:
+                raise EngineUnavailableError(url, reason)
+            return None
+        self.count_result(result, "num_retries")
+        delay = self.retry_policy.get_delay(attempt, retry_after)
+        self.logger.warning('Request to Engine "{}" failed ({}) - retry {} of {} in {:.2f}s'.format(
+            url, reason, attempt + 1, self.retry_policy.max_retries, delay))
+        return delay
+
+    def record_latency(self, url, latency, exec_time=None, failed=False):
+        """Give the outcome of a request to the adaptive limiter (if any)
+
+        Args:
+            url: url of the Engine
+            latency: round-trip time of the request (in seconds)
+            exec_time: value of the NX_EXEC_TIME header of the response (if any)
+            failed: the request failed with a transient error
+
+        """
+
+        if self.limiter is None:
+            return
+        try:
+            exec_time = float(exec_time)
+        except (TypeError, ValueError):
+            exec_time = None
+        self.limiter.record(url, latency, exec_time, failed)
+
+    def measure_phase(self, url, phase):
+        """Measure the wall time of a phase on an Engine in the metrics (with statement, if any metrics)"""
+
+        if self.metrics is None:
+            return contextlib.nullcontext()
+        return self.metrics.phase(url, phase)
+
+    def record_request(self, url, phase, latency, status_code, bytes_sent=0, bytes_received=0, exec_time=None):
+        """Record an attempt of a request to an Engine in the metrics (if any)
+
+        Args:
+            url: url of the Engine
+            phase: phase of the request (None to not record it)
+            latency: round-trip time of the request (in seconds)
+            status_code: status code of the response (None if no response)
+            bytes_sent: length of the request url
+            bytes_received: length of the response body
+            exec_time: value of the NX_EXEC_TIME header of the response (if any)
+
+        """
+
+        if self.metrics is not None and phase is not None:
+            self.metrics.record_request(url, phase, latency, status_code, bytes_sent, bytes_received, exec_time)
+
+    def engine_get(self, url, params, result=None, stream=False, sample_latency=False, phase=None):
+        """Send a get request to an Engine with the retry policy and the circuit breaker
+
+        Args:
+            url: url of the Engine
+            params: parameters of the request (query, format, hr)
+            result: result dictionary of the Engine (for the retry and breaker counters)
+            stream: do not download the response body straight away
+            sample_latency: give the latency of the request to the adaptive limiter
+            phase: phase of the request in the metrics (see RunMetrics.PHASES)
+
+        Return:
+            the http response (the last one if the retries are exhausted)
+
+        Raise:
+            EngineUnavailableError if the Engine cannot be reached or is parked by the circuit breaker
+
+        """
+
+        session = self._websession.get_session(url)
+        attempt = 0
+        while True:
+            self.check_breaker(url, result)
+            response = None
+            error = None
+            start = time.monotonic()
+            try:
+                response = session.get(url, params=params, stream=stream, verify=False,
+                                       timeout=(self.connect_timeout, self.read_timeout))
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+                error = err
+            latency = time.monotonic() - start
+            exec_time = response.headers.get('NX_EXEC_TIME') if response is not None else None
+            if sample_latency:
+                # The limiter is given the time spent by the Engine, not the time queued in this process
+                service_time = getattr(response, 'service_time', None)
+                self.record_latency(url, latency if service_time is None else service_time, exec_time,
+                                    error is not None or self.retry_policy.is_transient_status(response.status_code))
+            if response is None:
+                self.record_request(url, phase, latency, None)
+            else:
+                # The body of a streamed response is counted by its reader
+                self.record_request(url, phase, latency, response.status_code, len(response.request.url),
+                                    0 if stream else len(response.content), exec_time)
+            delay = self.retry_delay(url, result, attempt,
+                                     response.status_code if response is not None else None, error,
+                                     response.headers.get('Retry-After') if response is not None else None)
+            if delay is None:
+                return response
+            if response is not None:
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def new_object_parser(self):
+        """Create an incremental parser for an id query response
+
+        Only the id_column (and the category in differential mode) is kept
+        from the objects returned by the Engine.
+
+        Return:
+            a JsonArrayParser or CsvRowParser depending on id_format
+
+        """
+
+        fields = [self._id_column]
+        if self._diff_category:
+            fields += ['#"{}"'.format(self._diff_category), '#' + self._diff_category, self._diff_category]
+        if self.id_format == 'csv':
+            return CsvRowParser(fields)
+        return JsonArrayParser(fields)
+
+    def iter_engine_objects(self, response, stats=None):
+        """Iterate over the objects of an id query response
+
+        Args:
+            response: the response of the id query (requested with stream=stream_ids)
+            stats: dictionary in which the number of bytes read is added (if any)
+
+        Return:
+            an iterator of dictionaries
+
+        """
+
+        if self.id_format == 'json' and not self.stream_ids:
+            if stats is not None:
+                stats["bytes"] += len(response.content)
+            yield from response.json()
+            return
+        parser = self.new_object_parser()
+        for chunk in response.iter_content(chunk_size=self.stream_chunk_size):
+            if stats is not None:
+                stats["bytes"] += len(chunk)
+            yield from parser.feed(chunk)
+        yield from parser.close()
+
+    def index_engine_objects(self, objects, engine_index=None):
+        """Build the hash index of the objects returned by the id query of an Engine
+
+        Args:
+            objects: iterable of dictionaries returned by the id query
+            engine_index: index to add the objects to (a new one is created if None)
+
+        Return:
+            dict of normalized id -> (id, current keyword) in differential mode,
+            set of normalized ids otherwise
+
+        """
+
+        if self._diff_category:
+            if engine_index is None:
+                engine_index = {}
+            for obj in objects:
+                engine_index[Nxql.normalize_id(obj[self._id_column])] = (
+                    obj[self._id_column], self.get_category_value(obj, self._diff_category))
+        else:
+            if engine_index is None:
+                engine_index = set()
+            engine_index.update(Nxql.normalize_id(obj[self._id_column]) for obj in objects)
+        return engine_index
+
+    def plan_engine_updates(self, engine_index, result):
+        """Match the tags with the index of an Engine and build the update queries
+
+        The match, miss and unchanged counters of the result are filled here.
+
+        Args:
+            engine_index: index built by index_engine_objects
+            result: result dictionary of the Engine
+
+        Return:
+            list of the rounds of updates, each a list of (update query, list of tag rows updated by the query):
+            a round is sent once the previous one is done (the wildcard patterns first, so that the literal
+            ids they match keep their own keyword)
+
+        """
+
+        # For each tag row, see if the id column exists in this engine (or which ids its pattern matches)
+        expansions = {}
+        if self._diff_category:
+            matched_tags, unchanged_tags, removed_tags = self.diff_tags(engine_index, expansions)
+            result["num_matches"] = len(matched_tags) + len(unchanged_tags)
+            result["num_unchanged"] = len(unchanged_tags)
+            result["updated_ids"].extend(tag.object_id for tag in unchanged_tags)
+        else:
+            matched_tags = self.match_tags(engine_index, expansions)
+            removed_tags = []
+            result["num_matches"] = len(matched_tags)
+            # Do not send again the tags applied by the interrupted run
+            applied = self.journal.get_applied(result["url"]) if self.journal is not None else None
+            if applied:
+                self.add_resumed_tags(result, [tag for tag in matched_tags if Nxql.normalize_id(tag.object_id) in applied])
+                matched_tags = [tag for tag in matched_tags if Nxql.normalize_id(tag.object_id) not in applied]
+        result["num_misses"] = len(self._tag_index) - result["num_matches"]
+        # (pattern as written in the tag file, ids of the Engine it matches)
+        result["expanded_ids"] = [(self._tag_index[key].object_id, sorted(object_ids))
+                                  for key, object_ids in expansions.items()]
+
+        pattern_keys = {key for key, tag in self._pattern_index.patterns}
+        pattern_tags = [tag for tag in matched_tags if Nxql.normalize_id(tag.object_id) in pattern_keys]
+        literal_tags = [tag for tag in matched_tags if Nxql.normalize_id(tag.object_id) not in pattern_keys]
+        rounds = [self.build_update_batches(pattern_tags), self.build_update_batches(literal_tags + removed_tags)]
+        return [batches for batches in rounds if batches]
+
+    def record_update(self, result, upd_query, batch_tags, status_code):
+        """Account the outcome of an update query in the result of an Engine
+
+        Args:
+            result: result dictionary of the Engine
+            upd_query: the update query that was sent
+            batch_tags: list of tag rows updated by the query
+            status_code: http status code of the update response
+
+        """
+
+        url = result["url"]
+        if status_code != 200:
+            self.logger.error('process_engine_object({}): Unexpected response ({}) from update query: {}'.format(
+                url, status_code, upd_query))
+            result["num_failures"] += len(batch_tags)
+            result["failed_ids"].extend(tag.object_id for tag in batch_tags)
+        elif batch_tags[0].keyword is None:
+            self.trace('Successfully removed the keyword of %d objects in Engine "%s"', len(batch_tags), url)
+            result["num_removed"] += len(batch_tags)
+        else:
+            self.trace('Successfully updated %d objects in Engine "%s"', len(batch_tags), url)
+            result["num_updates"] += len(batch_tags)
+            result["updated_ids"].extend(tag.object_id for tag in batch_tags)
+
+    def send_update(self, url, upd_query, result=None):
+        """Send an update query to an Engine
+
+        Args:
+            url: url of the Engine
+            upd_query: the update query
+            result: result dictionary of the Engine (for the retry counters)
+
+        Return:
+            the http status code of the response (None if the Engine is unavailable)
+
+        """
+
+        try:
+            update_response = self.engine_get(url, {'query': upd_query}, result, sample_latency=True, phase="update")
+        except EngineUnavailableError as err:
+            self.logger.error('process_engine_object({}): {}'.format(url, err))
+            return None
+        return update_response.status_code
+
+    def fetch_engine_index(self, url, query=None, stats=None, engine_index=None, result=None):
+        """Run the id query on an Engine and build its hash index
+
+        Args:
+            url: url of the Engine
+            query: the id query to run (default: the full scan id query)
+            stats: dictionary in which the number of bytes read is added (if any)
+            engine_index: index to add the objects to (a new one is created if None)
+            result: result dictionary of the Engine (for the retry counters)
+
+        Return:
+            the index built by index_engine_objects (None if the query failed)
+
+        """
+
+        self.logger.debug('Requesting list of objects from Engine with URL "%s".', url)
+        response = self.engine_get(url, {'query': query or self._id_query, 'format': self.id_format, 'hr': self.hr},
+                                   result, stream=self.stream_ids, phase="fetch")
+        # A streamed response holds its pooled connection until it is closed, whatever its status
+        with response:
+            # Continue by iterating through the response text if we have results
+            if response.status_code == 200 and response:
+                hostname = urlparse(response.url).hostname
+                # Build a hash index of the normalized id_column values of this engine
+                read = {"bytes": 0}
+                engine_index = self.index_engine_objects(self.iter_engine_objects(response, read), engine_index)
+                if stats is not None:
+                    stats["bytes"] += read["bytes"]
+                if self.stream_ids and self.metrics is not None:
+                    self.metrics.add_bytes_received(url, "fetch", read["bytes"])
+                self.logger.debug('Engine "%s" returned %d ids', hostname, len(engine_index))
+                return engine_index
+
+            elif response.status_code != 200:
+                self.logger.error('process_engine_object({}): Unexpected response from id query: {}'.format(url, response.status_code))
+            else:
+                self.logger.error('process_engine_object({}): No results returned from id query.'.format(url))
+        return None
+
+    def fetch_planned_engine_index(self, url, result=None):
+        """Get the index of an Engine with the plan chosen by the planner
+
+        Args:
+            url: url of the Engine
+            result: result dictionary of the Engine (for the retry counters)
+
+        Return:
+            the index built by index_engine_objects (None if a query failed)
+
+        """
+
+        engine = urlparse(url).netloc
+        num_lookups = len(self._lookup_queries) if self._lookup_queries is not None else None
+        plan, estimate = self.planner.plan(engine, self._id_query, len(self._tag_index), num_lookups)
+        queries = self._lookup_queries if plan == "targeted" else [self._id_query]
+
+        stats = {"bytes": 0}
+        start = time.monotonic()
+        engine_index = None
+        for query in queries:
+            engine_index = self.fetch_engine_index(url, query, stats, engine_index, result)
+            if engine_index is None:
+                return None
+        self.planner.record(engine, self._id_query, plan, estimate, stats["bytes"], time.monotonic() - start,
+                            len(engine_index), len(queries))
+        if plan == "full" and self.snapshot_cache is not None:
+            self.snapshot_cache.put(url, self._id_query, self._id_column, engine_index)
+        return engine_index
+
+    def update_engine_objects(self, url, engine_index, result):
+        """Match the tags with the index of an Engine and send the update queries
+
+        Args:
+            url: url of the Engine
+            engine_index: index built by index_engine_objects
+            result: result dictionary of the Engine
+
+        """
+
+        with self.measure_phase(url, "match"):
+            rounds = self.plan_engine_updates(engine_index, result)
+        # Found matches, so update them (on the shared update workers if running)
+        self.logger.debug('Found %d update batches for Engine "%s".  About to update.', sum(len(batches) for batches in rounds), url)
+
+        def send_batch(batch):
+            upd_query, batch_tags = batch
+            status_code = self.send_update(url, upd_query, result)
+            if status_code == 200:
+                self.record_applied(url, batch_tags)
+            return status_code
+
+        with self.measure_phase(url, "update"):
+            for batches in rounds:
+                if self._run_scheduler:
+                    status_codes = self._run_scheduler.run(url, send_batch, batches)
+                else:
+                    status_codes = [send_batch(batch) for batch in batches]
+                # Process the results
+                for (upd_query, batch_tags), status_code in zip(batches, status_codes):
+                    self.record_update(result, upd_query, batch_tags, status_code)
+
+        self.logger.debug('Engine "%s" matched %d ids, missed %d ids, skipped %d unchanged ids',
+                          url, result["num_matches"], result["num_misses"], result["num_unchanged"])
+
     def process_engine_object(self, url):
         """Get the related engine objects
         Uses the request library to Another version of fetch_url() that uses the Requests library
 
-        Function that runs a get request adding:
+        Function that runs, on its own schedule for each Engine:
+        - the clean of the category (if requested) and the wait for it to be applied
+        - the id query and the match with the tags
+        - the update queries
+        Each get request is sent adding:
         - the query
         - specifing the format
         - authentication
@@ -497,60 +1382,57 @@ class Nxql(object):
             an http response object
 
         """
-        num_updates = 0
-        num_failures = 0
-        updated_ids = []
+        result = self.new_engine_result(url)
         try:
-            # First get the list of object identifiers from the current Engine
-            template = 'Requesting list of objects from Engine with URL "{}".'
-            message = template.format(url)
-            self.logger.debug(message)
-            get_session = self._websession.create_session()
-            response = get_session.get(url, params={'query': self._id_query, 'format': 'json', 'hr': self.hr},
-                                stream=False, verify=False)
-            response.raise_for_status()
-            # Continue by iterating through the response text if we have results
-            if response.status_code == 200 and response:
-                hostname = urlparse(response.url).hostname
-                json_results = response.json()
-                # Construct list of id_column values from list of objects in this engine
-                id_list = [obj[self._id_column].upper() for obj in json_results]
-                template = 'Engine "{}" returned {} ids' # .\n{}'
-                message = template.format(hostname, len(id_list)) #, id_list)
-                self.logger.debug(message)
-
-                # For each tag row, see if the id column exists in this engine
-                for tag in self._tags:
-                    if tag["Object ID"].upper() in id_list:
-                        # Found a match, so updated it.
-                        self.logger.debug('Found "{}" in Engine "{}".  About to update.'.format(tag["Object ID"], hostname))
-                        upd_query = self.start_update_query(tag["Keyword"], tag["Category"], tag["Object Type"])
-                        upd_query = self.add_condition(self._id_column, tag["Object ID"], tag["Object Type"], base_query=upd_query)
-                        upd_query = self.finish_update_query(base_query=upd_query)
-                        # Attempt the update
-                        update_session = self._websession.create_session()
-                        update_response = update_session.get(url, params={'query': upd_query},
-                                            stream=False, verify=False)
-                        # Process the result
-                        if update_response.status_code != 200:
-                            self.logger.error('process_engine_object({}): Unexpected response ({}) from update query: {}'.format(
-                                url, update_response.status_code, upd_query))
-                            num_failures += 1
+            # Nothing left to do on the Engines completed by the interrupted run
+            if self.resume_done_engine(url, result):
+                return result
+
+            # Clean the category on this Engine first (end if not successful)
+            if self.needs_clear(url):
+                if not self.clear_engine_category(url, result):
+                    result["cleared"] = False
+                    return result
+                if self.journal is not None:
+                    self.journal.record_cleared(url)
+
+            # Then get the list of object identifiers from the current Engine (unless routed or cached)
+            engine_index = None
+            if url in self._routes:
+                engine_index = self.fetch_routed_index(url, result)
+                if engine_index is not None:
+                    self.logger.debug('Engine "%s" has %d routed ids', url, len(engine_index))
+            elif self.snapshot_cache is not None:
+                engine_index = self.snapshot_cache.get(url, self._id_query, self._id_column)
+                if engine_index is not None:
+                    self.logger.debug('Engine "%s" has %d cached ids', url, len(engine_index))
+            if engine_index is None and url not in self._routes:
+                try:
+                    with self.measure_phase(url, "fetch"):
+                        if self.planner:
+                            engine_index = self.fetch_planned_engine_index(url, result)
                         else:
-                            self.logger.debug('Successfully updated "{}" in Engine "{}"'.format(tag["Object ID"], hostname))
-                            num_updates += 1
-                            updated_ids.append(tag["Object ID"])
-
-            elif response.status_code != 200:
-                self.logger.error('process_engine_object({}): Unexpected response from id query: {}'.format(url, response.status_code))
+                            engine_index = self.fetch_engine_index(url, result=result)
+                            if engine_index is not None and self.snapshot_cache is not None:
+                                self.snapshot_cache.put(url, self._id_query, self._id_column, engine_index)
+                finally:
+                    # Let the other files waiting for this index download it if it was not stored
+                    if self.snapshot_cache is not None:
+                        self.snapshot_cache.release(url, self._id_query, self._id_column)
+            if engine_index is None:
+                result["available"] = False
             else:
-                self.logger.error('process_engine_object({}): No results returned from id query.'.format(url))
-
-        except requests.exceptions.ConnectionError as err:
-            self.logger.error('process_engine_object({}): A ConnectionError exception occurred: {!r}'.format(url, err))
-            raise SystemExit(err)
+                self.update_engine_objects(url, engine_index, result)
+                if self.journal is not None and result["num_failures"] == 0:
+                    self.journal.record_done(url)
+
+        except (EngineUnavailableError, requests.exceptions.RequestException) as err:
+            # The other Engines carry on, the file is reported as failed
+            self.logger.error('process_engine_object({}): {!r}'.format(url, err))
+            result["available"] = False
+            return result
         else:
-            return {"url": url, "num_updates": num_updates, "num_failures": num_failures, "updated_ids": updated_ids}
+            return result
 
     def process_engine_objects(self):
         """Function to run requests in parallel
@@ -562,20 +1444,37 @@ class Nxql(object):
             list of (hostname, response text, response code)
 
         """
+        if self.transport == 'asyncio':
+            # Imported here so that aiohttp is only needed by the asyncio transport
+            from classes.asyncnxql import AsyncNxql
+            return AsyncNxql(self).process_engine_objects()
+
         result_list = []
-        # We can use a with statement to ensure threads are cleaned up promptly
-        with concurrent.futures.ThreadPoolExecutor(max_workers=40) as executor:
-            # Start the load operations and mark each future with its URL
-            future_to_url = {executor.submit(self.process_engine_object, url): url for url in self.urls}
-            for future in concurrent.futures.as_completed(future_to_url):
-                url = future_to_url[future]
-                try:
-                    response = future.result()
-                except Exception as exc:
-                    self.logger.error('{} generated an exception: {}'.format(url, exc))
-                else:
-                    self.logger.debug('{} returned {}'.format(url, response))
-                    result_list.append(response)
+        # The updates of all Engines are spread over the workers of the run
+        # (or over workers started for this call if the run has none)
+        scheduler = self.scheduler
+        if scheduler is None:
+            scheduler = UpdateScheduler(self.update_workers, self.max_engine_requests, self.logger, self.limiter)
+            scheduler.start()
+        self._run_scheduler = scheduler
+        try:
+            # We can use a with statement to ensure threads are cleaned up promptly
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                # Start the load operations and mark each future with its URL
+                future_to_url = {executor.submit(self.process_engine_object, url): url for url in self.urls}
+                for future in concurrent.futures.as_completed(future_to_url):
+                    url = future_to_url[future]
+                    try:
+                        response = future.result()
+                    except Exception as exc:
+                        self.logger.error('{} generated an exception: {}'.format(url, exc))
+                    else:
+                        self.logger.debug('%s returned %s', url, response)
+                        result_list.append(response)
+        finally:
+            self._run_scheduler = None
+            if scheduler is not self.scheduler:
+                scheduler.stop()
 
         return result_list
 
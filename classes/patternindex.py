@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# Copyright (C) 2017 Nexthink SA, Switzerland
+
+# Library import
+import re
+
+
+class PatternIndex(object):
+    """Summary of class PatternIndex.
+
+    Match index of the tags of a file: the literal ids in a hash, the
+    wildcard ids (* and ?) compiled per literal prefix.
+
+    Object Attributes:
+        literals: dict of normalized id -> TagRow of the ids without wildcards
+        patterns: list of (normalized pattern, TagRow) of the ids with wildcards
+
+    """
+
+    WILDCARDS = re.compile(r'[*?]')
+
+    def __init__(self, tag_index, wildcards=True):
+        """Split the tags of a file into literal ids and patterns
+
+        Args:
+            tag_index: dict of normalized id -> TagRow
+            wildcards: the ids can hold wildcards (only the name conditions are patterns)
+
+        """
+
+        self.literals = {}
+        self.patterns = []
+        for key, tag in tag_index.items():
+            if wildcards and self.WILDCARDS.search(key):
+                self.patterns.append((key, tag))
+            else:
+                self.literals[key] = tag
+        groups = {}
+        for number, (key, tag) in enumerate(self.patterns):
+            prefix = self.WILDCARDS.split(key, 1)[0]
+            groups.setdefault(prefix, []).append(number)
+        # Prefix length -> prefix -> (matcher of the group, pattern numbers, regular expression of each pattern)
+        self._groups = {}
+        for prefix, numbers in groups.items():
+            expressions = [self.pattern_to_regex(self.patterns[number][0]) for number in numbers]
+            # One group per pattern (and no other group): lastindex tells the first pattern matching an id
+            matcher = re.compile('|'.join('({})'.format(expression) for expression in expressions), re.DOTALL)
+            regexes = [re.compile(expression, re.DOTALL) for expression in expressions] if len(numbers) > 1 else None
+            self._groups.setdefault(len(prefix), {})[prefix] = (matcher, numbers, regexes)
+        self._prefix_lengths = sorted(self._groups)
+
+    @staticmethod
+    def pattern_to_regex(pattern):
+        """Translate an NXQL pattern to a regular expression (without groups)"""
+
+        return ''.join('.*' if part == '*' else '.' if part == '?' else re.escape(part)
+                       for part in re.split(r'([*?])', pattern) if part)
+
+    def match_patterns(self, object_key):
+        """Get the patterns matching the normalized id of an object
+
+        Return:
+            list of (normalized pattern, TagRow), empty if no pattern matches
+
+        """
+
+        matches = []
+        for length in self._prefix_lengths:
+            if length > len(object_key):
+                break
+            group = self._groups[length].get(object_key[:length])
+            if group is None:
+                continue
+            matcher, numbers, regexes = group
+            match = matcher.fullmatch(object_key)
+            if match is None:
+                continue
+            # The alternation stops at the first pattern: check the next ones on their own
+            first = match.lastindex - 1
+            matches.append(self.patterns[numbers[first]])
+            if regexes is not None:
+                matches.extend(self.patterns[numbers[position]] for position in range(first + 1, len(numbers))
+                               if regexes[position].fullmatch(object_key))
+        return matches
+
+    def expand(self, object_keys):
+        """Expand the patterns on the ids of an Engine (in one pass over the ids)
+
+        Args:
+            object_keys: iterable of the normalized ids of the Engine
+
+        Return:
+            dict of normalized pattern -> list of the normalized ids it matches (only the patterns matching ids)
+
+        """
+
+        expansions = {}
+        if not self.patterns:
+            return expansions
+        for object_key in object_keys:
+            for key, tag in self.match_patterns(object_key):
+                expansions.setdefault(key, []).append(object_key)
+        return expansions
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# Copyright (C) 2017 Nexthink SA, Switzerland
+
+# Library import
+import json
+import os
+import threading
+
+
+class QueryPlanner(object):
+    """Summary of class QueryPlanner.
+
+    Cost based choice, per Engine, between the full id scan and targeted
+    lookups, from the statistics of the previous runs.
+
+    Object Attributes:
+        stats_path: path of the JSON statistics file
+        logger: this is to log INFO/WARNING/ERROR/DEBUG messages
+
+    """
+
+    # Latency (in seconds) assumed for a targeted lookup until one was measured
+    DEFAULT_LOOKUP_LATENCY = 0.25
+    # Weight of the last measure in the average latency of a targeted lookup
+    LOOKUP_LATENCY_WEIGHT = 0.3
+
+    def __init__(self, stats_path, logger):
+        self.stats_path = stats_path
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._stats = {}
+        if os.path.exists(stats_path):
+            try:
+                with open(stats_path, 'r') as file:
+                    self._stats = json.load(file)
+            except ValueError as ex:
+                self.logger.warning('Ignoring invalid Engine statistics file {}: {!r}'.format(stats_path, ex))
+
+    def _key(self, engine, id_query):
+        return "{} {}".format(engine, id_query)
+
+    def plan(self, engine, id_query, num_tags, num_lookups):
+        """Choose how to get the ids of an Engine
+
+        Args:
+            engine: the Engine (host)
+            id_query: the full scan id query
+            num_tags: number of tags of the file
+            num_lookups: number of targeted lookup queries (None if the id query cannot be targeted)
+
+        Return:
+            'full' or 'targeted'
+            dict with the estimated bytes and latency of the chosen plan (None if unknown)
+
+        """
+
+        with self._lock:
+            stats = dict(self._stats.get(self._key(engine, id_query), {}))
+
+        # Without a previous full scan the cost of the full scan is unknown
+        if num_lookups is None or "latency" not in stats:
+            return "full", None
+
+        full = {"bytes": stats["bytes"], "latency": stats["latency"]}
+        bytes_per_object = stats["bytes"] / max(stats["objects"], 1)
+        targeted = {"bytes": int(min(num_tags, stats["objects"]) * bytes_per_object),
+                    "latency": num_lookups * stats.get("lookup_latency", self.DEFAULT_LOOKUP_LATENCY)}
+        if targeted["latency"] < full["latency"]:
+            return "targeted", targeted
+        return "full", full
+
+    def record(self, engine, id_query, plan, estimate, num_bytes, latency, num_objects, num_lookups):
+        """Record the actual cost of a plan and log it against the estimate
+
+        Args:
+            engine: the Engine (host)
+            id_query: the full scan id query
+            plan: 'full' or 'targeted'
+            estimate: the estimate returned by plan()
+            num_bytes: number of bytes downloaded
+            latency: time (in seconds) spent getting the ids
+            num_objects: number of objects returned
+            num_lookups: number of queries sent
+
+        """
+
+        if estimate:
+            self.logger.info('Plan for Engine "{}": {} ({} queries) - estimated {} bytes in {:.2f}s, actual {} bytes in {:.2f}s'.format(
+                engine, plan, num_lookups, estimate["bytes"], estimate["latency"], num_bytes, latency))
+        else:
+            self.logger.info('Plan for Engine "{}": {} ({} queries) - no estimate, actual {} bytes in {:.2f}s'.format(
+                engine, plan, num_lookups, num_bytes, latency))
+
+        with self._lock:
+            stats = self._stats.setdefault(self._key(engine, id_query), {})
+            if plan == "full":
+                stats.update({"bytes": num_bytes, "latency": latency, "objects": num_objects})
+            else:
+                lookup_latency = latency / max(num_lookups, 1)
+                previous = stats.get("lookup_latency", lookup_latency)
+                stats["lookup_latency"] = (1 - self.LOOKUP_LATENCY_WEIGHT) * previous + self.LOOKUP_LATENCY_WEIGHT * lookup_latency
+
+    def save(self):
+        """Write the statistics file (atomically)"""
+
+        # Files processed at the same time may save at the same time
+        with self._lock:
+            data = json.dumps(self._stats, indent=1, sort_keys=True)
+            temp_path = self.stats_path + ".tmp"
+            with open(temp_path, 'w') as file:
+                file.write(data)
+            os.replace(temp_path, self.stats_path)
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+# Copyright (C) 2017 Nexthink SA, Switzerland
+
+# Library import
+import cProfile
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+
+
+class RunProfiler(object):
+    """Summary of class RunProfiler.
+
+    Profiles a run on the main thread and its workers, with cProfile
+    (<path>.pstats) and/or stack sampling (<path>.folded).
+
+    Object Attributes:
+        path: path of the profile files, without their extension
+        logger: this is to log INFO/WARNING/ERROR/DEBUG messages
+        cprofile: profile the threads with cProfile
+        sample: sample the stacks of the threads
+        interval: time (in seconds) between two samples of the stacks
+
+    """
+
+    # Builtins of cProfile whose time is spent waiting (network, locks, sleeps)
+    WAIT_FUNCTIONS = re.compile(r"_queue\.|_socket\.|_ssl\.|select\.|time\.sleep|'_thread\.|getaddrinfo")
+    # Numbers of the names of the worker threads, removed to merge their stacks
+    THREAD_NUMBER = re.compile(r"[-_]\d+")
+
+    def __init__(self, path, logger, cprofile=True, sample=False, interval=0.01):
+        self.path = path
+        self.logger = logger
+        self.cprofile = cprofile
+        self.sample = sample
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._main_profile = None
+        self._thread_profiles = []
+        self._sampler = None
+        self._stop = threading.Event()
+        self._stacks = {}
+        self._states = {"running": 0, "waiting": 0, "unknown": 0}
+        self._cpu_times = {}
+        self._wall_time = 0.0
+        self._cpu_time = 0.0
+
+    def _profile_thread(self, frame, event, arg):
+        """Start the profile of a new thread (called once, then replaced by the profile of the thread)"""
+
+        profile = cProfile.Profile()
+        with self._lock:
+            self._thread_profiles.append(profile)
+        profile.enable()
+
+    def start(self):
+        """Start profiling"""
+
+        self._wall_time = time.monotonic()
+        self._cpu_time = time.process_time()
+        if self.sample:
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self._sample_stacks, name="profile-sampler", daemon=True)
+            self._sampler.start()
+        if self.cprofile:
+            threading.setprofile(self._profile_thread)
+            self._main_profile = cProfile.Profile()
+            self._main_profile.enable()
+        self.logger.info('Profiling the run to {}'.format(self.path))
+
+    def stop(self):
+        """Stop profiling (the threads still running are profiled until they end)"""
+
+        if self.cprofile:
+            self._main_profile.disable()
+            threading.setprofile(None)
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+        self._wall_time = time.monotonic() - self._wall_time
+        self._cpu_time = time.process_time() - self._cpu_time
+
+    def _get_thread_state(self, ident, elapsed):
+        """Tell if a thread was running or waiting since the previous sample, from its CPU time"""
+
+        try:
+            cpu_time = time.clock_gettime(time.pthread_getcpuclockid(ident))
+        except (AttributeError, OSError):
+            # No per thread CPU clock on this platform (or the thread just ended)
+            return "unknown"
+        previous = self._cpu_times.get(ident)
+        self._cpu_times[ident] = cpu_time
+        if previous is None or elapsed <= 0:
+            return "unknown"
+        return "running" if cpu_time - previous >= elapsed / 2 else "waiting"
+
+    def _sample_stacks(self):
+        """Count the stacks of the threads every interval seconds (sampler thread)"""
+
+        own_ident = threading.get_ident()
+        last_sample = time.monotonic()
+        while not self._stop.wait(self.interval):
+            now = time.monotonic()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                state = self._get_thread_state(ident, now - last_sample)
+                stack = []
+                while frame is not None:
+                    stack.append('{}:{}'.format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                    frame = frame.f_back
+                stack.append(state)
+                stack.append(self.THREAD_NUMBER.sub('', names.get(ident, 'thread')).replace(';', ' '))
+                key = ';'.join(reversed(stack))
+                self._stacks[key] = self._stacks.get(key, 0) + 1
+                self._states[state] += 1
+            last_sample = now
+
+    def write(self):
+        """Write the profile files and log the time spent running and waiting"""
+
+        self.logger.info('Profile: {:.2f}s wall time, {:.2f}s CPU time (all threads)'.format(self._wall_time, self._cpu_time))
+        if self.cprofile:
+            stats = pstats.Stats(self._main_profile)
+            with self._lock:
+                for profile in self._thread_profiles:
+                    stats.add(profile)
+            stats.dump_stats(self.path + '.pstats')
+            total = sum(values[2] for values in stats.stats.values())
+            waiting = sum(values[2] for function, values in stats.stats.items()
+                          if function[0] == '~' and self.WAIT_FUNCTIONS.search(function[2]))
+            self.logger.info('cProfile of {} threads: {:.2f}s running Python code, {:.2f}s waiting (network, locks, sleeps) - written to {}'.format(
+                len(self._thread_profiles) + 1, total - waiting, waiting, self.path + '.pstats'))
+            top = sorted(((values[2], function) for function, values in stats.stats.items()
+                          if not (function[0] == '~' and self.WAIT_FUNCTIONS.search(function[2]))), reverse=True)[:10]
+            for tottime, function in top:
+                self.logger.info('\t{:.3f}s in {}'.format(tottime, pstats.func_std_string(function)))
+        if self.sample:
+            with open(self.path + '.folded', 'w') as file:
+                for stack, count in sorted(self._stacks.items()):
+                    file.write('{} {}\n'.format(stack, count))
+            num_samples = sum(self._states.values())
+            self.logger.info('Sampled {} thread stacks every {}s: {} running, {} waiting, {} unknown - written to {}'.format(
+                num_samples, self.interval, self._states["running"], self._states["waiting"], self._states["unknown"],
+                self.path + '.folded'))
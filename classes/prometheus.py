@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# Copyright (C) 2017 Nexthink SA, Switzerland
+
+# Library import
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class PrometheusTextfile(object):
+    """Summary of class PrometheusTextfile.
+
+    Writes the metrics of the last run in the Prometheus text format, for
+    the textfile collector of the node exporter.
+
+    Object Attributes:
+        path: path of the .prom file (in the directory of the textfile collector)
+        logger: this is to log INFO/WARNING/ERROR/DEBUG messages
+
+    """
+
+    PREFIX = "nexthink_tagger_"
+
+    # Latency percentiles of the report -> quantile label
+    QUANTILES = (("p50", "0.5"), ("p95", "0.95"), ("p99", "0.99"))
+
+    # Result counters exported per Engine (name in the result -> metric, help)
+    RESULT_METRICS = (
+        ("num_updates", "updates", "Objects successfully tagged on the Engine by the last run"),
+        ("num_failures", "failures", "Objects that could not be tagged on the Engine by the last run"),
+        ("num_misses", "misses", "Tags whose object was not found on the Engine by the last run"),
+        ("num_unchanged", "unchanged", "Objects already tagged with their keyword on the Engine (differential mode)"),
+        ("num_removed", "removed", "Objects whose keyword was removed on the Engine (differential mode)"),
+        ("num_retries", "retries", "Requests to the Engine retried by the last run"),
+    )
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def escape_label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def _add_metric(self, lines, name, help_text, samples):
+        """Add a gauge and its samples ((labels dict, value) pairs) to the lines of the file"""
+
+        name = self.PREFIX + name
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} gauge'.format(name))
+        for labels, value in samples:
+            label_text = ','.join('{}="{}"'.format(key, self.escape_label(label)) for key, label in sorted(labels.items()))
+            lines.append('{}{} {}'.format(name, '{' + label_text + '}' if label_text else '', repr(float(value))))
+
+    def format_report(self, report):
+        """Format a run report of RunMetrics in the Prometheus text format
+
+        Return:
+            the text of the file
+        """
+
+        counters = report.get("counters", {})
+        engines = {urlparse(url).netloc or url: engine for url, engine in report["engines"].items()}
+        results = {engine: values["result"] for engine, values in engines.items()}
+        total_updates = sum(result.get("num_updates", 0) for result in results.values())
+
+        lines = []
+        self._add_metric(lines, "last_run_timestamp_seconds", "Time the last run completed", [({}, time.time())])
+        self._add_metric(lines, "run_duration_seconds", "Wall time of the last run", [({}, report["wall_time"])])
+        self._add_metric(lines, "files", "Tag files processed by the last run", [
+            ({"status": "success"}, counters.get("files_succeeded", 0)),
+            ({"status": "failed"}, counters.get("files_failed", 0))])
+        self._add_metric(lines, "updates_per_second", "Objects tagged per second of the last run",
+                         [({}, total_updates / report["wall_time"] if report["wall_time"] > 0 else 0)])
+        self._add_metric(lines, "objects_missed", "Tagged objects found on no Engine by the last run",
+                         [({}, counters.get("objects_missed", 0))])
+        for key, name, help_text in self.RESULT_METRICS:
+            self._add_metric(lines, name, help_text, [({"engine": engine}, result.get(key, 0))
+                                                      for engine, result in sorted(results.items())])
+        self._add_metric(lines, "bytes_downloaded", "Bytes of the responses of the Engine during the last run", [
+            ({"engine": engine}, sum(requests["bytes_received"] for requests in values["requests"].values()))
+            for engine, values in sorted(engines.items())])
+        self._add_metric(lines, "requests", "Requests sent to the Engine by the last run, per phase", [
+            ({"engine": engine, "phase": phase}, requests["count"])
+            for engine, values in sorted(engines.items()) for phase, requests in sorted(values["requests"].items())])
+        self._add_metric(lines, "phase_duration_seconds", "Wall time of each phase on the Engine during the last run", [
+            ({"engine": engine, "phase": phase}, timing["wall_time"])
+            for engine, values in sorted(engines.items()) for phase, timing in sorted(values["phases"].items())])
+        self._add_metric(lines, "request_latency_seconds", "Latency percentiles of the requests to the Engine during the last run", [
+            ({"engine": engine, "phase": phase, "quantile": quantile}, requests["latency"][percentile])
+            for engine, values in sorted(engines.items()) for phase, requests in sorted(values["requests"].items())
+            if requests["latency"] for percentile, quantile in self.QUANTILES])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, metrics):
+        """Write the metrics of a run (atomically), logging the errors
+
+        Args:
+            metrics: the RunMetrics of the run
+
+        """
+
+        try:
+            data = self.format_report(metrics.get_report())
+            # Only one writer at a time on the temporary file
+            with self._lock:
+                temp_path = self.path + ".tmp"
+                with open(temp_path, 'w') as file:
+                    file.write(data)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temp_path, self.path)
+        except OSError as ex:
+            self.logger.error('Unable to write the Prometheus metrics to {}: {!r}'.format(self.path, ex))
+        else:
+            self.logger.debug('Wrote the Prometheus metrics to {}'.format(self.path))
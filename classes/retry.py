@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# Copyright (C) 2017 Nexthink SA, Switzerland
+
+# Library import
+import random
+import threading
+import time
+
+
+class EngineUnavailableError(Exception):
+    """Raised when a request cannot be sent to an Engine (connection errors or circuit breaker open)"""
+
+    def __init__(self, url, reason):
+        super().__init__('Engine "{}" unavailable: {}'.format(url, reason))
+        self.url = url
+        self.reason = reason
+
+
+class RetryPolicy(object):
+    """Summary of class RetryPolicy.
+
+    Bounded retries of the transient failures, with a full jitter
+    exponential backoff.
+
+    Object Attributes:
+        max_retries: maximum number of retries of a request (0 to never retry)
+        base_delay: backoff (in seconds) of the first retry, doubled for each next one
+        max_delay: maximum backoff (in seconds)
+
+    """
+
+    # Http status codes worth a retry (the Engine is busy or restarting)
+    RETRY_STATUS_CODES = frozenset((429, 500, 502, 503, 504))
+
+    def __init__(self, max_retries=3, base_delay=0.5, max_delay=10):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_transient_status(self, status_code):
+        """Check if a response status code is worth a retry"""
+
+        return status_code in self.RETRY_STATUS_CODES
+
+    def get_delay(self, attempt, retry_after=None):
+        """Get the time to wait before a retry
+
+        Args:
+            attempt: number of the failed attempt (0 for the first one)
+            retry_after: value of the Retry-After header of the response (if any)
+
+        Return:
+            the delay in seconds
+
+        """
+
+        try:
+            # A delay requested by the Engine is honored (within max_delay)
+            return min(float(retry_after), self.max_delay)
+        except (TypeError, ValueError):
+            return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+    """Summary of class CircuitBreaker.
+
+    Per Engine circuit breaker: open after failure_threshold failures in a
+    row, half open (one probe request) after reset_timeout.
+
+    Object Attributes:
+        failure_threshold: number of failures in a row that open the breaker
+        reset_timeout: time (in seconds) an open breaker waits before a probe request
+
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        return self._states.setdefault(key, {"state": self.CLOSED, "failures": 0, "opened": 0.0, "probing": False})
+
+    def get_state(self, key):
+        """Get the state of the breaker of an Engine (CLOSED, OPEN or HALF_OPEN)"""
+
+        with self._lock:
+            return self._get(key)["state"]
+
+    def allow_request(self, key):
+        """Check if a request can be sent to an Engine
+
+        Return:
+            False if the breaker is open (or half open with its probe request running)
+
+        """
+
+        with self._lock:
+            breaker = self._get(key)
+            if breaker["state"] == self.OPEN and time.monotonic() - breaker["opened"] >= self.reset_timeout:
+                breaker["state"] = self.HALF_OPEN
+                breaker["probing"] = False
+            if breaker["state"] == self.HALF_OPEN:
+                if breaker["probing"]:
+                    return False
+                breaker["probing"] = True
+                return True
+            return breaker["state"] == self.CLOSED
+
+    def record_success(self, key):
+        """Record a successful request
+
+        Return:
+            the new state of the breaker if it changed, None otherwise
+
+        """
+
+        with self._lock:
+            breaker = self._get(key)
+            breaker["failures"] = 0
+            breaker["probing"] = False
+            if breaker["state"] != self.CLOSED:
+                breaker["state"] = self.CLOSED
+                return self.CLOSED
+            return None
+
+    def record_failure(self, key):
+        """Record a transient failure
+
+        Return:
+            the new state of the breaker if it changed, None otherwise
+
+        """
+
+        with self._lock:
+            breaker = self._get(key)
+            breaker["failures"] += 1
+            breaker["probing"] = False
+            if breaker["state"] == self.HALF_OPEN or (
+                    breaker["state"] == self.CLOSED and breaker["failures"] >= self.failure_threshold):
+                breaker["state"] = self.OPEN
+                breaker["opened"] = time.monotonic()
+                return self.OPEN
+            return None
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# Copyright (C) 2017 Nexthink SA, Switzerland
+
+# Library import
+import sqlite3
+import threading
+import time
+
+
+class RoutingIndex(object):
+    """Summary of class RoutingIndex.
+
+    On-disk (SQLite) index of the Engine on which each tagged object was
+    last seen, so that the tags with a recent route skip the full id scans.
+
+    Object Attributes:
+        db_path: path of the SQLite database file
+        refresh_interval: maximum age (in seconds) of a route and of the last full scan
+        logger: this is to log INFO/WARNING/ERROR/DEBUG messages
+
+    """
+
+    # Maximum number of keys in a single "IN (...)" SQL condition
+    CHUNK_SIZE = 500
+    # Engine recorded for the objects that were not found on any Engine
+    NOT_FOUND = ""
+
+    def __init__(self, db_path, refresh_interval, logger):
+        self.db_path = db_path
+        self.refresh_interval = refresh_interval
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA mmap_size=268435456")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS routes (
+                                object_type TEXT NOT NULL,
+                                id_column TEXT NOT NULL,
+                                object_key TEXT NOT NULL,
+                                engine TEXT NOT NULL,
+                                last_seen REAL NOT NULL,
+                                PRIMARY KEY (object_type, id_column, object_key)) WITHOUT ROWID""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS scans (
+                                object_type TEXT NOT NULL,
+                                id_column TEXT NOT NULL,
+                                last_scan REAL NOT NULL,
+                                PRIMARY KEY (object_type, id_column))""")
+        self._db.commit()
+
+    def lookup(self, object_type, id_column, keys):
+        """Get the recent routes of a list of objects
+
+        Args:
+            object_type: the type of the objects
+            id_column: the column identifying the objects
+            keys: list of normalized object identifiers
+
+        Return:
+            dict of normalized identifier -> Engine, for the objects seen within refresh_interval
+
+        """
+
+        oldest = time.time() - self.refresh_interval
+        routes = {}
+        with self._lock:
+            for start in range(0, len(keys), self.CHUNK_SIZE):
+                chunk = keys[start:start + self.CHUNK_SIZE]
+                rows = self._db.execute(
+                    "SELECT object_key, engine FROM routes WHERE object_type = ? AND id_column = ? AND last_seen >= ? "
+                    "AND object_key IN ({})".format(",".join("?" * len(chunk))),
+                    [object_type, id_column, oldest] + chunk)
+                routes.update(rows)
+        return routes
+
+    def needs_full_scan(self, object_type, id_column):
+        """Check if the last full id scan of an object type is older than refresh_interval"""
+
+        with self._lock:
+            row = self._db.execute("SELECT last_scan FROM scans WHERE object_type = ? AND id_column = ?",
+                                   (object_type, id_column)).fetchone()
+        return row is None or row[0] < time.time() - self.refresh_interval
+
+    def record(self, object_type, id_column, engine, keys):
+        """Record that objects were seen on an Engine
+
+        Args:
+            object_type: the type of the objects
+            id_column: the column identifying the objects
+            engine: the Engine the objects were found on
+            keys: iterable of normalized object identifiers
+
+        """
+
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO routes (object_type, id_column, object_key, engine, last_seen) VALUES (?, ?, ?, ?, ?)",
+                ((object_type, id_column, key, engine, now) for key in keys))
+            self._db.commit()
+
+    def record_full_scan(self, object_type, id_column):
+        """Record that the ids of an object type were just scanned on all Engines"""
+
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO scans (object_type, id_column, last_scan) VALUES (?, ?, ?)",
+                             (object_type, id_column, time.time()))
+            self._db.commit()
+
+    def forget(self, object_type, id_column, keys):
+        """Remove the routes of objects (e.g. after a failed update) so they are scanned again"""
+
+        keys = list(keys)
+        with self._lock:
+            for start in range(0, len(keys), self.CHUNK_SIZE):
+                chunk = keys[start:start + self.CHUNK_SIZE]
+                self._db.execute(
+                    "DELETE FROM routes WHERE object_type = ? AND id_column = ? AND object_key IN ({})".format(
+                        ",".join("?" * len(chunk))),
+                    [object_type, id_column] + chunk)
+            self._db.commit()
+
+    def close(self):
+        """Close the database"""
+
+        with self._lock:
+            self._db.close()
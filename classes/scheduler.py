@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# Copyright (C) 2017 Nexthink SA, Switzerland
+
+# Library import
+import threading
+
+
+class UpdateScheduler(object):
+    """Summary of class UpdateScheduler.
+
+    Shared pool of workers running the update work items of all the Engines,
+    the Engine with the largest backlog first.
+
+    Object Attributes:
+        num_workers: number of worker threads
+        max_engine_requests: maximum number of items running at the same time for one Engine
+        logger: this is to log INFO/WARNING/ERROR/DEBUG messages
+        limiter: AdaptiveLimiter giving the limit of each Engine instead of max_engine_requests (if any)
+
+    """
+
+    def __init__(self, num_workers, max_engine_requests, logger, limiter=None):
+        self.num_workers = num_workers
+        self.max_engine_requests = max_engine_requests
+        self.logger = logger
+        self.limiter = limiter
+        self._backlogs = {}
+        self._in_flight = {}
+        self._condition = threading.Condition()
+        self._workers = []
+        self._stopped = False
+
+    def start(self):
+        """Start the worker threads"""
+
+        self._stopped = False
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self._work, name="update-worker-{}".format(i), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        """Stop the worker threads once they are done with their current item"""
+
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def _next_item(self):
+        """Take the next item of the Engine with the largest runnable backlog (lock held)"""
+
+        best = None
+        for engine, backlog in self._backlogs.items():
+            limit = self.limiter.get_limit(engine) if self.limiter else self.max_engine_requests
+            if backlog and self._in_flight.get(engine, 0) < limit:
+                if best is None or len(backlog) > len(self._backlogs[best]):
+                    best = engine
+        if best is None:
+            return None, None
+        self._in_flight[best] = self._in_flight.get(best, 0) + 1
+        return best, self._backlogs[best].pop()
+
+    def _work(self):
+        """Worker thread loop"""
+
+        while True:
+            with self._condition:
+                engine, item = self._next_item()
+                while item is None:
+                    if self._stopped:
+                        return
+                    self._condition.wait()
+                    engine, item = self._next_item()
+
+            index, func, arg, job = item
+            try:
+                outcome = func(arg)
+            except Exception as exc:
+                outcome = exc
+
+            with self._condition:
+                self._in_flight[engine] -= 1
+                job["results"][index] = outcome
+                job["pending"] -= 1
+                self._condition.notify_all()
+
+    def run(self, engine, func, args):
+        """Run func on each argument with the workers and wait for all of them
+
+        Args:
+            engine: the Engine the work items belong to (its url)
+            func: function run by the workers for each work item
+            args: list of the arguments of the work items
+
+        Return:
+            list of the values returned by func (same order as args)
+
+        """
+
+        job = {"results": [None] * len(args), "pending": len(args)}
+        with self._condition:
+            # Items are popped from the end of the backlog, so store them reversed
+            backlog = self._backlogs.setdefault(engine, [])
+            backlog[:0] = [(index, func, arg, job) for index, arg in reversed(list(enumerate(args)))]
+            self._condition.notify_all()
+            while job["pending"]:
+                self._condition.wait()
+            # Another caller may share the backlog of the Engine (the files of a run share the workers)
+            if not self._backlogs.get(engine) and not self._in_flight.get(engine):
+                self._backlogs.pop(engine, None)
+
+        # Give the first error back to the Engine that submitted the items
+        for outcome in job["results"]:
+            if isinstance(outcome, Exception):
+                raise outcome
+        return job["results"]
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+# Copyright (C) 2017 Nexthink SA, Switzerland
+
+# Library import
+import threading
+
+
+class SnapshotCache(object):
+    """Summary of class SnapshotCache.
+
+    Run-scoped cache of the id indexes of the Engines, each downloaded once
+    (single flight) by the files that need it.
+
+    Object Attributes:
+        logger: this is to log INFO/WARNING/ERROR/DEBUG messages
+        hits: number of indexes served from the cache
+        misses: number of indexes that had to be downloaded
+
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _key(self, url, id_query, id_column):
+        return url, " ".join(id_query.split()), id_column
+
+    def claim(self, url, id_query, id_column):
+        """Get the cached index of an Engine, or claim its download
+
+        Return:
+            (index, None) if it is cached,
+            (None, event) if another caller is downloading it: wait for the event, then claim again,
+            (None, None) if the caller must download it, then put() or release() it
+
+        """
+
+        key = self._key(url, id_query, id_column)
+        with self._lock:
+            engine_index = self._entries.get(key)
+            if engine_index is not None:
+                self.hits += 1
+                return engine_index, None
+            pending = self._pending.get(key)
+            if pending is not None:
+                return None, pending
+            self.misses += 1
+            self._pending[key] = threading.Event()
+            return None, None
+
+    def get(self, url, id_query, id_column):
+        """Get the cached index of an Engine (waiting for its download by another caller)
+
+        Return:
+            the index, or None if it is not cached: the caller must then download it, and put() or release() it
+
+        """
+
+        while True:
+            engine_index, pending = self.claim(url, id_query, id_column)
+            if pending is None:
+                return engine_index
+            pending.wait()
+
+    def put(self, url, id_query, id_column, engine_index):
+        """Store the index of an Engine built from a full id scan"""
+
+        key = self._key(url, id_query, id_column)
+        with self._lock:
+            self._entries[key] = engine_index
+            pending = self._pending.pop(key, None)
+        if pending is not None:
+            pending.set()
+
+    def release(self, url, id_query, id_column):
+        """End the download of an index claimed by get() (without storing it if it was not put)"""
+
+        with self._lock:
+            pending = self._pending.pop(self._key(url, id_query, id_column), None)
+        if pending is not None:
+            pending.set()
+
+    def invalidate(self, url=None, category=None):
+        """Drop the cached indexes of an Engine and/or of the queries returning a category
+
+        Args:
+            url: drop the indexes of this Engine (all Engines if None)
+            category: only drop the indexes holding the keyword of this category (all if None)
+
+        """
+
+        category_field = '#"{}"'.format(category) if category else None
+        with self._lock:
+            for key in list(self._entries):
+                entry_url, id_query, id_column = key
+                if url is not None and entry_url != url:
+                    continue
+                if category_field is not None and category_field not in id_query:
+                    continue
+                del self._entries[key]
+                self.logger.debug('Dropped cached ids of Engine "{}" for query: {}'.format(entry_url, id_query))
+
+    def get_stats(self):
+        """Get the hit/miss counters
+
+        Return:
+            dict with the number of hits, misses and cached indexes
+
+        """
+
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# Copyright (C) 2017 Nexthink SA, Switzerland
+
+# Library import
+import codecs
+import csv
+import json
+
+
+class JsonArrayParser(object):
+    """Summary of class JsonArrayParser.
+
+    Incremental parser of a JSON array of objects (format=json).
+
+    Object Attributes:
+        fields: names of the fields to keep from each object
+
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self._buffer = ""
+        self._started = False
+
+    def feed(self, chunk):
+        """Parse a chunk of the response body
+
+        Args:
+            chunk: bytes of the response body
+
+        Return:
+            list of the objects completed by the chunk (dicts with the requested fields only)
+
+        """
+
+        self._buffer += self._decoder.decode(chunk)
+        objects = []
+        buffer = self._buffer
+        position = 0
+        while True:
+            # Skip the separators between the objects
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position == len(buffer):
+                break
+            if not self._started:
+                if buffer[position] != "[":
+                    raise ValueError("Expected a JSON array")
+                self._started = True
+                position += 1
+                continue
+            if buffer[position] == "]":
+                position = len(buffer)
+                break
+            try:
+                obj, end = self._json.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # Incomplete object: wait for the next chunk
+                break
+            objects.append({field: obj.get(field) for field in self.fields if field in obj})
+            position = end
+        self._buffer = buffer[position:]
+        return objects
+
+    def close(self):
+        """Check that the whole response body was parsed
+
+        Return:
+            an empty list (all the objects were returned by feed)
+
+        """
+
+        if self._buffer.strip():
+            raise ValueError("Truncated JSON array: {!r}".format(self._buffer[:100]))
+        return []
+
+
+class CsvRowParser(object):
+    """Summary of class CsvRowParser.
+
+    Incremental parser of a CSV response (format=csv).
+
+    Object Attributes:
+        fields: names of the fields to keep from each row
+
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._positions = None
+        self._delimiter = ","
+
+    def _parse_lines(self, lines):
+        objects = []
+        for line in lines:
+            line = line.rstrip("\r")
+            if not line.strip():
+                continue
+            if self._positions is None:
+                self._delimiter = "\t" if "\t" in line else ","
+                header = next(csv.reader([line], delimiter=self._delimiter))
+                self._positions = [(field, header.index(field)) for field in self.fields if field in header]
+                continue
+            row = next(csv.reader([line], delimiter=self._delimiter))
+            objects.append({field: row[index] if index < len(row) else None for field, index in self._positions})
+        return objects
+
+    def feed(self, chunk):
+        """Parse a chunk of the response body
+
+        Args:
+            chunk: bytes of the response body
+
+        Return:
+            list of the rows completed by the chunk (dicts with the requested fields only)
+
+        """
+
+        self._buffer += self._decoder.decode(chunk)
+        lines = self._buffer.split("\n")
+        self._buffer = lines.pop()
+        return self._parse_lines(lines)
+
+    def close(self):
+        """Parse the last line of the response body
+
+        Return:
+            list with the last row (if the body does not end with a new line)
+
+        """
+
+        lines = [self._buffer]
+        self._buffer = ""
+        return self._parse_lines(lines)
@@ -0,0 +1,30 @@
+#!/usr/bin/python
+# Copyright (C) 2017 Nexthink SA, Switzerland
+
+# Library import
+import sys
+
+
+class TagRow(object):
+    """Summary of class TagRow.
+
+    Compact row of a tag file (the repeated values are interned).
+
+    Object Attributes:
+        object_type: the type of the object (device, user, ...)
+        object_id: the identifier of the object (value of the id_column)
+        category: the name of the Category
+        keyword: the Keyword to set in the Category (None to remove the keyword)
+
+    """
+
+    __slots__ = ("object_type", "object_id", "category", "keyword")
+
+    def __init__(self, object_type, object_id, category, keyword):
+        self.object_type = sys.intern(object_type)
+        self.object_id = object_id
+        self.category = sys.intern(category)
+        self.keyword = sys.intern(keyword) if keyword is not None else None
+
+    def __repr__(self):
+        return "TagRow({!r}, {!r}, {!r}, {!r})".format(self.object_type, self.object_id, self.category, self.keyword)
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+# Copyright (C) 2017 Nexthink SA, Switzerland
+
+# Library import
+import ctypes
+import ctypes.util
+import glob
+import os
+import select
+import struct
+import threading
+import time
+
+
+class TagDirectoryWatcher(object):
+    """Summary of class TagDirectoryWatcher.
+
+    Watches the tags directory (inotify or polling) for new CSV tag files
+    that are completely written.
+
+    Object Attributes:
+        tags_path: the directory to watch
+        logger: this is to log INFO/WARNING/ERROR/DEBUG messages
+        poll_interval: time (in seconds) between two scans of the directory (without inotify)
+        settle_time: time (in seconds) a file must stay unchanged before it is processed
+
+    """
+
+    # inotify events (see inotify(7))
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_Q_OVERFLOW = 0x00004000
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, tags_path, logger, poll_interval=5, settle_time=2):
+        self.tags_path = tags_path
+        self.logger = logger
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self._inotify_fd = None
+        self._pending = {}
+        self._returned = {}
+        self._stop = threading.Event()
+
+    @property
+    def stopped(self):
+        return self._stop.is_set()
+
+    def _start_inotify(self):
+        """Watch the directory with inotify (through the C library)
+
+        Return:
+            True if inotify is used, False if the directory must be polled
+
+        """
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError) as ex:
+            self.logger.info('inotify is not available ({!r}) - polling {} every {}s'.format(
+                ex, self.tags_path, self.poll_interval))
+            return False
+        if fd < 0:
+            self.logger.warning('inotify_init1 failed (errno {}) - polling {} every {}s'.format(
+                ctypes.get_errno(), self.tags_path, self.poll_interval))
+            return False
+        if libc.inotify_add_watch(fd, os.fsencode(self.tags_path), self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            self.logger.warning('inotify_add_watch failed on {} (errno {}) - polling every {}s'.format(
+                self.tags_path, ctypes.get_errno(), self.poll_interval))
+            os.close(fd)
+            return False
+        self._inotify_fd = fd
+        self.logger.info('Watching {} with inotify'.format(self.tags_path))
+        return True
+
+    def start(self):
+        """Start watching the directory (the CSV files already there are processed first)"""
+
+        self._stop.clear()
+        self._start_inotify()
+        self._scan()
+
+    def stop(self):
+        """Make wait_for_files() return as soon as possible (can be called from a signal handler)"""
+
+        self._stop.set()
+
+    def close(self):
+        """Stop watching the directory"""
+
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+
+    def _add_pending(self, file_name):
+        if file_name not in self._pending:
+            self._pending[file_name] = None
+
+    def _scan(self):
+        for file_name in glob.glob(os.path.join(self.tags_path, '*.csv')):
+            self._add_pending(file_name)
+
+    def _read_events(self, timeout):
+        """Wait up to timeout seconds for inotify events and add the CSV files written to the pending files"""
+
+        readable, _, _ = select.select([self._inotify_fd], [], [], timeout)
+        if not readable:
+            return
+        try:
+            data = os.read(self._inotify_fd, 65536)
+        except BlockingIOError:
+            return
+        position = 0
+        while position + self.EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, position)
+            position += self.EVENT_HEADER.size
+            name = os.fsdecode(data[position:position + length].rstrip(b"\0"))
+            position += length
+            if mask & self.IN_Q_OVERFLOW:
+                self.logger.warning('inotify queue overflow - scanning {}'.format(self.tags_path))
+                self._scan()
+            elif name.endswith('.csv'):
+                self._add_pending(os.path.join(self.tags_path, name))
+
+    def _get_ready_files(self):
+        """Get the pending files that did not change for settle_time seconds"""
+
+        now = time.time()
+        ready = []
+        for file_name, previous in list(self._pending.items()):
+            try:
+                stat = os.stat(file_name)
+            except FileNotFoundError:
+                del self._pending[file_name]
+                continue
+            signature = (stat.st_size, stat.st_mtime)
+            if self._returned.get(file_name) == signature:
+                # Already returned and not replaced since
+                del self._pending[file_name]
+            elif signature == previous and now - stat.st_mtime >= self.settle_time:
+                del self._pending[file_name]
+                self._returned[file_name] = signature
+                ready.append(file_name)
+            else:
+                self._pending[file_name] = signature
+        return sorted(ready, key=os.path.getmtime)
+
+    def wait_for_files(self):
+        """Wait for completely written tag files
+
+        Return:
+            list of the CSV files ready to be processed (oldest first), empty once stopped
+
+        """
+
+        # Forget the returned files that were renamed since
+        self._returned = {file_name: signature for file_name, signature in self._returned.items()
+                          if os.path.exists(file_name)}
+        while not self._stop.is_set():
+            ready = self._get_ready_files()
+            if ready:
+                return ready
+            # Check the pending files again once they may have settled
+            timeout = min(self.settle_time, self.poll_interval) if self._pending else self.poll_interval
+            if self._inotify_fd is not None:
+                self._read_events(timeout)
+            else:
+                self._stop.wait(timeout)
+                self._scan()
+        return []
@@ -1,11 +1,107 @@
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import EmptyPoolError
+
+# Time at which the current thread got its connection from a pool
+_connection_times = threading.local()
+
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    """Connection pool noting the time at which a connection is handed out"""
+
+    # Maximum wait (in seconds) for a free connection of the pool (None to wait forever)
+    pool_timeout = None
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(self.pool_timeout if timeout is None else timeout)
+        _connection_times.value = time.monotonic()
+        return conn
+
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    """Connection pool noting the time at which a connection is handed out"""
+
+    # Maximum wait (in seconds) for a free connection of the pool (None to wait forever)
+    pool_timeout = None
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(self.pool_timeout if timeout is None else timeout)
+        _connection_times.value = time.monotonic()
+        return conn
+
+
+
+class BudgetAdapter(HTTPAdapter):
+    """HTTP adapter that takes a slot of a shared request budget while sending
+
+    Its responses have a service_time attribute: the time from the connection
+    handed out by the pool to the response headers, without the waits on the
+    budget and on the pool (None if it could not be measured). A request
+    waiting more than pool_timeout seconds for a pooled connection fails with
+    a ConnectionError.
+    """
+
+    def __init__(self, budget=None, pool_timeout=None, **kwargs):
+        self.budget = budget
+        self.pool_timeout = pool_timeout
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: type(pool_class.__name__, (pool_class,), {"pool_timeout": self.pool_timeout})
+            for scheme, pool_class in (("http", TimedHTTPConnectionPool), ("https", TimedHTTPSConnectionPool))}
+
+    def send(self, *args, **kwargs):
+        if self.budget is None:
+            return self._timed_send(*args, **kwargs)
+        with self.budget:
+            return self._timed_send(*args, **kwargs)
+
+    def _timed_send(self, *args, **kwargs):
+        _connection_times.value = None
+        try:
+            response = super().send(*args, **kwargs)
+        except EmptyPoolError as err:
+            raise requests.exceptions.ConnectionError(err, request=args[0] if args else kwargs.get("request"))
+        acquired = _connection_times.value
+        response.service_time = time.monotonic() - acquired if acquired is not None else None
+        return response
+
+
+
+class KeepAliveAdapter(BudgetAdapter):
+    """HTTP adapter that turns on TCP keep-alive on the pooled connections"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super().init_poolmanager(*args, **kwargs)
 
 
 
 class WebSession():
 
-    def __init__(self,credentials):
+    def __init__(self, credentials, pool_size=10, keep_alive=True, max_requests=None, pool_timeout=None):
         self._credentials = credentials
+        self.pool_size = pool_size
+        # Maximum wait (in seconds) for a free pooled connection (None to wait forever)
+        self.pool_timeout = pool_timeout
+        self.keep_alive = keep_alive
+        # Requests running at the same time on all the Engines, whatever the file or thread sending them
+        self.request_budget = threading.BoundedSemaphore(max_requests) if max_requests else None
+        # One long-lived session per host, shared by all the worker threads
+        self._sessions = {}
+        self._lock = threading.Lock()
 
 
     def get_default_headers(self):
@@ -18,3 +114,65 @@ class WebSession():
         session = requests.session()
         session.headers.update(self.get_default_headers())
         return session
+
+
+    def get_session(self, url):
+        """ Get the pooled session of the host of an url
+
+        The session is created on first use and then reused by every request
+        sent to the same host, so the TCP connections and TLS handshakes are
+        kept for the whole run.
+
+        Args:
+            url: url of the request to send
+
+        Return:
+            a requests session bound to a connection pool of pool_size connections
+        """
+        host = urlparse(url).netloc
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = self.create_session()
+                if self.keep_alive:
+                    adapter = KeepAliveAdapter(budget=self.request_budget, pool_connections=1,
+                                               pool_maxsize=self.pool_size, pool_block=True,
+                                               pool_timeout=self.pool_timeout)
+                else:
+                    adapter = BudgetAdapter(budget=self.request_budget, pool_connections=1,
+                                            pool_maxsize=self.pool_size, pool_block=True,
+                                            pool_timeout=self.pool_timeout)
+                    session.headers['Connection'] = 'close'
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._sessions[host] = session
+        return session
+
+
+    def get_pool_stats(self):
+        """ Get the connection counters of all the pooled sessions
+
+        Return:
+            dict with the number of requests, new connections (handshakes) and reused connections
+        """
+        num_requests = 0
+        num_connections = 0
+        with self._lock:
+            sessions = list(self._sessions.values())
+        for session in sessions:
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools[key]
+                    num_requests += pool.num_requests
+                    num_connections += pool.num_connections
+        return {"requests": num_requests, "handshakes": num_connections,
+                "reused": num_requests - num_connections}
+
+
+    def close(self):
+        """ Close all the pooled sessions and their connections """
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
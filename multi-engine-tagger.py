@@ -2,14 +2,18 @@
 
 # Standard libraries
 import argparse
+import atexit
+import concurrent.futures
 import datetime
 import glob
+import itertools
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import os
 import os.path
+import queue
+import signal
 import sys
-import time
 import xml.etree.ElementTree as Xml
 
 # 3rd Party Libraries
@@ -18,85 +22,178 @@ import requests
 # Custom classes
 from classes.nxql import Nxql
 from classes.appliance import Appliance
+from classes.filescheduler import FileScheduler
+from classes.journal import TagJournal
+from classes.limiter import AdaptiveLimiter
+from classes.metrics import RunMetrics
+from classes.planner import QueryPlanner
+from classes.profiler import RunProfiler
+from classes.prometheus import PrometheusTextfile
+from classes.retry import CircuitBreaker, RetryPolicy
+from classes.routing import RoutingIndex
+from classes.scheduler import UpdateScheduler
+from classes.snapshotcache import SnapshotCache
+from classes.watcher import TagDirectoryWatcher
 from classes.websession import WebSession
 import classes.functions as functions
 
 # Script execution path
 path = os.path.dirname(os.path.abspath(__file__))
 
-def clear_tags(nxql, all_engines, object_type, category, logger):
-    """Clear the category from all Engines"""
-    success = True
-
-    # First clear the tag from all engines
-    nxql.engine = all_engines
-
-    # Get the Object Type and Category Name from the first row
-    logger.info('Removing any existing tags from {} objects for Category "{}"...'.format(object_type, category))
-
-    # We add the update query to the NXQL object
-    nxql.clean_category_query(category, object_type)
-
-    # Create the URL with the correct Format
-    nxql.prepare_url_2()
-
-    # Run the requests and get the response as a list
-    results_clean = nxql.run_request_2()
-
-    # Sleep 10 seconds to give the Engines time to quiesce
-    time.sleep( 10 )
-
-    # Iterate over the responses return by the get requests
-    for hostname, response, response_code in results_clean:
-        logger.debug('Hostname: "{}" returned http response code: {}.'.format(hostname, response_code))
-        if response_code:
-            template = 'Tags successfully cleaned for Category "{0}" on Engine: {1}'
-            message = template.format(category, hostname)
-            logger.info(message)
-        else:
-            template = 'Unable to clean tags for Category "{0}" on Engine: {1}'
-            message = template.format(category, hostname)
-            logger.error(message)
-            # Return unsuccessful if any engines throw an error
-            success = False
-
-    return success
-
-def tag_device(config_file_name, tags_file, nxql, all_engines, logger):
-
-    # Read tags from CSV files
-    # Assumption that all rows of the file are for the same object type and category
-    tags = functions.read_csv_file(tags_file)
-    object_type = tags[0]["Object Type"]
-    category = tags[0]["Category"]
-
-    # First clear the tag from all engines (end if not successful)
-    result = clear_tags(nxql, all_engines, object_type, category, logger)
-    if not result: return
+def get_tag_routes(routing, tag_keys, all_engines, object_type, id_column, logger):
+    """Get the Engine of each tag from the routing index
+
+    The ids without a recent route are looked up on all Engines, unless they
+    are more than half of the ids: all the ids are then scanned.
+
+    Return:
+        (dict of Engine -> set of normalized ids, list of the unrouted ids),
+        or None if the ids must be scanned on all Engines
+    """
+    if routing.needs_full_scan(object_type, id_column):
+        logger.info('Routing index: full id scan of {} objects is due'.format(object_type))
+        return None
+
+    known_routes = routing.lookup(object_type, id_column, tag_keys)
+    routes = {}
+    for key, engine in known_routes.items():
+        # An empty Engine means the id was not found on any Engine during the last scan
+        if engine in all_engines or engine == RoutingIndex.NOT_FOUND:
+            routes.setdefault(engine, set()).add(key)
+    num_routed = sum(len(keys) for keys in routes.values())
+    if num_routed * 2 < len(tag_keys):
+        logger.info('Routing index: {} of {} {}s have no recent route - scanning all Engines'.format(
+            len(tag_keys) - num_routed, len(tag_keys), object_type))
+        return None
+
+    unrouted = [key for key in tag_keys if key not in known_routes or
+                (known_routes[key] not in all_engines and known_routes[key] != RoutingIndex.NOT_FOUND)]
+    logger.info('Routing index: {} of {} {}s routed to {} Engines ({} known to be missing), {} looked up on all Engines - skipping the id scan'.format(
+        num_routed, len(tag_keys), object_type, len(routes) - (RoutingIndex.NOT_FOUND in routes),
+        len(routes.get(RoutingIndex.NOT_FOUND, ())), len(unrouted)))
+    return routes, unrouted
+
+def record_tag_routes(routing, nxql, tag_results, all_engines, object_type, id_column, routes=None, unrouted=None):
+    """Record in the routing index the Engines the tags were found on
+
+    Only the objects found by a scan or a lookup refresh their route: the
+    update of a routed object succeeds even if the object left its Engine,
+    so its route is left to expire. routes and unrouted are the ones of
+    get_tag_routes() (None after a full scan).
+    """
+    url_engines = dict(zip(nxql.urls, nxql.engine))
+    found_keys = set()
+    for tag_result in tag_results:
+        engine = url_engines[tag_result["url"]]
+        routed_keys = routes.get(engine, ()) if routes is not None else ()
+        updated_keys = [Nxql.normalize_id(object_id) for object_id in tag_result["updated_ids"]]
+        failed_keys = [Nxql.normalize_id(object_id) for object_id in tag_result["failed_ids"]]
+        routing.record(object_type, id_column, engine, [key for key in updated_keys if key not in routed_keys])
+        # Routes that failed are scanned again next time
+        routing.forget(object_type, id_column, failed_keys)
+        found_keys.update(updated_keys, failed_keys)
+    if len(tag_results) == len(all_engines) and all(tag_result["available"] and tag_result["cleared"]
+                                                    for tag_result in tag_results):
+        # The ids searched on all Engines and found on none are known to be missing until the next refresh
+        # (an Engine that could not be reached or cleaned was not searched)
+        searched_keys = nxql.tag_index if routes is None else unrouted
+        routing.record(object_type, id_column, RoutingIndex.NOT_FOUND,
+                       [key for key in searched_keys if key not in found_keys])
+        if routes is None:
+            routing.record_full_scan(object_type, id_column)
+
+def tag_device(config_file_name, tags_file, nxql, all_engines, logger, diff=False, routing=None, journal=None, metrics=None,
+               tags=None):
+
+    # Stream tags from CSV files (unless given the rows of a partition of a mixed file)
+    # All rows of the file must be for the same object type and category (checked while streaming)
+    tags = iter(tags) if tags is not None else functions.stream_csv_file(tags_file)
+    first_tag = next(tags)
+    object_type = first_tag.object_type
+    category = first_tag.category
+    tags = itertools.chain([first_tag], tags)
 
     # Get the object identity query from the config file
     id_column, id_query = functions.get_object_query(config_file_name, object_type, category, logger)
 
-    # Prepare to run the per-engine update process
+    # Checkpoint the progress of the file (or continue from the interrupted run)
+    if journal is not None:
+        journal.open(tags_file, 'diff' if diff else 'clear', category, object_type)
+    nxql.journal = journal
+    nxql.metrics = metrics
+
+    # Prepare to run the per-engine process (clean or diff, id query and updates)
     nxql.engine = all_engines
-    nxql.prepare_for_engine_object_updates(id_query, id_column, tags)
+    if diff:
+        logger.info('Comparing existing tags of {} objects for Category "{}" with the tag file...'.format(object_type, category))
+        nxql.prepare_for_engine_object_updates(id_query, id_column, tags, object_type=object_type, diff_category=category)
+    else:
+        logger.info('Removing any existing tags from {} objects for Category "{}" before tagging...'.format(object_type, category))
+        nxql.prepare_for_engine_object_updates(id_query, id_column, tags, clear_category=category, object_type=object_type)
+
+    # A pattern can match objects on several Engines: the files with wildcard ids are not routed
+    if routing is not None and nxql.pattern_index.patterns:
+        logger.info('Routing index: not used for the wildcard ids of the file')
+        routing = None
+
+    # Send the tags straight to their Engine if the routing index knows them (the others are looked up)
+    routes, unrouted = None, None
+    if routing is not None and not diff:
+        tag_routes = get_tag_routes(routing, list(nxql.tag_index), all_engines, object_type, id_column, logger)
+        if tag_routes is not None:
+            if nxql.set_routes(*tag_routes):
+                routes, unrouted = tag_routes
+            else:
+                logger.info('Routing index: the id query cannot look up the unrouted ids - scanning all Engines')
 
     # Run the multi-engine process on the current set of tags
-    tag_results = nxql.process_engine_objects()
+    try:
+        tag_results = nxql.process_engine_objects()
+    finally:
+        nxql.journal = None
+        nxql.metrics = None
+
+    if routing is not None:
+        record_tag_routes(routing, nxql, tag_results, all_engines, object_type, id_column, routes, unrouted)
+
+    # The cached ids holding the keywords of the category are now outdated
+    if nxql.snapshot_cache is not None:
+        nxql.snapshot_cache.invalidate(category=category)
 
     # Dump the results to the log
     all_updates = 0
     all_failures = 0
+    all_unchanged = 0
+    all_removed = 0
+    all_cleared = True
     updated_ids = []
+    expanded_ids = {}
     logger.info('Results for updating Category "{}":'.format(category))
     for tag_result in tag_results:
-        if tag_result["num_failures"] > 0:
-            logger.error('\tEngine: "{url}", {num_updates} Sucessful Updates, {num_failures} Failed Updates.'.format(**tag_result))
+        if not tag_result["cleared"]:
+            # Engines that could not be cleaned were not updated
+            logger.error('\tEngine: "{url}", unable to clean the Category - no updates done.'.format(**tag_result))
+            all_cleared = False
+        elif not tag_result["available"]:
+            # Engines that could not be reached were not (fully) updated
+            logger.error('\tEngine: "{url}", unavailable after {num_retries} Retries and {num_breaker_changes} circuit breaker changes - {num_updates} Sucessful Updates before giving up.'.format(**tag_result))
+            all_cleared = False
+        elif tag_result["num_failures"] > 0:
+            logger.error('\tEngine: "{url}", {num_matches} Matched, {num_misses} Missed, {num_unchanged} Unchanged, {num_removed} Removed, {num_updates} Sucessful Updates, {num_failures} Failed Updates, {num_retries} Retries.'.format(**tag_result))
         else:
-            logger.info('\tEngine: "{url}", {num_updates} Sucessful Updates, {num_failures} Failed Updates.'.format(**tag_result))
+            logger.info('\tEngine: "{url}", {num_matches} Matched, {num_misses} Missed, {num_unchanged} Unchanged, {num_removed} Removed, {num_updates} Sucessful Updates, {num_failures} Failed Updates, {num_retries} Retries.'.format(**tag_result))
         all_updates += tag_result["num_updates"]
         all_failures += tag_result["num_failures"]
+        all_unchanged += tag_result["num_unchanged"]
+        all_removed += tag_result["num_removed"]
         updated_ids.extend(tag_result["updated_ids"])
+        for pattern, object_ids in tag_result["expanded_ids"]:
+            expanded_ids.setdefault(pattern, set()).update(object_ids)
+    if len(tag_results) < len(all_engines):
+        # The Engines whose processing raised an unexpected error have no result (and may have been cleaned)
+        logger.error('\t{} of the {} Engines failed with an unexpected error - see the errors above.'.format(
+            len(all_engines) - len(tag_results), len(all_engines)))
+        all_cleared = False
 
     # Put the total processed into the log
     if all_failures > 0:
@@ -106,12 +203,215 @@ def tag_device(config_file_name, tags_file, nxql, all_engines, logger):
         logger.info('Tagged Category "{}" on {} {}s with {} failures across all {} Engines.'.format(
             category, all_updates, object_type, all_failures, len(all_engines)))
 
+    if diff:
+        logger.info('Skipped {} unchanged {}s and removed Category "{}" from {} {}s.'.format(
+            all_unchanged, object_type, category, all_removed, object_type))
+
+    # Put the objects each wildcard pattern expanded to into the log
+    for pattern, object_ids in sorted(expanded_ids.items()):
+        logger.info('Pattern "{}" expanded to {} {}s'.format(pattern, len(object_ids), object_type))
+        logger.debug('Pattern "%s" expanded to: %s', pattern, sorted(object_ids))
+
+    # Put the time spent in each phase (summed over the Engines) into the log
+    if metrics is not None:
+        metrics.record_results(tag_results)
+        logger.info('Time spent on all Engines: {}'.format(', '.join(
+            '{} {:.2f}s'.format(phase, seconds) for phase, seconds in metrics.get_phase_times().items())))
+
     # Now, determine which items were not tagged
-    object_ids_to_be_tagged = [tag["Object ID"] for tag in tags]
-    missed_object_ids = sorted(set(object_ids_to_be_tagged) - set(updated_ids))
-    logger.debug('missed_object_ids: {}'.format(missed_object_ids))
+    updated_ids = set(updated_ids)
+    missed_object_ids = sorted(tag.object_id for tag in nxql.tag_index.values() if tag.object_id not in updated_ids)
+    logger.debug('missed_object_ids: %s', missed_object_ids)
+
+    return (all_failures == 0 and all_cleared), missed_object_ids, expanded_ids
+
+def tag_mixed_file(args, fullpath, nxql, all_engines, logger, rundate, routing=None, metrics=None):
+    """Tag the objects of a tag file mixing several Object Types and Categories in one pass
+
+    The rows are partitioned on their (Object Type, Category). Each partition cleans (or compares)
+    its Category once, with its own NXQL object and journal, and up to parallel_partitions partitions
+    run at the same time. The partitions of the same Object Type share the id scan of each Engine
+    through the snapshot cache (when their id queries are the same).
+
+    Return:
+        (success, missed object ids, objects expanded from each pattern, journals of the partitions)
+    """
+    partitions = {}
+    for tag in functions.stream_csv_file(fullpath, mixed=True):
+        partitions.setdefault((tag.object_type, tag.category), []).append(tag)
+    partitions = sorted(partitions.items())
+    logger.info('{} rows in {} partitions (Object Type, Category): {}'.format(
+        sum(len(tags) for key, tags in partitions), len(partitions),
+        ', '.join('{} {} "{}"'.format(len(tags), key[0], key[1]) for key, tags in partitions)))
+    journals = [TagJournal('{}.{}.journal'.format(fullpath, number), rundate, args.resume, logger)
+                for number in range(len(partitions))]
+
+    def tag_partition(journal, tags):
+        # The results of the Engines are kept per partition, then added to the ones of the file
+        partition_metrics = RunMetrics(os.path.basename(fullpath), rundate) if metrics is not None else None
+        try:
+            return tag_device(args.query_file, fullpath, nxql.copy(), all_engines, logger, diff=args.diff,
+                              routing=routing, journal=journal, metrics=partition_metrics, tags=tags)
+        finally:
+            if partition_metrics is not None:
+                metrics.merge(partition_metrics)
 
-    return (all_failures == 0), missed_object_ids
+    success = True
+    missed_object_ids = set()
+    expanded_ids = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.parallel_partitions)) as executor:
+        futures = {executor.submit(tag_partition, journal, tags): key for journal, (key, tags) in zip(journals, partitions)}
+        for future in futures:
+            try:
+                partition_success, partition_missed, partition_expanded = future.result()
+            except Exception as exc:
+                logger.error('Partition {} of {} generated an exception: {!r}'.format(futures[future], fullpath, exc))
+                success = False
+            else:
+                success = success and partition_success
+                missed_object_ids.update(partition_missed)
+                for pattern, object_ids in partition_expanded.items():
+                    expanded_ids.setdefault(pattern, set()).update(object_ids)
+    return success, sorted(missed_object_ids), expanded_ids, journals
+
+def process_tag_file(args, fullpath, nxql, all_engines, logger, rundate, routing=None, report_path=None, run_metrics=None):
+    """Tag the objects of a tag file and rename it once completed
+
+    The timing report of the file is written to report_path (if any) and added to run_metrics (if any).
+    """
+    # Open and process each file
+    print('Processing: {}...'.format(fullpath))
+    logger.info("###### Starts tagging file => " + fullpath + " ######")
+    metrics = RunMetrics(os.path.basename(fullpath), rundate)
+    journals = []
+    success = False
+    missed_object_ids, expanded_ids = [], {}
+    try:
+        if args.mixed:
+            success, missed_object_ids, expanded_ids, journals = tag_mixed_file(args, fullpath, nxql, all_engines, logger, rundate,
+                                                                  routing=routing, metrics=metrics)
+        else:
+            journals = [TagJournal('{}.journal'.format(fullpath), rundate, args.resume, logger)]
+            success, missed_object_ids, expanded_ids = tag_device(args.query_file, fullpath, nxql, all_engines, logger,
+                                                                  diff=args.diff, routing=routing, journal=journals[0],
+                                                                  metrics=metrics)
+        metrics.add_counter("objects_missed", len(missed_object_ids))
+    except functions.TagFileError as ex:
+        # The rows are all read before the first request: nothing was sent for this file
+        logger.error(str(ex))
+    finally:
+        for journal in journals:
+            journal.close()
+        metrics.add_counter("files_succeeded" if success else "files_failed")
+        if run_metrics is not None:
+            run_metrics.merge(metrics)
+        if report_path is not None:
+            write_report(metrics, '{}{}.{}.report.json'.format(report_path, os.path.basename(fullpath), rundate),
+                         logger, success=success)
+    logger.info("###### Ends tagging file => " + fullpath + " ######")
+    if nxql.planner:
+        nxql.planner.save()
+    # Write the missed_object_ids to a similarly named file
+    if missed_object_ids and len(missed_object_ids) > 0:
+        missed_path = '{}.{}.missing'.format(fullpath, rundate)
+        with open(missed_path, "w") as missed:
+            for id in missed_object_ids:
+                missed.write(id + '\r\n')
+        logger.info('Wrote {} object idntiefiers that were not found to: {}'.format(len(missed_object_ids), missed_path))
+    # Write the objects each wildcard pattern expanded to (one "pattern<tab>object id" line per object)
+    if expanded_ids:
+        expanded_path = '{}.{}.expanded'.format(fullpath, rundate)
+        with open(expanded_path, "w") as expanded:
+            for pattern, object_ids in sorted(expanded_ids.items()):
+                for id in sorted(object_ids):
+                    expanded.write('{}\t{}\r\n'.format(pattern, id))
+        logger.info('Wrote the objects of {} wildcard patterns to: {}'.format(len(expanded_ids), expanded_path))
+    # Rename the file (and its journals: <file>.<rundate>[.<partition>].journal) once completed
+    for journal in journals:
+        if os.path.exists(journal.path):
+            os.rename(journal.path, '{}.{}{}'.format(fullpath, rundate, journal.path[len(fullpath):]))
+    if success:
+        new_name = '{}.{}.success'.format(fullpath, rundate)
+        os.rename(fullpath, new_name)
+        logger.info("###### Renaming successfully complete tagging file => " + new_name + " ######")
+        print('Processing completed successfuly: {}'.format(new_name))
+    else:
+        new_name = '{}.{}.failed'.format(fullpath, rundate)
+        os.rename(fullpath, new_name)
+        logger.error("###### Renaming unsuccessful (errors occurred) tagging file => " + new_name + " ######")
+        print('Processing completed with errors: {}'.format(new_name))
+
+def write_report(metrics, report_name, logger, **extra):
+    """Write a timing report, logging the errors (a report is not worth failing the run)"""
+    try:
+        metrics.write_report(report_name, **extra)
+        logger.info('Wrote the timing report to: {}'.format(report_name))
+    except (OSError, TypeError, ValueError) as ex:
+        logger.error('Unable to write the timing report {}: {!r}'.format(report_name, ex))
+
+def process_tag_files(args, csv_files, nxql, all_engines, logger, rundate, routing=None, report_path=None, exporter=None):
+    """Tag the objects of a list of tag files
+
+    The timing reports of the files and of the run are written to report_path (if any),
+    the metrics of the run to the Prometheus textfile of exporter (if any).
+    """
+    run_metrics = RunMetrics('run', rundate)
+    try:
+        if args.parallel_files > 1 and not args.mixed:
+            # Files of different Categories run at the same time, each with its own NXQL object,
+            # within the request budget of the web session (mixed files share Categories: they
+            # run one after another, each running its own partitions at the same time)
+            scheduler = FileScheduler(args.parallel_files, logger)
+            scheduler.run(csv_files, lambda fullpath: process_tag_file(args, fullpath, nxql.copy(), all_engines,
+                                                                       logger, rundate, routing, report_path, run_metrics))
+        else:
+            for fullpath in csv_files:
+                process_tag_file(args, fullpath, nxql, all_engines, logger, rundate, routing, report_path, run_metrics)
+    finally:
+        if report_path is not None:
+            write_report(run_metrics, '{}run.{}.report.json'.format(report_path, rundate), logger,
+                         files=[os.path.basename(fullpath) for fullpath in csv_files])
+        if exporter is not None:
+            exporter.write(run_metrics)
+
+def refresh_engines(portal, all_engines, logger):
+    """Get the list of connected Engines again, keeping the current one if the Portal cannot give it"""
+    try:
+        return portal.get_engines_list()
+    except SystemExit:
+        logger.warning('Unable to refresh the list of Engines - keeping the {} known Engines'.format(len(all_engines)))
+        return all_engines
+
+def watch_tags_directory(args, tags_path, portal, nxql, all_engines, logger, routing=None, report_path=None, exporter=None):
+    """Tag the files written to the tags directory as soon as they are complete, until stopped (SIGTERM or Ctrl-C)
+
+    The web sessions, the NXQL object and the list of Engines are kept between
+    the files; the list of Engines is refreshed once older than engine_cache_ttl.
+    """
+    watcher = TagDirectoryWatcher(tags_path, logger, poll_interval=args.watch_interval, settle_time=args.settle_time)
+    signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+    watcher.start()
+    logger.info('Waiting for tag files in {}...'.format(tags_path))
+    try:
+        while True:
+            csv_files = watcher.wait_for_files()
+            if not csv_files:
+                break
+            all_engines = refresh_engines(portal, all_engines, logger)
+            rundate = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+            try:
+                process_tag_files(args, csv_files, nxql, all_engines, logger, rundate, routing, report_path, exporter)
+            except (Exception, SystemExit) as exc:
+                # The files left in place are not processed again until they are replaced
+                logger.error('Processing of {} stopped: {!r}'.format(csv_files, exc))
+            # The objects of the Engines may have changed by the next files
+            if nxql.snapshot_cache is not None:
+                nxql.snapshot_cache.invalidate()
+    except KeyboardInterrupt:
+        logger.info('Interrupted')
+    finally:
+        watcher.close()
+    logger.info('Stopped watching {}'.format(tags_path))
 
 def main():
 
@@ -121,6 +421,84 @@ def main():
     parser.add_argument("config_file", help="xml file containing the configuration parameters")
     parser.add_argument("query_file", help="xml file in which the queries are located")
     parser.add_argument("-v", "--verbose", help="increase output verbosity", action="store_true")
+    parser.add_argument("--trace-sample", help="with -v, log one in N of the per object trace messages (default: 1, all of them; 0 for none)",
+                        metavar="N", type=int, default=1)
+    parser.add_argument("-b", "--batch-size", help="maximum number of objects per update query (default: 1)",
+                        type=int, default=1)
+    parser.add_argument("--max-query-length", help="maximum length of a batched update query (default: 4000)",
+                        type=int, default=4000)
+    parser.add_argument("-d", "--diff", help="only update the objects whose keyword changed instead of cleaning the Category",
+                        action="store_true")
+    parser.add_argument("--clear-timeout", help="maximum seconds to wait for an Engine to clean a Category (default: 30)",
+                        type=int, default=30)
+    parser.add_argument("--transport", help="how the Engines are queried (default: threads)",
+                        choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--max-requests", help="maximum number of requests running at the same time on all Engines (default: 40)",
+                        type=int, default=40)
+    parser.add_argument("--max-engine-requests", help="maximum number of update requests running at the same time on one Engine (default: 4)",
+                        type=int, default=4)
+    parser.add_argument("--adaptive-concurrency", help="adapt the number of update requests running on each Engine to its latency, starting from --max-engine-requests",
+                        action="store_true")
+    parser.add_argument("--engine-requests-floor", help="minimum number of update requests running on one Engine with --adaptive-concurrency (default: 1)",
+                        type=int, default=1)
+    parser.add_argument("--engine-requests-ceiling", help="maximum number of update requests running on one Engine with --adaptive-concurrency (default: 32)",
+                        type=int, default=32)
+    parser.add_argument("--update-workers", help="number of threads sending the updates of all Engines (default: 40)",
+                        type=int, default=40)
+    parser.add_argument("--max-retries", help="maximum number of retries of a request failing with a transient error (default: 3)",
+                        type=int, default=3)
+    parser.add_argument("--retry-delay", help="backoff in seconds before the first retry, doubled for each next one (default: 0.5)",
+                        type=float, default=0.5)
+    parser.add_argument("--connect-timeout", help="seconds to wait for the connection to an Engine, retried on expiry (default: 10)",
+                        type=float, default=10)
+    parser.add_argument("--read-timeout", help="seconds to wait for data from an Engine, retried on expiry (default: 120)",
+                        type=float, default=120)
+    parser.add_argument("--breaker-threshold", help="number of failures in a row after which an Engine is parked, 0 to never park (default: 5)",
+                        type=int, default=5)
+    parser.add_argument("--breaker-reset", help="seconds after which a parked Engine is tried again (default: 30)",
+                        type=float, default=30)
+    parser.add_argument("--id-format", help="format of the id query responses (default: json)",
+                        choices=["json", "csv"], default="json")
+    parser.add_argument("--stream-ids", help="parse the id query responses chunk by chunk to limit memory usage",
+                        action="store_true")
+    parser.add_argument("--routing-index", help="send the tags straight to the Engine they were last seen on",
+                        action="store_true")
+    parser.add_argument("--routing-refresh", help="hours after which the ids are scanned on all Engines again (default: 24)",
+                        type=float, default=24)
+    parser.add_argument("--query-planner", help="choose per Engine between a full id scan and targeted id lookups",
+                        action="store_true")
+    parser.add_argument("--lookup-chunk-size", help="maximum number of ids in a targeted lookup query (default: 100)",
+                        type=int, default=100)
+    parser.add_argument("--no-snapshot-cache", help="download the ids of the Engines again for each file of the run",
+                        action="store_true")
+    parser.add_argument("--parallel-files", help="maximum number of tag files of different Categories processed at the same time (default: 1)",
+                        type=int, default=1)
+    parser.add_argument("--mixed", help="tag files mixing several Object Types and Categories: the rows of each file are partitioned on (Object Type, Category) and the partitions run at the same time",
+                        action="store_true")
+    parser.add_argument("--parallel-partitions", help="with --mixed, maximum number of partitions of a file processed at the same time (default: 8)",
+                        type=int, default=8)
+    parser.add_argument("--resume", help="continue the files of an interrupted run from their journal instead of starting over",
+                        action="store_true")
+    parser.add_argument("--watch", help="keep running and tag the files as soon as they are written to the tags directory",
+                        action="store_true")
+    parser.add_argument("--watch-interval", help="seconds between two scans of the tags directory when inotify is not available (default: 5)",
+                        type=float, default=5)
+    parser.add_argument("--settle-time", help="seconds a tag file must stay unchanged before it is processed in watch mode (default: 2)",
+                        type=float, default=2)
+    parser.add_argument("--engine-cache-ttl", help="seconds during which the cached list of Engines is used without asking the Portal (default: 900)",
+                        type=float, default=900)
+    parser.add_argument("--prometheus-textfile", help="write the metrics of each run to this .prom file for the node exporter textfile collector",
+                        default=None)
+    parser.add_argument("--profile", help="profile the run with cProfile (pstats file), stack sampling (collapsed stacks file) or both (default), next to the logs",
+                        nargs="?", choices=["cprofile", "sample", "both"], const="both", default=None)
+    parser.add_argument("--profile-interval", help="seconds between two samples of the thread stacks with --profile sample (default: 0.01)",
+                        type=float, default=0.01)
+    parser.add_argument("--engine-url-template", help="url of the query endpoint of an Engine, {} being the Engine address (default: https://{}:1671/2/query)",
+                        default="https://{}:1671/2/query")
+    parser.add_argument("--pool-size", help="maximum number of pooled connections per Engine, at least the per Engine request limit (default: 10)",
+                        type=int, default=10)
+    parser.add_argument("--no-keep-alive", help="close the Engine connections after each request",
+                        action="store_true")
     args = parser.parse_args()
 
     # Get tag file and log file path from the configuration file
@@ -136,7 +514,13 @@ def main():
     handler = RotatingFileHandler(log_name, maxBytes=100000000, backupCount=5)
     formatter = logging.Formatter('%(asctime)s - %(levelname)-8s %(message)s', '%Y-%m-%d %H:%M:%S')
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    # The records are written to the file by a background thread, so the
+    # workers never wait on the disk (nor on the rotation of the log file)
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.addHandler(QueueHandler(log_queue))
 
     # Set log level to debug if argument passed
     if args.verbose:
@@ -154,52 +538,109 @@ def main():
     portal_fqdn, portal_port = functions.get_portal(args.config_file, logger)
 
     # create a session object
-    websession = WebSession(portal_credentials)
+    # The pool of an Engine must hold the requests the concurrency limit lets run on it
+    pool_size = max(args.pool_size, args.max_engine_requests)
+    if args.adaptive_concurrency:
+        pool_size = max(pool_size, args.engine_requests_ceiling)
+    # (a request waiting longer than a whole request for a pooled connection gives up on it)
+    websession = WebSession(portal_credentials, pool_size=pool_size, keep_alive=not args.no_keep_alive,
+                            max_requests=args.max_requests, pool_timeout=args.connect_timeout + args.read_timeout)
     session = websession.create_session()
 
     # Create a Portal Object for making API Call (Portal)
-    portal = Appliance(portal_fqdn,"Portal", portal_port, portal_credentials, session, logger)
+    # (the last list of Engines is cached next to the logs)
+    portal = Appliance(portal_fqdn,"Portal", portal_port, portal_credentials, session, logger,
+                       cache_path='{}engines-cache.json'.format(log_path), cache_ttl=args.engine_cache_ttl)
 
     # Create NXQL object (passing the logger)
     nxql = Nxql(websession, logger)
+    nxql.batch_size = args.batch_size
+    nxql.max_query_length = args.max_query_length
+    nxql.clear_timeout = args.clear_timeout
+    nxql.connect_timeout = args.connect_timeout
+    nxql.read_timeout = args.read_timeout
+    nxql.transport = args.transport
+    nxql.max_workers = args.max_requests
+    nxql.max_engine_requests = args.max_engine_requests
+    nxql.update_workers = args.update_workers
+    nxql.id_format = args.id_format
+    nxql.stream_ids = args.stream_ids
+    nxql.engine_url_template = args.engine_url_template
+    nxql.trace_sample = args.trace_sample
+    nxql.retry_policy = RetryPolicy(max_retries=args.max_retries, base_delay=args.retry_delay)
+    if args.breaker_threshold > 0:
+        nxql.breaker = CircuitBreaker(failure_threshold=args.breaker_threshold, reset_timeout=args.breaker_reset)
+    if args.adaptive_concurrency:
+        nxql.limiter = AdaptiveLimiter(args.max_engine_requests, args.engine_requests_floor, args.engine_requests_ceiling, logger)
     
-    # Get list of connected engines (via API call)
-    all_engines = portal.get_engines_list()
-    if all_engines:
-
-        # We check if the tag directory contains tags csv files
-        csv_files = glob.glob(os.path.join(tags_path, '*.csv')) 
-        if not csv_files:
-            logger.error('Tags directory ({}) contains no .csv files to process'.format(tags_path))
-        else:
-            for fullpath in csv_files:
-                # Open and process each file
-                print('Processing: {}...'.format(fullpath))
-                logger.info("###### Starts tagging file => " + fullpath + " ######")
-                success, missed_object_ids = tag_device(args.query_file, fullpath, nxql, all_engines, logger)
-                logger.info("###### Ends tagging file => " + fullpath + " ######")
-                # Write the missed_object_ids to a similarly named file
-                if missed_object_ids and len(missed_object_ids) > 0:
-                    missed_path = '{}.{}.missing'.format(fullpath, rundate)
-                    with open(missed_path, "w") as missed:
-                        for id in missed_object_ids:
-                            missed.write(id + '\r\n')
-                    logger.info('Wrote {} object idntiefiers that were not found to: {}'.format(len(missed_object_ids), missed_path))
-                # Rename the file once completed
-                if success:
-                    new_name = '{}.{}.success'.format(fullpath, rundate)
-                    os.rename(fullpath, new_name)
-                    logger.info("###### Renaming successfully complete tagging file => " + new_name + " ######")
-                    print('Processing completed successfuly: {}'.format(new_name))
-                else:
-                    new_name = '{}.{}.failed'.format(fullpath, rundate)
-                    os.rename(fullpath, new_name)
-                    logger.error("###### Renaming unsuccessful (errors occurred) tagging file => " + new_name + " ######")
-                    print('Processing completed with errors: {}'.format(new_name))
+    # Share the id scans of the Engines between the files of the run
+    if not args.no_snapshot_cache:
+        nxql.snapshot_cache = SnapshotCache(logger)
+
+    # Open the routing index stored next to the logs
+    routing = None
+    if args.routing_index:
+        routing = RoutingIndex('{}routing-index.sqlite'.format(log_path), args.routing_refresh * 3600, logger)
+
+    # Load the Engine statistics of the query planner stored next to the logs
+    if args.query_planner:
+        nxql.planner = QueryPlanner('{}engine-stats.json'.format(log_path), logger)
+        nxql.lookup_chunk_size = args.lookup_chunk_size
+
+    # Export the metrics of the runs to the node exporter textfile collector
+    exporter = None
+    if args.prometheus_textfile:
+        exporter = PrometheusTextfile(args.prometheus_textfile, logger)
+
+    # Profile the run (main thread and workers) into files next to the logs
+    profiler = None
+    if args.profile:
+        profiler = RunProfiler('{}{}.{}.profile'.format(log_path, app_name, rundate), logger,
+                               cprofile=args.profile in ("cprofile", "both"), sample=args.profile in ("sample", "both"),
+                               interval=args.profile_interval)
+        profiler.start()
+
+    # The updates of all the files of the run are spread over one shared set of workers
+    # (started after the profiler so that it sees them)
+    if args.transport == 'threads':
+        nxql.scheduler = UpdateScheduler(args.update_workers, args.max_engine_requests, logger, nxql.limiter)
+        nxql.scheduler.start()
+
+    try:
+        # Get list of connected engines (via API call)
+        all_engines = portal.get_engines_list()
+        if all_engines and args.watch:
+            watch_tags_directory(args, tags_path, portal, nxql, all_engines, logger, routing, log_path, exporter)
+        elif all_engines:
+
+            # We check if the tag directory contains tags csv files
+            csv_files = glob.glob(os.path.join(tags_path, '*.csv')) 
+            if not csv_files:
+                logger.error('Tags directory ({}) contains no .csv files to process'.format(tags_path))
+            else:
+                # The timing reports are written next to the logs
+                process_tag_files(args, csv_files, nxql, all_engines, logger, rundate, routing, log_path, exporter)
 
-    else:
-        logger.error("No Engines found - Exiting Program")
-        raise SystemExit()
+        else:
+            logger.error("No Engines found - Exiting Program")
+            raise SystemExit()
+    finally:
+        if nxql.scheduler is not None:
+            nxql.scheduler.stop()
+        if profiler is not None:
+            profiler.stop()
+            profiler.write()
+
+    # Put the connection reuse into the log
+    pool_stats = websession.get_pool_stats()
+    logger.info('Engine connections: {requests} requests, {handshakes} handshakes, {reused} reused connections'.format(**pool_stats))
+    websession.close()
+    if nxql.limiter is not None:
+        logger.info('Engine concurrency limits: {}'.format(nxql.limiter.get_stats()))
+    if nxql.snapshot_cache is not None:
+        logger.info('Engine id snapshots: {hits} reused, {misses} downloaded'.format(**nxql.snapshot_cache.get_stats()))
+    if routing is not None:
+        routing.close()
 
     logger.info("====== Script execution completed ======")
 
@@ -0,0 +1,90 @@
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+# The modules of the tagger are imported from the root of the repository (and the mock Engines from the benchmarks)
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("tests")
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    """Answer {} after the delay (in seconds) given in the delay parameter of the query string
+    (with the status given in the status parameter, 200 by default)"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        time.sleep(float(params.get("delay", ["0"])[0]))
+        body = b"{}"
+        self.send_response(int(params.get("status", ["200"])[0]))
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    """Local http server, yields its base url"""
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}/".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def get_free_ports(count):
+    """Get a base port followed by count - 1 ports that are free on the loopback interface"""
+
+    while True:
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            base_port = probe.getsockname()[1]
+        if base_port + count > 65535:
+            continue
+        try:
+            for port in range(base_port, base_port + count):
+                with socket.socket() as probe:
+                    probe.bind(("127.0.0.1", port))
+        except OSError:
+            continue
+        return base_port
+
+
+@pytest.fixture
+def mock_nexthink():
+    """Start mock Engines on local ports: call with the MockEngine list, get the MockNexthink"""
+
+    from mock_nexthink import MockNexthink
+
+    started = []
+
+    def start(engines):
+        base_port = get_free_ports(len(engines) + 1)
+        mock = MockNexthink(engines, base_port=base_port + 1, portal_port=base_port)
+        mock.start()
+        started.append(mock)
+        return mock
+
+    yield start
+    for mock in started:
+        mock.stop()
@@ -0,0 +1,103 @@
+import json
+import threading
+import time
+
+import pytest
+import requests
+
+from classes.appliance import Appliance
+
+ENGINES = [{"address": "e1", "status": "CONNECTED"}, {"address": "e2", "status": "DISCONNECTED"}]
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code=200, body=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._body = body
+
+    def json(self):
+        return self._body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError("{} error".format(self.status_code))
+
+
+class FakeSession(object):
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.headers = []
+        self.started = threading.Event()
+        self.release = None
+
+    def get(self, url, headers=None, **kwargs):
+        self.headers.append(headers)
+        self.started.set()
+        if self.release is not None:
+            self.release.wait()
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def make_appliance(logger, session, tmp_path, cache=None, cache_ttl=0):
+    cache_path = str(tmp_path / "engines.json")
+    if cache is not None:
+        with open(cache_path, "w") as cache_file:
+            json.dump(cache, cache_file)
+    return Appliance("portal", "Portal", 443, "", session, logger, cache_path=cache_path, cache_ttl=cache_ttl)
+
+
+def test_engines_are_read_from_the_api_and_cached(logger, tmp_path):
+    session = FakeSession(FakeResponse(body=ENGINES, headers={"ETag": "v1"}))
+    appliance = make_appliance(logger, session, tmp_path)
+    assert appliance.get_engines_list() == ["e1"]
+    with open(str(tmp_path / "engines.json")) as cache_file:
+        cache = json.load(cache_file)
+    assert cache["engines"] == ENGINES and cache["etag"] == "v1"
+
+
+def test_recent_cache_skips_the_api(logger, tmp_path):
+    session = FakeSession()
+    appliance = make_appliance(logger, session, tmp_path, {"time": time.time(), "engines": ENGINES}, cache_ttl=60)
+    assert appliance.get_engines_list() == ["e1"]
+    assert session.headers == []
+
+
+def test_not_modified_keeps_the_cache(logger, tmp_path):
+    session = FakeSession(FakeResponse(status_code=304))
+    appliance = make_appliance(logger, session, tmp_path, {"time": 0, "etag": "v1", "engines": ENGINES})
+    assert appliance.get_engines_list() == ["e1"]
+    assert session.headers == [{"If-None-Match": "v1"}]
+
+
+@pytest.mark.parametrize("failure", [FakeResponse(status_code=500), requests.exceptions.SSLError("bad certificate"),
+                                     requests.exceptions.ConnectionError("refused")])
+def test_api_failure_falls_back_on_the_cache(logger, tmp_path, failure):
+    appliance = make_appliance(logger, FakeSession(failure), tmp_path, {"time": 0, "engines": ENGINES})
+    assert appliance.get_engines_list() == ["e1"]
+
+
+@pytest.mark.parametrize("failure", [FakeResponse(status_code=500), requests.exceptions.SSLError("bad certificate")])
+def test_api_failure_without_cache_stops(logger, tmp_path, failure):
+    appliance = make_appliance(logger, FakeSession(failure), tmp_path)
+    with pytest.raises(SystemExit):
+        appliance.get_engines_list()
+
+
+def test_stale_cache_is_refreshed_in_a_daemon_thread(logger, tmp_path):
+    session = FakeSession(FakeResponse(body=[{"address": "e3", "status": "CONNECTED"}]))
+    session.release = threading.Event()
+    appliance = make_appliance(logger, session, tmp_path, {"time": time.time() - 120, "engines": ENGINES},
+                               cache_ttl=60)
+    # The stale list is used while the Portal is asked in the background
+    assert appliance.get_engines_list() == ["e1"]
+    assert session.started.wait(5)
+    assert appliance._refresh_thread.daemon
+    session.release.set()
+    appliance._refresh_thread.join(5)
+    assert appliance.get_engines_list() == ["e3"]
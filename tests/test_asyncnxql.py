@@ -0,0 +1,210 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+import types
+
+import pytest
+
+from classes.nxql import Nxql
+from classes.retry import EngineUnavailableError, RetryPolicy
+
+aiohttp = pytest.importorskip("aiohttp")
+
+from classes.asyncnxql import AsyncNxql  # noqa: E402
+
+
+class FakeResponse(object):
+
+    def __init__(self, url, status=200, body=b""):
+        self.status = status
+        self.headers = {}
+        self.request_info = types.SimpleNamespace(url=url)
+        self.content = types.SimpleNamespace(total_bytes=len(body))
+        self._body = body
+
+    async def read(self):
+        return self._body
+
+
+class FakeRequest(object):
+
+    def __init__(self, session, url):
+        self._session = session
+        self._url = url
+
+    async def __aenter__(self):
+        self._session.started.append(self._url)
+        outcome = self._session.outcomes.get(self._url)
+        if outcome:
+            failure = outcome.pop(0)
+            if failure is not None:
+                raise failure
+        await asyncio.sleep(self._session.delays.get(self._url, 0))
+        self._session.finished.append(self._url)
+        return FakeResponse(self._url)
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeSession(object):
+    """aiohttp session answering 200 after a delay per url (or raising the queued failures first)"""
+
+    def __init__(self, delays=None, outcomes=None):
+        self.delays = delays or {}
+        self.outcomes = outcomes or {}
+        self.started = []
+        self.finished = []
+        self.kwargs = []
+
+    def get(self, url, **kwargs):
+        self.kwargs.append(kwargs)
+        return FakeRequest(self, url)
+
+
+def make_async_nxql(logger, urls, session, max_workers=2, max_engine_requests=1, budget=None):
+    websession = types.SimpleNamespace(request_budget=budget)
+    nxql = Nxql(websession, logger)
+    nxql.urls = urls
+    nxql.max_workers = max_workers
+    nxql.max_engine_requests = max_engine_requests
+    async_nxql = AsyncNxql(nxql)
+    async_nxql._global_limit = asyncio.Semaphore(max_workers)
+    async_nxql._engine_conditions = {url: asyncio.Condition() for url in urls}
+    async_nxql._in_flight = {url: 0 for url in urls}
+    async_nxql._session = session
+    async_nxql._budget_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    return async_nxql
+
+
+def test_busy_engine_does_not_starve_the_others(logger):
+    session = FakeSession(delays={"slow": 0.02, "fast": 0})
+
+    async def run():
+        async_nxql = make_async_nxql(logger, ["slow", "fast"], session)
+        await asyncio.gather(*[async_nxql._get("slow", {}) for _ in range(10)], async_nxql._get("fast", {}))
+
+    asyncio.run(run())
+    # The queued requests of the slow Engine wait on their Engine slot, not on the global slots
+    assert session.finished.index("fast") <= 1
+
+
+def test_timeout_is_retried(logger):
+    session = FakeSession(outcomes={"engine": [asyncio.TimeoutError(), aiohttp.ServerTimeoutError()]})
+
+    async def run():
+        async_nxql = make_async_nxql(logger, ["engine"], session)
+        async_nxql.nxql.retry_policy = RetryPolicy(max_retries=3, base_delay=0)
+        result = {"num_retries": 0, "num_breaker_changes": 0}
+        status, body = await async_nxql._get("engine", {}, result)
+        return status, result
+
+    status, result = asyncio.run(run())
+    assert status == 200
+    assert result["num_retries"] == 2
+    assert session.started == ["engine"] * 3
+
+
+def test_timeout_gives_up_after_the_retries(logger):
+    session = FakeSession(outcomes={"engine": [asyncio.TimeoutError()] * 2})
+
+    async def run():
+        async_nxql = make_async_nxql(logger, ["engine"], session)
+        async_nxql.nxql.retry_policy = RetryPolicy(max_retries=1, base_delay=0)
+        await async_nxql._get("engine", {})
+
+    with pytest.raises(EngineUnavailableError):
+        asyncio.run(run())
+
+
+class RecordingLimiter(object):
+
+    max_limit = 1
+
+    def __init__(self):
+        self.samples = []
+
+    def get_limit(self, engine):
+        return 2
+
+    def record(self, engine, latency, exec_time=None, failed=False):
+        self.samples.append(latency)
+
+
+def test_limiter_latency_excludes_the_connection_wait(logger, http_server):
+    limiter = RecordingLimiter()
+
+    async def run():
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(AsyncNxql._on_connection)
+        trace_config.on_connection_reuseconn.append(AsyncNxql._on_connection)
+        # One connection for two requests let through by the limiter: the second one waits for it
+        connector = aiohttp.TCPConnector(limit_per_host=1)
+        async with aiohttp.ClientSession(connector=connector, trace_configs=[trace_config]) as session:
+            async_nxql = make_async_nxql(logger, [http_server], session, max_engine_requests=2)
+            async_nxql.nxql.limiter = limiter
+            await asyncio.gather(*[async_nxql._get(http_server, {"delay": "0.3"}, sample_latency=True)
+                                   for _ in range(2)])
+
+    asyncio.run(run())
+    assert len(limiter.samples) == 2
+    assert all(sample < 0.5 for sample in limiter.samples)
+
+
+def test_budget_wait_does_not_block_the_event_loop(logger):
+    # The budget is shared with another thread that holds its only slot for a while
+    budget = threading.BoundedSemaphore(1)
+    budget.acquire()
+    threading.Timer(0.2, budget.release).start()
+    session = FakeSession()
+    ticks = []
+
+    async def tick():
+        start = time.monotonic()
+        while time.monotonic() - start < 0.15:
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.01)
+
+    async def run():
+        async_nxql = make_async_nxql(logger, ["engine"], session, budget=budget)
+        status, body = (await asyncio.gather(async_nxql._get("engine", {}), tick()))[0]
+        return status
+
+    assert asyncio.run(run()) == 200
+    assert len(ticks) > 5
+    # The slot was given back after the request
+    assert budget.acquire(blocking=False)
+
+
+def test_cancelled_budget_wait_gives_the_slot_back(logger):
+    budget = threading.BoundedSemaphore(1)
+    budget.acquire()
+
+    async def run():
+        async_nxql = make_async_nxql(logger, ["engine"], FakeSession(), budget=budget)
+        task = asyncio.ensure_future(async_nxql._acquire_budget())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # The waiting thread gets the slot and gives it back
+        budget.release()
+        async_nxql._budget_executor.shutdown(wait=True)
+
+    asyncio.run(run())
+    assert budget.acquire(blocking=False)
+
+
+def test_client_error_marks_the_engine_unavailable(logger, monkeypatch):
+    async def fail(self, url, result):
+        raise aiohttp.ClientPayloadError("truncated id response")
+
+    monkeypatch.setattr(AsyncNxql, "_process_engine_object", fail)
+
+    async def run():
+        async_nxql = make_async_nxql(logger, ["engine"], FakeSession())
+        return await async_nxql.process_engine_object("engine")
+
+    result = asyncio.run(run())
+    assert result["url"] == "engine" and not result["available"]
@@ -0,0 +1,48 @@
+import os
+import threading
+
+from classes.filescheduler import FileScheduler
+
+HEADER = "Object Type,Object ID,Category,Keyword\n"
+
+
+def write_file(tmp_path, name, rows, mtime):
+    path = tmp_path / name
+    path.write_text(HEADER + rows)
+    os.utime(path, (mtime, mtime))
+    return str(path)
+
+
+def test_files_are_grouped_on_their_category(tmp_path, logger):
+    old_vip = write_file(tmp_path, "a.csv", "device,PC1,VIP,Gold\n", 100)
+    team = write_file(tmp_path, "b.csv", "device,PC1,Team,Blue\n", 200)
+    new_vip = write_file(tmp_path, "c.csv", "device,PC2,VIP,Gold\n", 300)
+    user_vip = write_file(tmp_path, "d.csv", "user,bob,VIP,Gold\n", 400)
+    groups = FileScheduler(2, logger).group_files([user_vip, new_vip, team, old_vip])
+    assert groups == [[old_vip, new_vip], [team], [user_vip]]
+
+
+def test_invalid_file_is_a_group_of_its_own(tmp_path, logger):
+    first = write_file(tmp_path, "a.csv", "", 100)
+    second = write_file(tmp_path, "b.csv", "", 200)
+    assert FileScheduler(2, logger).group_files([first, second]) == [[first], [second]]
+
+
+def test_groups_run_at_the_same_time_and_files_in_order(tmp_path, logger):
+    first = write_file(tmp_path, "a.csv", "device,PC1,VIP,Gold\n", 100)
+    second = write_file(tmp_path, "b.csv", "device,PC2,VIP,Gold\n", 200)
+    other = write_file(tmp_path, "c.csv", "device,PC1,Team,Blue\n", 300)
+    barrier = threading.Barrier(2, timeout=5)
+    processed = []
+
+    def process(file_name):
+        if file_name in (first, other):
+            # Only returns if the two groups run at the same time
+            barrier.wait()
+        if file_name == first:
+            raise ValueError("failed")
+        processed.append(file_name)
+
+    FileScheduler(2, logger).run([second, other, first], process)
+    # The failure of a file does not stop its group
+    assert sorted(processed) == sorted([second, other])
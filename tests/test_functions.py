@@ -0,0 +1,56 @@
+import pytest
+
+from classes import functions
+
+HEADER = "Object Type,Object ID,Category,Keyword\n"
+
+
+def write_tags(tmp_path, text):
+    path = tmp_path / "tags.csv"
+    path.write_text(text)
+    return str(path)
+
+
+def read_tags(file_name, mixed=False):
+    return [(tag.object_type, tag.object_id, tag.category, tag.keyword)
+            for tag in functions.stream_csv_file(file_name, mixed)]
+
+
+def test_rows_are_streamed(tmp_path):
+    file_name = write_tags(tmp_path, HEADER + "device,PC1,VIP,Gold\n\ndevice,PC2,VIP,\n")
+    assert read_tags(file_name) == [("device", "PC1", "VIP", "Gold"), ("device", "PC2", "VIP", "")]
+
+
+def test_columns_in_any_order(tmp_path):
+    file_name = write_tags(tmp_path, "Keyword,Category,Object ID,Object Type\nGold,VIP,PC1,device\n")
+    assert read_tags(file_name) == [("device", "PC1", "VIP", "Gold")]
+
+
+def test_mismatched_row_raises(tmp_path):
+    file_name = write_tags(tmp_path, HEADER + "device,PC1,VIP,Gold\nuser,bob,VIP,Gold\n")
+    tags = functions.stream_csv_file(file_name)
+    assert next(tags).object_id == "PC1"
+    with pytest.raises(functions.TagFileError, match="Line 3"):
+        next(tags)
+
+
+def test_mismatched_rows_allowed_in_mixed_files(tmp_path):
+    file_name = write_tags(tmp_path, HEADER + "device,PC1,VIP,Gold\nuser,bob,Team,Blue\n")
+    assert read_tags(file_name, mixed=True) == [("device", "PC1", "VIP", "Gold"), ("user", "bob", "Team", "Blue")]
+
+
+def test_short_row_raises(tmp_path):
+    file_name = write_tags(tmp_path, HEADER + "device,PC1,VIP,Gold\ndevice,PC2\n")
+    with pytest.raises(functions.TagFileError, match="Line 3: 2 columns instead of 4"):
+        list(functions.stream_csv_file(file_name))
+
+
+@pytest.mark.parametrize("text", ["", HEADER, "Object Type,Object ID,Category\ndevice,PC1,VIP\n"])
+def test_invalid_file_raises(tmp_path, text):
+    with pytest.raises(functions.TagFileError):
+        list(functions.stream_csv_file(write_tags(tmp_path, text)))
+
+
+def test_missing_file_raises(tmp_path):
+    with pytest.raises(functions.TagFileError):
+        list(functions.stream_csv_file(str(tmp_path / "missing.csv")))
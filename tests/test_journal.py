@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+from classes.journal import TagJournal
+
+
+@pytest.fixture
+def tag_file(tmp_path):
+    path = tmp_path / "tags.csv"
+    path.write_text("Object Type,Object ID,Category,Keyword\ndevice,PC1,VIP,Gold\n")
+    return str(path)
+
+
+def interrupted_run(tag_file, logger):
+    journal = TagJournal(tag_file + ".journal", "R1", False, logger)
+    journal.open(tag_file, "clear", "VIP", "device")
+    journal.record_cleared("e1")
+    journal.record_cleared("e2")
+    journal.record_applied("e1", ["pc1", "pc2"])
+    journal.record_done("e1")
+    journal.record_applied("e2", ["pc3"])
+    journal.close()
+    return journal.path
+
+
+def read_records(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file]
+
+
+def test_resume_continues_from_the_records(tag_file, logger):
+    path = interrupted_run(tag_file, logger)
+    journal = TagJournal(path, "R2", True, logger)
+    journal.open(tag_file, "clear", "VIP", "device")
+    assert journal.is_done("e1") and not journal.is_done("e2")
+    assert journal.is_cleared("e2")
+    assert journal.get_applied("e2") == {"pc3"}
+    assert journal.get_applied("e3") == set()
+    journal.close()
+    assert read_records(path)[-1] == {"event": "resume", "run": "R2"}
+
+
+def test_cut_record_is_truncated(tag_file, logger):
+    path = interrupted_run(tag_file, logger)
+    with open(path, "a") as file:
+        file.write('{"event": "applied", "engine": "e2", "ids": ["pc')
+    journal = TagJournal(path, "R2", True, logger)
+    journal.open(tag_file, "clear", "VIP", "device")
+    journal.record_applied("e2", ["pc4"])
+    journal.close()
+    # The next records follow a complete line
+    records = read_records(path)
+    assert [record["event"] for record in records] == ["start", "cleared", "cleared", "applied", "done", "applied",
+                                                       "resume", "applied"]
+    assert records[-1]["ids"] == ["pc4"]
+
+
+@pytest.mark.parametrize("mode, category", [("diff", "VIP"), ("clear", "Other")])
+def test_journal_of_another_run_is_ignored(tag_file, logger, mode, category):
+    path = interrupted_run(tag_file, logger)
+    journal = TagJournal(path, "R2", True, logger)
+    journal.open(tag_file, mode, category, "device")
+    assert not journal.is_done("e1") and journal.get_applied("e2") == set()
+    journal.close()
+    assert [record["event"] for record in read_records(path)] == ["start"]
+
+
+def test_changed_file_is_not_resumed(tag_file, logger):
+    path = interrupted_run(tag_file, logger)
+    with open(tag_file, "a") as file:
+        file.write("device,PC2,VIP,Gold\n")
+    journal = TagJournal(path, "R2", True, logger)
+    journal.open(tag_file, "clear", "VIP", "device")
+    assert not journal.is_done("e1")
+    journal.close()
+
+
+def test_no_resume_starts_a_new_journal(tag_file, logger):
+    path = interrupted_run(tag_file, logger)
+    journal = TagJournal(path, "R2", False, logger)
+    journal.open(tag_file, "clear", "VIP", "device")
+    journal.close()
+    assert read_records(path)[0]["run"] == "R2" and len(read_records(path)) == 1
@@ -0,0 +1,79 @@
+import pytest
+
+from classes.limiter import AdaptiveLimiter
+
+
+@pytest.fixture
+def limiter(logger):
+    return AdaptiveLimiter(4, 1, 8, logger)
+
+
+def test_initial_limit_within_floor_and_ceiling(logger):
+    assert AdaptiveLimiter(4, 1, 8, logger).get_limit("e1") == 4
+    assert AdaptiveLimiter(20, 1, 8, logger).get_limit("e1") == 8
+    assert AdaptiveLimiter(0, 2, 8, logger).get_limit("e1") == 2
+
+
+def test_additive_increase_of_one_per_round(limiter):
+    for _ in range(4):
+        limiter.record("e1", 0.1)
+    assert limiter.get_limit("e1") == 4
+    limiter.record("e1", 0.1)
+    assert limiter.get_limit("e1") == 5
+    # Only the Engine of the samples
+    assert limiter.get_limit("e2") == 4
+
+
+def test_increase_stops_at_the_ceiling(limiter):
+    for _ in range(200):
+        limiter.record("e1", 0.1)
+    assert limiter.get_limit("e1") == 8
+
+
+def test_failure_decreases_once_per_round(limiter):
+    for _ in range(5):
+        limiter.record("e1", 0.1)
+    assert limiter.get_limit("e1") == 5
+    limiter.record("e1", None, failed=True)
+    assert limiter.get_limit("e1") == 3
+    # The requests already running saw the same load
+    for _ in range(3):
+        limiter.record("e1", None, failed=True)
+    assert limiter.get_limit("e1") == 3
+    limiter.record("e1", None, failed=True)
+    assert limiter.get_limit("e1") == 2
+
+
+def test_first_failures_wait_for_a_round(limiter):
+    limiter.record("e1", None, failed=True)
+    assert limiter.get_limit("e1") == 4
+
+
+def test_latency_above_tolerance_decreases(limiter):
+    for _ in range(5):
+        limiter.record("e1", 0.1)
+    limiter.record("e1", 1.0)
+    assert limiter.get_limit("e1") == 3
+
+
+def test_execution_time_above_tolerance_decreases(limiter):
+    for _ in range(5):
+        limiter.record("e1", 0.1, exec_time=0.05)
+    limiter.record("e1", 0.1, exec_time=0.5)
+    assert limiter.get_limit("e1") == 3
+
+
+def test_decrease_stops_at_the_floor(limiter):
+    for _ in range(50):
+        limiter.record("e1", None, failed=True)
+    assert limiter.get_limit("e1") == 1
+
+
+def test_baseline_follows_lasting_changes(limiter):
+    for _ in range(5):
+        limiter.record("e1", 0.1)
+    # A lasting change: the limit backs off, then grows again at the new latency
+    for _ in range(400):
+        limiter.record("e1", 0.3)
+    assert limiter.get_limit("e1") == 8
+    assert limiter.get_stats() == {"e1": 8}
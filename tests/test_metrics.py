@@ -0,0 +1,54 @@
+import json
+
+from classes.metrics import RunMetrics
+
+
+def test_distribution_nearest_rank():
+    distribution = RunMetrics.get_distribution(list(range(1, 101)))
+    assert (distribution["p50"], distribution["p95"], distribution["p99"]) == (50, 95, 99)
+    assert distribution["mean"] == 50.5 and distribution["max"] == 100
+    assert RunMetrics.get_distribution([3])["p99"] == 3
+    assert RunMetrics.get_distribution([]) is None
+
+
+def test_requests_are_counted_per_phase(logger):
+    metrics = RunMetrics("file.csv", "run")
+    metrics.record_request("e1", "fetch", 0.5, 200, bytes_sent=10, bytes_received=100, exec_time="0.25")
+    metrics.record_request("e1", "fetch", 1.5, None, bytes_sent=10)
+    metrics.add_bytes_received("e1", "fetch", 50)
+    metrics.record_request("e1", "update", 0.1, 200, exec_time="n/a")
+    report = metrics.get_report(mode="test")
+    fetch = report["engines"]["e1"]["requests"]["fetch"]
+    assert (fetch["count"], fetch["errors"], fetch["status_codes"]) == (2, 1, {"200": 1})
+    assert (fetch["bytes_sent"], fetch["bytes_received"]) == (20, 150)
+    assert fetch["latency"]["max"] == 1.5
+    assert fetch["exec_time"]["mean"] == 0.25
+    assert report["requests"]["update"]["exec_time"] is None
+    assert report["mode"] == "test"
+
+
+def test_merge_adds_the_measures_of_a_file():
+    run = RunMetrics("run", "run")
+    for name in ("a.csv", "b.csv"):
+        metrics = RunMetrics(name, "run")
+        metrics.add_phase_time("e1", "fetch", 1.0)
+        metrics.record_request("e1", "fetch", 0.5, 200)
+        metrics.record_results([{"url": "e1", "num_updates": 2, "success": name == "a.csv", "failed_ids": []}])
+        metrics.add_counter("files_succeeded")
+        run.merge(metrics)
+    report = run.get_report()
+    engine = report["engines"]["e1"]
+    assert engine["phases"]["fetch"] == {"wall_time": 2.0, "count": 2}
+    assert engine["requests"]["fetch"]["count"] == 2
+    assert engine["result"] == {"num_updates": 4, "success": False}
+    assert report["counters"] == {"files_succeeded": 2}
+    assert report["phases"] == {"fetch": 2.0}
+
+
+def test_write_report(tmp_path):
+    metrics = RunMetrics("run", "20170101")
+    metrics.add_counter("objects_missed", 3)
+    path = str(tmp_path / "report.json")
+    metrics.write_report(path)
+    assert json.loads((tmp_path / "report.json").read_text())["counters"] == {"objects_missed": 3}
+
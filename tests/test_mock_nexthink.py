@@ -0,0 +1,54 @@
+import hashlib
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from mock_nexthink import MockEngine
+
+
+@pytest.fixture
+def engine():
+    return MockEngine(["pc-1", "pc-2", "srv-1"])
+
+
+def select(engine, query):
+    status, body, count = engine.handle(query, "json")
+    assert status == 200
+    return json.loads(body)
+
+
+def test_conditions_of_one_where_clause_are_ored(engine):
+    engine.handle('(update (set #"C" (enum "K")) (from device(where device (eq name (pattern "PC-1")) (eq name (pattern "srv-1")))))', "json")
+    assert engine.get_keywords("C") == {"pc-1": "K", "srv-1": "K"}
+
+
+def test_where_clauses_are_anded(engine):
+    engine.handle('(update (set #"C" (enum "K")) (from device(where device (eq name (pattern "pc-1")))(where device (eq name (pattern "pc-2")))))', "json")
+    assert engine.get_keywords("C") == {}
+    engine.handle('(update (set #"C" (enum "K")) (from device(where device (eq name (pattern "pc-*")))(where device (eq name (pattern "*-2")))))', "json")
+    assert engine.get_keywords("C") == {"pc-2": "K"}
+
+
+def test_id_and_hash_conditions(engine):
+    engine.handle('(update (set #"C" (enum "I")) (from device(where device (eq id (identifier 2)))))', "json")
+    engine.handle('(update (set #"C" (enum "H")) (from binary(where binary (eq hash (md5 {})))))'.format(
+        hashlib.md5(b"pc-1").hexdigest()), "json")
+    assert engine.get_keywords("C") == {"srv-1": "I", "pc-1": "H"}
+
+
+def test_update_without_where_sets_or_cleans_all_objects(engine):
+    engine.handle('(update (set #"C" (enum "K")) (from device))', "json")
+    assert len(engine.get_keywords("C")) == 3
+    engine.handle('(update (set #"C" nil) (from device))', "json")
+    assert engine.get_keywords("C") == {}
+
+
+def test_select_of_diff_lookup(engine):
+    engine.handle('(update (set #"C" (enum "K")) (from device(where device (eq name (pattern "srv-1")))))', "json")
+    rows = select(engine, '(select (#"C" name) (from device(where device (ne #"C" nil) (eq name (pattern "pc-2")))))')
+    assert rows == [{'#"C"': None, "name": "pc-2"}, {'#"C"': "K", "name": "srv-1"}]
+    assert select(engine, '(select (id) (from device (where device (ne #"C" nil))) (limit 1))') == [{"id": 2}]
@@ -0,0 +1,240 @@
+import types
+
+import pytest
+import requests
+
+from classes.nxql import Nxql
+from classes.patternindex import PatternIndex
+from classes.retry import EngineUnavailableError, RetryPolicy
+from classes.tagrow import TagRow
+from classes.websession import WebSession
+
+
+@pytest.fixture
+def nxql(logger):
+    nxql = Nxql(None, logger)
+    nxql._id_column = "name"
+    return nxql
+
+
+def test_add_condition_single_object(nxql):
+    query = nxql.add_condition("name", "PC1", "device", base_query="(update (set #\"C\" (enum \"K\")) (from device")
+    assert query == '(update (set #"C" (enum "K")) (from device(where device (eq name (pattern "PC1")))'
+
+
+def test_update_batch_has_one_where_clause(nxql):
+    nxql.batch_size = 10
+    tags = [TagRow("device", name, "VIP", "Gold") for name in ("PC1", "PC2", "PC3")]
+    batches = nxql.build_update_batches(tags)
+    assert batches == [(
+        '(update (set #"VIP" (enum "Gold")) (from device'
+        '(where device (eq name (pattern "PC1")) (eq name (pattern "PC2")) (eq name (pattern "PC3")))))',
+        tags)]
+
+
+def test_update_batches_split_on_batch_size_and_keyword(nxql):
+    nxql.batch_size = 2
+    tags = [TagRow("device", "PC1", "VIP", "Gold"), TagRow("device", "PC2", "VIP", "Gold"),
+            TagRow("device", "PC3", "VIP", "Gold"), TagRow("device", "PC4", "VIP", None)]
+    queries = [query for query, batch_tags in nxql.build_update_batches(tags)]
+    assert queries == [
+        '(update (set #"VIP" (enum "Gold")) (from device(where device (eq name (pattern "PC1")) (eq name (pattern "PC2")))))',
+        '(update (set #"VIP" (enum "Gold")) (from device(where device (eq name (pattern "PC3")))))',
+        '(update (set #"VIP" nil) (from device(where device (eq name (pattern "PC4")))))',
+    ]
+
+
+def test_update_batches_respect_max_query_length(nxql):
+    nxql.batch_size = 100
+    tags = [TagRow("device", "PC{}".format(number), "VIP", "Gold") for number in range(50)]
+    one = len(nxql.build_update_batches(tags[:2])[0][0])
+    nxql.max_query_length = one
+    batches = nxql.build_update_batches(tags)
+    assert all(len(query) <= one for query, batch_tags in batches)
+    assert [len(batch_tags) for query, batch_tags in batches][:3] == [2, 2, 2]
+    assert sum(len(batch_tags) for query, batch_tags in batches) == 50
+
+
+@pytest.mark.parametrize("column, object_type, condition", [
+    ("id", "device", "(eq id (identifier 42))"),
+    ("hash", "binary", "(eq hash (md5 42))"),
+    ("name", "binary", "(eq executable_name (pattern 42))"),
+])
+def test_update_batch_conditions_of_other_columns(nxql, column, object_type, condition):
+    nxql._id_column = column
+    nxql.batch_size = 10
+    tags = [TagRow(object_type, "42", "VIP", "Gold"), TagRow(object_type, "43", "VIP", "Gold")]
+    query, batch_tags = nxql.build_update_batches(tags)[0]
+    assert query.endswith("(where {} {} {})))".format(object_type, condition, condition.replace("42", "43")))
+
+
+def prepare_lookups(nxql, names, diff_category=None, id_query="(select (name) (from device))"):
+    nxql.engine = []
+    nxql.prepare_for_engine_object_updates(id_query, "name", [TagRow("device", name, "VIP", "Gold") for name in names],
+                                           object_type="device", diff_category=diff_category)
+    return nxql.build_lookup_queries()
+
+
+def test_lookup_queries_have_one_where_clause_per_chunk(nxql):
+    nxql.lookup_chunk_size = 2
+    assert prepare_lookups(nxql, ["PC1", "PC2", "PC3"]) == [
+        '(select (name) (from device(where device (eq name (pattern "PC1")) (eq name (pattern "PC2")))))',
+        '(select (name) (from device(where device (eq name (pattern "PC3")))))',
+    ]
+
+
+def test_lookup_queries_of_diff_mode_also_match_the_tagged_objects(nxql):
+    nxql.lookup_chunk_size = 2
+    assert prepare_lookups(nxql, ["PC1", "PC2", "PC3"], diff_category="VIP") == [
+        '(select (#"VIP" name) (from device(where device (ne #"VIP" nil) (eq name (pattern "PC1")) (eq name (pattern "PC2")))))',
+        '(select (#"VIP" name) (from device(where device (eq name (pattern "PC3")))))',
+    ]
+
+
+def test_lookup_queries_respect_max_query_length(nxql):
+    nxql.lookup_chunk_size = 100
+    nxql.max_query_length = 120
+    queries = prepare_lookups(nxql, ["PC{}".format(number) for number in range(20)])
+    assert all(len(query) <= 120 for query in queries)
+    assert sum(query.count("(eq name") for query in queries) == 20
+
+
+def test_lookup_queries_not_built_on_id_queries_with_a_where_clause(nxql):
+    assert prepare_lookups(nxql, ["PC1"], id_query="(select (name) (from device (where device (eq type (enum server)))))") is None
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code=200, content=b"{}"):
+        self.status_code = status_code
+        self.headers = {}
+        self.content = content
+        self.request = types.SimpleNamespace(url="https://engine/2/query")
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    """requests session raising the queued failures before answering"""
+
+    def __init__(self, failures):
+        self.failures = list(failures)
+        self.calls = []
+
+    def get(self, url, **kwargs):
+        self.calls.append(kwargs)
+        if self.failures:
+            raise self.failures.pop(0)
+        return FakeResponse()
+
+
+def make_engine_nxql(logger, session, max_retries=3):
+    websession = types.SimpleNamespace(get_session=lambda url: session)
+    nxql = Nxql(websession, logger)
+    nxql.retry_policy = RetryPolicy(max_retries=max_retries, base_delay=0)
+    nxql.connect_timeout = 2
+    nxql.read_timeout = 5
+    return nxql
+
+
+def test_engine_get_passes_the_timeouts_and_retries_a_timeout(logger):
+    session = FakeSession([requests.exceptions.ReadTimeout(), requests.exceptions.ConnectTimeout()])
+    nxql = make_engine_nxql(logger, session)
+    result = {"num_retries": 0, "num_breaker_changes": 0}
+    response = nxql.engine_get("https://engine/2/query", {}, result)
+    assert response.status_code == 200
+    assert result["num_retries"] == 2
+    assert [call["timeout"] for call in session.calls] == [(2, 5)] * 3
+
+
+def test_engine_get_gives_up_after_the_retries(logger):
+    session = FakeSession([requests.exceptions.ReadTimeout()] * 2)
+    nxql = make_engine_nxql(logger, session, max_retries=1)
+    with pytest.raises(EngineUnavailableError):
+        nxql.engine_get("https://engine/2/query", {})
+
+
+def test_index_engine_objects_keeps_the_keyword_in_diff_mode(nxql):
+    nxql._diff_category = "C"
+    index = nxql.index_engine_objects([{"name": "PC1", '#"C"': "Gold"}, {"name": "pc2", '#"C"': ""}])
+    assert index == {"pc1": ("PC1", "Gold"), "pc2": ("pc2", None)}
+    nxql._diff_category = None
+    assert nxql.index_engine_objects([{"name": "PC1"}], {"pc2"}) == {"pc1", "pc2"}
+
+def set_tags(nxql, tags, diff_category=None):
+    nxql._diff_category = diff_category
+    nxql._object_type = "device"
+    nxql._tag_index = {Nxql.normalize_id(tag.object_id): tag for tag in tags}
+    nxql._pattern_index = PatternIndex(nxql._tag_index, wildcards=nxql._id_column == "name")
+
+
+def test_match_tags_expands_the_patterns(nxql):
+    set_tags(nxql, [TagRow("device", "PC1", "C", "K"), TagRow("device", "web*", "C", "W"),
+                    TagRow("device", "db?", "C", "D")])
+    expansions = {}
+    matched = nxql.match_tags({"pc1", "web1", "web2", "db12"}, expansions)
+    assert sorted(tag.object_id for tag in matched) == ["PC1", "web*"]
+    assert {key: sorted(ids) for key, ids in expansions.items()} == {"web*": ["web1", "web2"]}
+
+
+def test_diff_tags_compares_the_keywords(nxql):
+    set_tags(nxql, [TagRow("device", "PC1", "C", "Gold"), TagRow("device", "PC2", "C", "Gold"),
+                    TagRow("device", "web*", "C", "W")], diff_category="C")
+    engine_objects = {"pc1": ("PC1", "gold"), "pc2": ("PC2", "Silver"), "pc3": ("PC3", "Gold"),
+                      "pc4": ("PC4", None), "web1": ("WEB1", "W"), "web2": ("WEB2", None)}
+    expansions = {}
+    to_update, unchanged, to_remove = nxql.diff_tags(engine_objects, expansions)
+    assert sorted(tag.object_id for tag in to_update) == ["PC2", "web*"]
+    assert [tag.object_id for tag in unchanged] == ["PC1"]
+    assert [(tag.object_id, tag.keyword) for tag in to_remove] == [("PC3", None)]
+    assert sorted(expansions["web*"]) == ["WEB1", "WEB2"]
+
+
+
+def make_streaming_nxql(logger, websession):
+    nxql = Nxql(websession, logger)
+    nxql.retry_policy = RetryPolicy(max_retries=0, base_delay=0)
+    nxql.stream_ids = True
+    nxql._id_column = "name"
+    nxql._diff_category = None
+    return nxql
+
+
+def test_failed_streamed_id_query_gives_its_connection_back(logger, http_server):
+    websession = WebSession("dXNlcjpwYXNz", pool_size=1, pool_timeout=2)
+    nxql = make_streaming_nxql(logger, websession)
+    # Each failed response must free the only pooled connection for the next query (or it times out)
+    for _ in range(3):
+        assert nxql.fetch_engine_index(http_server + "?status=503", query="q") is None
+    websession.close()
+
+
+def test_pool_wait_is_bounded(logger, http_server):
+    websession = WebSession("dXNlcjpwYXNz", pool_size=1, pool_timeout=0.2)
+    session = websession.get_session(http_server)
+    held = session.get(http_server, stream=True)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        session.get(http_server)
+    held.close()
+    assert session.get(http_server).status_code == 200
+    websession.close()
+
+
+def test_diff_tags_sets_again_a_literal_overwritten_by_a_pattern(nxql):
+    set_tags(nxql, [TagRow("device", "PC1", "C", "Silver"), TagRow("device", "PC*", "C", "Gold")], diff_category="C")
+    to_update, unchanged, to_remove = nxql.diff_tags({"pc1": ("PC1", "Silver"), "pc2": ("PC2", None)})
+    assert sorted(tag.object_id for tag in to_update) == ["PC*", "PC1"]
+    assert unchanged == [] and to_remove == []
+    # Without an update of the pattern, the literal stays unchanged
+    to_update, unchanged, to_remove = nxql.diff_tags({"pc1": ("PC1", "Silver"), "pc2": ("PC2", "Gold")})
+    assert to_update == [] and sorted(tag.object_id for tag in unchanged) == ["PC*", "PC1"]
+
+
+def test_patterns_are_updated_before_the_literal_ids(nxql):
+    set_tags(nxql, [TagRow("device", "PC1", "C", "Silver"), TagRow("device", "PC*", "C", "Gold"),
+                    TagRow("device", "PC2", "C", "Gold")])
+    nxql.batch_size = 10
+    rounds = nxql.plan_engine_updates({"pc1", "pc2", "pc3"}, nxql.new_engine_result("e1"))
+    assert [[[tag.object_id for tag in batch_tags] for query, batch_tags in batches] for batches in rounds] == [
+        [["PC*"]], [["PC1"], ["PC2"]]]
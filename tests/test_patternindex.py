@@ -0,0 +1,51 @@
+from classes.patternindex import PatternIndex
+
+
+def test_literals_and_patterns_are_split():
+    index = PatternIndex({"host-1": "a", "host-*": "b", "db?": "c"})
+    assert index.literals == {"host-1": "a"}
+    assert sorted(index.patterns) == [("db?", "c"), ("host-*", "b")]
+
+
+def test_wildcards_are_literal_without_patterns():
+    index = PatternIndex({"host-*": "b"}, wildcards=False)
+    assert index.literals == {"host-*": "b"}
+    assert index.expand(["host-1"]) == {}
+
+
+def test_pattern_to_regex_escapes_the_literal_parts():
+    assert PatternIndex.pattern_to_regex("a.b*c?") == r"a\.b.*c."
+
+
+def test_star_and_question_mark():
+    index = PatternIndex({"web*": "a", "db?": "b"})
+    assert index.match_patterns("web") == [("web*", "a")]
+    assert index.match_patterns("web-01") == [("web*", "a")]
+    assert index.match_patterns("db1") == [("db?", "b")]
+    assert index.match_patterns("db12") == []
+    assert index.match_patterns("db") == []
+
+
+def test_the_dot_is_not_a_wildcard():
+    index = PatternIndex({"a.b*": "a"})
+    assert index.match_patterns("a.bc") == [("a.b*", "a")]
+    assert index.match_patterns("axbc") == []
+
+
+def test_all_the_patterns_of_a_group_are_matched():
+    # Same prefix: one alternation, the patterns after the first match are checked on their own
+    index = PatternIndex({"pc-*": "a", "pc-1*": "b", "pc-?2": "c"})
+    assert sorted(index.match_patterns("pc-12")) == [("pc-*", "a"), ("pc-1*", "b"), ("pc-?2", "c")]
+    assert sorted(index.match_patterns("pc-3")) == [("pc-*", "a")]
+
+
+def test_patterns_of_different_prefixes():
+    index = PatternIndex({"*": "a", "p*": "b", "pc-*": "c"})
+    assert sorted(index.match_patterns("pc-1")) == [("*", "a"), ("p*", "b"), ("pc-*", "c")]
+    assert sorted(index.match_patterns("x")) == [("*", "a")]
+
+
+def test_expand_on_the_ids_of_an_engine():
+    index = PatternIndex({"web*": "a", "db?": "b", "mail*": "c", "host": "d"})
+    expansions = index.expand(["web1", "db1", "db22", "web2", "host"])
+    assert expansions == {"web*": ["web1", "web2"], "db?": ["db1"]}
@@ -0,0 +1,53 @@
+import json
+
+from classes.planner import QueryPlanner
+
+
+def test_full_scan_without_statistics(tmp_path, logger):
+    planner = QueryPlanner(str(tmp_path / "stats.json"), logger)
+    assert planner.plan("e1", "q", 10, 1) == ("full", None)
+
+
+def test_full_scan_when_the_query_cannot_be_targeted(tmp_path, logger):
+    planner = QueryPlanner(str(tmp_path / "stats.json"), logger)
+    planner.record("e1", "q", "full", None, 1000, 5.0, 100, 1)
+    assert planner.plan("e1", "q", 10, None) == ("full", None)
+
+
+def test_plan_on_the_latency_of_the_last_full_scan(tmp_path, logger):
+    planner = QueryPlanner(str(tmp_path / "stats.json"), logger)
+    planner.record("e1", "q", "full", None, 1000, 1.0, 100, 1)
+    # Default lookup latency: 2 lookups are cheaper than the scan, 4 are not
+    plan, estimate = planner.plan("e1", "q", 10, 2)
+    assert plan == "targeted"
+    assert estimate == {"bytes": 100, "latency": 2 * QueryPlanner.DEFAULT_LOOKUP_LATENCY}
+    assert planner.plan("e1", "q", 10, 4) == ("full", {"bytes": 1000, "latency": 1.0})
+    # Other Engines and queries have their own statistics
+    assert planner.plan("e2", "q", 10, 2) == ("full", None)
+
+
+def test_lookup_latency_is_averaged(tmp_path, logger):
+    planner = QueryPlanner(str(tmp_path / "stats.json"), logger)
+    planner.record("e1", "q", "full", None, 1000, 1.0, 100, 1)
+    planner.record("e1", "q", "targeted", None, 10, 2.0, 1, 2)
+    planner.record("e1", "q", "targeted", None, 10, 0.0, 1, 1)
+    # 1.0 then 0.7 * 1.0 + 0.3 * 0.0
+    plan, estimate = planner.plan("e1", "q", 1, 1)
+    assert abs(estimate["latency"] - 0.7) < 1e-9
+
+
+def test_statistics_are_saved_and_reloaded(tmp_path, logger):
+    path = str(tmp_path / "stats.json")
+    planner = QueryPlanner(path, logger)
+    planner.record("e1", "q", "full", None, 1000, 1.0, 100, 1)
+    planner.save()
+    assert json.loads((tmp_path / "stats.json").read_text()) == {"e1 q": {"bytes": 1000, "latency": 1.0, "objects": 100}}
+    assert QueryPlanner(path, logger).plan("e1", "q", 10, 4)[0] == "full"
+    assert QueryPlanner(path, logger).plan("e1", "q", 10, 1)[0] == "targeted"
+
+
+def test_invalid_statistics_file_is_ignored(tmp_path, logger):
+    path = tmp_path / "stats.json"
+    path.write_text("{not json")
+    planner = QueryPlanner(str(path), logger)
+    assert planner.plan("e1", "q", 10, 1) == ("full", None)
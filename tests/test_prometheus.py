@@ -0,0 +1,24 @@
+from classes.metrics import RunMetrics
+from classes.prometheus import PrometheusTextfile
+
+
+def test_prometheus_textfile(tmp_path, logger):
+    metrics = RunMetrics("run", "20170101")
+    metrics.record_request("https://engine1:1671/2/query", "fetch", 0.5, 200, bytes_received=100)
+    metrics.add_phase_time("https://engine1:1671/2/query", "fetch", 2.0)
+    metrics.record_results([{"url": "https://engine1:1671/2/query", "num_updates": 5}])
+    metrics.add_counter("files_succeeded")
+    path = tmp_path / "tagger.prom"
+    PrometheusTextfile(str(path), logger).write(metrics)
+    lines = path.read_text().splitlines()
+    assert '# TYPE nexthink_tagger_updates gauge' in lines
+    assert 'nexthink_tagger_updates{engine="engine1:1671"} 5.0' in lines
+    assert 'nexthink_tagger_files{status="success"} 1.0' in lines
+    assert 'nexthink_tagger_bytes_downloaded{engine="engine1:1671"} 100.0' in lines
+    assert 'nexthink_tagger_requests{engine="engine1:1671",phase="fetch"} 1.0' in lines
+    assert 'nexthink_tagger_request_latency_seconds{engine="engine1:1671",phase="fetch",quantile="0.99"} 0.5' in lines
+    assert not (tmp_path / "tagger.prom.tmp").exists()
+
+
+def test_prometheus_label_escaping():
+    assert PrometheusTextfile.escape_label('a"b\\c\nd') == 'a\\"b\\\\c\\nd'
@@ -0,0 +1,122 @@
+import types
+
+import pytest
+
+from classes.nxql import Nxql
+from classes.retry import CircuitBreaker, EngineUnavailableError, RetryPolicy
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr("classes.retry.time.monotonic", clock)
+    return clock
+
+
+def test_transient_statuses():
+    policy = RetryPolicy()
+    assert all(policy.is_transient_status(status) for status in (429, 500, 502, 503, 504))
+    assert not any(policy.is_transient_status(status) for status in (200, 400, 401, 404, None))
+
+
+def test_delay_is_a_full_jitter_backoff(monkeypatch):
+    policy = RetryPolicy(base_delay=0.5, max_delay=3)
+    monkeypatch.setattr("classes.retry.random.uniform", lambda low, high: (low, high))
+    assert [policy.get_delay(attempt) for attempt in range(4)] == [(0, 0.5), (0, 1.0), (0, 2.0), (0, 3)]
+
+
+def test_retry_after_is_honored_within_max_delay():
+    policy = RetryPolicy(max_delay=10)
+    assert policy.get_delay(0, "2") == 2.0
+    assert policy.get_delay(0, "60") == 10
+    # An http date is not parsed: back to the backoff
+    assert 0 <= policy.get_delay(0, "Wed, 21 Oct 2015 07:28:00 GMT") <= 0.5
+
+
+def test_breaker_opens_after_the_threshold(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    assert breaker.record_failure("e1") is None
+    assert breaker.record_failure("e1") is None
+    assert breaker.record_failure("e1") == CircuitBreaker.OPEN
+    assert not breaker.allow_request("e1")
+    # The other Engines are not affected
+    assert breaker.allow_request("e2")
+
+
+def test_success_resets_the_failure_count(clock):
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.record_failure("e1")
+    assert breaker.record_success("e1") is None
+    assert breaker.record_failure("e1") is None
+    assert breaker.get_state("e1") == CircuitBreaker.CLOSED
+
+
+def test_half_open_probe_closes_the_breaker(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure("e1")
+    clock.now += 29
+    assert not breaker.allow_request("e1")
+    clock.now += 1
+    # A single probe request is let through
+    assert breaker.allow_request("e1")
+    assert breaker.get_state("e1") == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow_request("e1")
+    assert breaker.record_success("e1") == CircuitBreaker.CLOSED
+    assert breaker.allow_request("e1") and breaker.allow_request("e1")
+
+
+def test_failed_probe_opens_the_breaker_again(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure("e1")
+    clock.now += 30
+    assert breaker.allow_request("e1")
+    assert breaker.record_failure("e1") == CircuitBreaker.OPEN
+    clock.now += 10
+    assert not breaker.allow_request("e1")
+
+
+@pytest.fixture
+def nxql(logger):
+    nxql = Nxql(types.SimpleNamespace(), logger)
+    nxql.retry_policy = RetryPolicy(max_retries=2, base_delay=0)
+    nxql.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    return nxql
+
+
+def new_result():
+    return {"num_retries": 0, "num_breaker_changes": 0}
+
+
+def test_transient_status_is_retried_then_returned(nxql):
+    result = new_result()
+    assert nxql.retry_delay("e1", result, 0, 503) == 0
+    assert nxql.retry_delay("e1", result, 1, 503) == 0
+    # Retries exhausted: the last response is final and counts against the Engine
+    assert nxql.retry_delay("e1", result, 2, 503) is None
+    assert result == {"num_retries": 2, "num_breaker_changes": 0}
+    assert nxql.breaker.get_state("e1") == CircuitBreaker.CLOSED
+
+
+def test_final_status_is_not_retried(nxql):
+    result = new_result()
+    assert nxql.retry_delay("e1", result, 0, 404) is None
+    assert result["num_retries"] == 0
+
+
+def test_exhausted_errors_open_the_breaker(nxql):
+    result = new_result()
+    for attempt in range(2):
+        with pytest.raises(EngineUnavailableError):
+            nxql.retry_delay("e1", result, 2, error=ConnectionError("refused"))
+    assert result["num_breaker_changes"] == 1
+    with pytest.raises(EngineUnavailableError, match="circuit breaker open"):
+        nxql.check_breaker("e1", result)
@@ -0,0 +1,148 @@
+import importlib.util
+import os
+
+import pytest
+
+from classes.nxql import Nxql
+from classes.routing import RoutingIndex
+from classes.tagrow import TagRow
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def tagger():
+    spec = importlib.util.spec_from_file_location("tagger", os.path.join(ROOT, "multi-engine-tagger.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def routing(tmp_path, logger):
+    routing = RoutingIndex(str(tmp_path / "routing.sqlite"), 3600, logger)
+    yield routing
+    routing.close()
+
+
+@pytest.fixture
+def nxql(logger):
+    nxql = Nxql(None, logger)
+    nxql.engine = ["e1", "e2"]
+    nxql.prepare_for_engine_object_updates("(select (name) (from device))", "name",
+                                           [TagRow("device", name, "VIP", "Gold") for name in ("PC1", "PC2", "PC3")],
+                                           object_type="device")
+    return nxql
+
+
+def test_record_lookup_and_forget(routing):
+    routing.record("device", "name", "e1", ["pc1", "pc2"])
+    routing.record("device", "name", RoutingIndex.NOT_FOUND, ["pc3"])
+    assert routing.lookup("device", "name", ["pc1", "pc2", "pc3", "pc4"]) == {"pc1": "e1", "pc2": "e1", "pc3": ""}
+    assert routing.lookup("user", "name", ["pc1"]) == {}
+    routing.forget("device", "name", ["pc2"])
+    assert routing.lookup("device", "name", ["pc1", "pc2"]) == {"pc1": "e1"}
+
+
+def test_routes_expire(routing, monkeypatch):
+    routing.record("device", "name", "e1", ["pc1"])
+    routing.record_full_scan("device", "name")
+    assert not routing.needs_full_scan("device", "name")
+    later = routing.refresh_interval + 1
+    monkeypatch.setattr("classes.routing.time.time", lambda real=__import__("time").time: real() + later)
+    assert routing.lookup("device", "name", ["pc1"]) == {}
+    assert routing.needs_full_scan("device", "name")
+
+
+def test_unrouted_ids_are_looked_up(tagger, routing, logger):
+    routing.record_full_scan("device", "name")
+    routing.record("device", "name", "e1", ["pc1"])
+    routing.record("device", "name", RoutingIndex.NOT_FOUND, ["pc2"])
+    # The Engine of PC3 was removed
+    routing.record("device", "name", "gone", ["pc3"])
+    routes, unrouted = tagger.get_tag_routes(routing, ["pc1", "pc2", "pc3", "pc4"], ["e1", "e2"], "device", "name",
+                                             logger)
+    assert routes == {"e1": {"pc1"}, RoutingIndex.NOT_FOUND: {"pc2"}}
+    assert sorted(unrouted) == ["pc3", "pc4"]
+
+
+def test_mostly_unrouted_ids_are_scanned(tagger, routing, logger):
+    routing.record_full_scan("device", "name")
+    routing.record("device", "name", "e1", ["pc1"])
+    assert tagger.get_tag_routes(routing, ["pc1", "pc2", "pc3"], ["e1", "e2"], "device", "name", logger) is None
+
+
+def test_full_scan_due(tagger, routing, logger):
+    routing.record("device", "name", "e1", ["pc1"])
+    assert tagger.get_tag_routes(routing, ["pc1"], ["e1"], "device", "name", logger) is None
+
+
+def test_set_routes_looks_up_only_the_unrouted_ids(nxql):
+    assert nxql.set_routes({"e1": {"pc1"}}, ["pc3"])
+    urls = dict(zip(nxql.engine, nxql.urls))
+    found = {urls["e1"]: [], urls["e2"]: ["pc3"]}
+    queries = []
+
+    def fetch_engine_index(url, query, stats=None, engine_index=None, result=None):
+        queries.append(query)
+        engine_index.update(found[url])
+        return engine_index
+
+    nxql.fetch_engine_index = fetch_engine_index
+    assert nxql.fetch_routed_index(urls["e1"]) == {"pc1"}
+    assert nxql.fetch_routed_index(urls["e2"]) == {"pc3"}
+    assert queries == ['(select (name) (from device(where device (eq name (pattern "PC3")))))'] * 2
+
+
+def test_set_routes_refused_if_the_id_query_cannot_be_targeted(logger):
+    nxql = Nxql(None, logger)
+    nxql.engine = ["e1"]
+    nxql.prepare_for_engine_object_updates("(select (name) (from device (where device (eq os (pattern \"Win*\")))))",
+                                           "name", [TagRow("device", "PC1", "VIP", "Gold")], object_type="device")
+    assert not nxql.set_routes({}, ["pc1"])
+    assert nxql.set_routes({"e1": {"pc1"}})
+
+
+def result(url, updated=(), failed=(), available=True, cleared=True):
+    return {"url": url, "updated_ids": list(updated), "failed_ids": list(failed), "available": available,
+            "cleared": cleared}
+
+
+def test_routed_objects_do_not_refresh_their_route(tagger, nxql, routing, monkeypatch):
+    urls = dict(zip(nxql.engine, nxql.urls))
+    routing.record("device", "name", "e1", ["pc1"])
+    before = routing._db.execute("SELECT last_seen FROM routes WHERE object_key = 'pc1'").fetchone()[0]
+    monkeypatch.setattr("classes.routing.time.time", lambda real=__import__("time").time: real() + 10)
+    # PC1 routed to e1 (the update succeeds even if it is gone), PC2 found on e2 by the lookup, PC3 found nowhere
+    tagger.record_tag_routes(routing, nxql, [result(urls["e1"], ["PC1"]), result(urls["e2"], ["PC2"])],
+                             ["e1", "e2"], "device", "name", routes={"e1": {"pc1"}}, unrouted=["pc2", "pc3"])
+    after = routing._db.execute("SELECT last_seen FROM routes WHERE object_key = 'pc1'").fetchone()[0]
+    assert after == before
+    assert routing.lookup("device", "name", ["pc1", "pc2", "pc3"]) == {"pc1": "e1", "pc2": "e2", "pc3": ""}
+    assert routing.needs_full_scan("device", "name")
+
+
+def test_full_scan_records_all_the_routes(tagger, nxql, routing):
+    urls = dict(zip(nxql.engine, nxql.urls))
+    tagger.record_tag_routes(routing, nxql, [result(urls["e1"], ["PC1"]), result(urls["e2"], ["PC2"], ["PC3"])],
+                             ["e1", "e2"], "device", "name")
+    assert routing.lookup("device", "name", ["pc1", "pc2", "pc3"]) == {"pc1": "e1", "pc2": "e2"}
+    assert not routing.needs_full_scan("device", "name")
+
+
+@pytest.mark.parametrize("available, cleared", [(False, True), (True, False)])
+def test_failed_engine_records_no_missing_ids(tagger, nxql, routing, available, cleared):
+    urls = dict(zip(nxql.engine, nxql.urls))
+    # PC2 and PC3 may be on e2, which was not searched
+    tagger.record_tag_routes(routing, nxql, [result(urls["e1"], ["PC1"]),
+                                             result(urls["e2"], available=available, cleared=cleared)],
+                             ["e1", "e2"], "device", "name")
+    assert routing.lookup("device", "name", ["pc1", "pc2", "pc3"]) == {"pc1": "e1"}
+    assert routing.needs_full_scan("device", "name")
+
+
+def test_failed_engine_records_no_missing_looked_up_ids(tagger, nxql, routing):
+    urls = dict(zip(nxql.engine, nxql.urls))
+    tagger.record_tag_routes(routing, nxql, [result(urls["e1"], ["PC1"]), result(urls["e2"], available=False)],
+                             ["e1", "e2"], "device", "name", routes={"e1": {"pc1"}}, unrouted=["pc2"])
+    assert routing.lookup("device", "name", ["pc2"]) == {}
@@ -0,0 +1,70 @@
+import threading
+import time
+
+import pytest
+
+from classes.nxql import Nxql
+from classes.scheduler import UpdateScheduler
+
+
+@pytest.fixture
+def scheduler(logger):
+    scheduler = UpdateScheduler(4, 2, logger)
+    scheduler.start()
+    yield scheduler
+    scheduler.stop()
+
+
+def test_run_returns_the_results_in_order(scheduler):
+    assert scheduler.run("engine", lambda value: value * 2, [1, 2, 3, 4, 5]) == [2, 4, 6, 8, 10]
+
+
+def test_run_gives_back_the_first_error(scheduler):
+    def func(value):
+        if value == 2:
+            raise ValueError(value)
+        return value
+
+    with pytest.raises(ValueError):
+        scheduler.run("engine", func, [1, 2, 3])
+
+
+def test_engine_limit_is_respected(scheduler):
+    lock = threading.Lock()
+    running = {"now": 0, "max": 0}
+
+    def func(value):
+        with lock:
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+        time.sleep(0.01)
+        with lock:
+            running["now"] -= 1
+
+    scheduler.run("engine", func, list(range(10)))
+    assert running["max"] == 2
+
+
+def test_callers_sharing_an_engine(scheduler):
+    # Two files of a run sending the updates of the same Engine at the same time
+    results = {}
+
+    def submit(name, delay):
+        results[name] = scheduler.run("engine", lambda value: time.sleep(delay) or value, list(range(5)))
+
+    threads = [threading.Thread(target=submit, args=(name, delay)) for name, delay in (("a", 0), ("b", 0.02))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {"a": list(range(5)), "b": list(range(5))}
+    assert scheduler.run("engine", lambda value: value, [7]) == [7]
+
+
+def test_nxql_keeps_the_scheduler_of_the_run(logger, scheduler):
+    nxql = Nxql(None, logger)
+    nxql.scheduler = scheduler
+    assert nxql.process_engine_objects() == []
+    assert nxql.copy().scheduler is scheduler
+    # Still running for the next file of the run
+    assert scheduler.run("engine", lambda value: value, [1]) == [1]
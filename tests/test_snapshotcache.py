@@ -0,0 +1,58 @@
+import threading
+
+from classes.snapshotcache import SnapshotCache
+
+
+def test_miss_then_hit(logger):
+    cache = SnapshotCache(logger)
+    assert cache.get("e1", "select (id) (from device)", "id") is None
+    cache.put("e1", "select (id) (from device)", "id", {"a": 1})
+    # The queries are normalized on their whitespace
+    assert cache.get("e1", "select  (id)\n(from device)", "id") == {"a": 1}
+    assert cache.get_stats() == {"hits": 1, "misses": 1, "entries": 1}
+
+
+def test_claim_single_flight(logger):
+    cache = SnapshotCache(logger)
+    assert cache.claim("e1", "q", "id") == (None, None)
+    index, pending = cache.claim("e1", "q", "id")
+    assert index is None and pending is not None and not pending.is_set()
+    cache.put("e1", "q", "id", {"a": 1})
+    assert pending.is_set()
+    assert cache.claim("e1", "q", "id") == ({"a": 1}, None)
+
+
+def test_release_lets_another_caller_download(logger):
+    cache = SnapshotCache(logger)
+    cache.claim("e1", "q", "id")
+    index, pending = cache.claim("e1", "q", "id")
+    cache.release("e1", "q", "id")
+    assert pending.is_set()
+    assert cache.claim("e1", "q", "id") == (None, None)
+    assert cache.get_stats()["misses"] == 2
+
+
+def test_waiters_get_the_index_downloaded_once(logger):
+    cache = SnapshotCache(logger)
+    assert cache.get("e1", "q", "id") is None
+    results = []
+    waiters = [threading.Thread(target=lambda: results.append(cache.get("e1", "q", "id"))) for _ in range(3)]
+    for waiter in waiters:
+        waiter.start()
+    cache.put("e1", "q", "id", {"a": 1})
+    for waiter in waiters:
+        waiter.join(5)
+    assert results == [{"a": 1}] * 3
+    assert cache.get_stats()["misses"] == 1
+
+
+def test_invalidate_by_engine_and_category(logger):
+    cache = SnapshotCache(logger)
+    cache.put("e1", 'select (id #"Team") (from device)', "id", {})
+    cache.put("e1", 'select (id #"Site") (from device)', "id", {})
+    cache.put("e2", 'select (id #"Team") (from device)', "id", {})
+    cache.invalidate(url="e1", category="Team")
+    assert cache.get_stats()["entries"] == 2
+    assert cache.claim("e1", 'select (id #"Team") (from device)', "id") == (None, None)
+    cache.invalidate()
+    assert cache.get_stats()["entries"] == 0
@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+from classes.streamparse import CsvRowParser, JsonArrayParser
+
+OBJECTS = [{"name": "PC-é1", "id": 1, "other": [1, {"x": "]"}]}, {"name": "PC,\"2\"", "id": 2}, {"id": 3}]
+
+
+def parse(parser, body, chunk_size):
+    objects = []
+    for start in range(0, len(body), chunk_size):
+        objects.extend(parser.feed(body[start:start + chunk_size]))
+    objects.extend(parser.close())
+    return objects
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, 100000])
+def test_json_objects_across_chunk_boundaries(chunk_size):
+    body = json.dumps(OBJECTS, ensure_ascii=False, indent=1).encode("utf-8")
+    assert parse(JsonArrayParser(["name"]), body, chunk_size) == [{"name": "PC-é1"}, {"name": "PC,\"2\""}, {}]
+
+
+def test_json_empty_array():
+    assert parse(JsonArrayParser(["name"]), b" [ ]\n", 1) == []
+
+
+def test_json_truncated_array_raises():
+    parser = JsonArrayParser(["name"])
+    assert parser.feed(b'[{"name": "PC1"}, {"name": "P') == [{"name": "PC1"}]
+    with pytest.raises(ValueError, match="Truncated"):
+        parser.close()
+
+
+def test_json_not_an_array_raises():
+    with pytest.raises(ValueError, match="Expected a JSON array"):
+        JsonArrayParser(["name"]).feed(b'{"name": "PC1"}')
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 5, 100000])
+@pytest.mark.parametrize("delimiter", [",", "\t"])
+def test_csv_rows_across_chunk_boundaries(chunk_size, delimiter):
+    lines = [delimiter.join(["id", "name", "#VIP"]), delimiter.join(["1", "PC-é1", "Gold"]), "",
+             delimiter.join(["2", '"PC,2"', ""]), delimiter.join(["3"])]
+    body = "\r\n".join(lines).encode("utf-8")
+    assert parse(CsvRowParser(["name", "#VIP", "missing"]), body, chunk_size) == [
+        {"name": "PC-é1", "#VIP": "Gold"}, {"name": "PC,2", "#VIP": ""}, {"name": None, "#VIP": None}]
+
+
+def test_csv_header_only():
+    assert parse(CsvRowParser(["name"]), b"name\n", 3) == []
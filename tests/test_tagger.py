@@ -0,0 +1,183 @@
+import importlib.util
+import json
+import os
+import types
+
+import pytest
+from mock_nexthink import MockEngine
+
+from classes.metrics import RunMetrics
+from classes.nxql import Nxql
+from classes.retry import RetryPolicy
+from classes.snapshotcache import SnapshotCache
+from classes.websession import WebSession
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEADER = "Object Type,Object ID,Category,Keyword\n"
+QUERIES = """<?xml version="1.0"?>
+<configuration>
+    <Queries>
+        <Query category="VIP" id_column="name" objecttype="device">(select (name)(from device))</Query>
+        <Query category="Team" id_column="name" objecttype="device">(select (name)(from device))</Query>
+    </Queries>
+</configuration>
+"""
+
+
+@pytest.fixture(scope="module")
+def tagger():
+    spec = importlib.util.spec_from_file_location("tagger", os.path.join(ROOT, "multi-engine-tagger.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_args(**kwargs):
+    args = dict(mixed=False, diff=False, resume=False, parallel_files=1, parallel_partitions=1,
+                query_file=os.path.join(ROOT, "tagger_queries.xml"))
+    args.update(kwargs)
+    return types.SimpleNamespace(**args)
+
+
+@pytest.mark.parametrize("rows, mixed", [
+    ("device,PC1,VIP - Track Key Indicators,Gold\ndevice,PC2\n", False),
+    ("device,PC1,VIP - Track Key Indicators,Gold\ndevice,PC2\n", True),
+    ("device,PC1\n", False),
+    ("device,PC1,VIP - Track Key Indicators,Gold\nuser,bob,Other,Gold\n", False),
+])
+def test_invalid_file_fails_only_itself(tagger, logger, tmp_path, rows, mixed):
+    bad = tmp_path / "bad.csv"
+    bad.write_text(HEADER + rows)
+    nxql = Nxql(None, logger)
+    # No Engine: nothing is sent, the valid file has no failures
+    good = tmp_path / "good.csv"
+    good.write_text(HEADER + "device,PC1,VIP - Track Key Indicators,Gold\n")
+    tagger.process_tag_files(make_args(mixed=mixed), [str(bad), str(good)], nxql, [], logger, "R")
+    names = os.listdir(tmp_path)
+    assert "bad.csv.R.failed" in names and "good.csv.R.success" in names
+    assert "bad.csv" not in names and "good.csv" not in names
+
+
+def test_invalid_file_fails_with_parallel_files(tagger, logger, tmp_path):
+    (tmp_path / "bad.csv").write_text(HEADER + "device\n")
+    (tmp_path / "good.csv").write_text(HEADER + "device,PC1,VIP - Track Key Indicators,Gold\n")
+    files = [str(tmp_path / "bad.csv"), str(tmp_path / "good.csv")]
+    tagger.process_tag_files(make_args(parallel_files=2), files, Nxql(None, logger), [], logger, "R")
+    names = os.listdir(tmp_path)
+    assert "bad.csv.R.failed" in names and "good.csv.R.success" in names
+
+
+@pytest.fixture
+def query_file(tmp_path):
+    path = tmp_path / "queries.xml"
+    path.write_text(QUERIES)
+    return str(path)
+
+
+def make_mock_nxql(logger, mock, transport="threads"):
+    nxql = Nxql(WebSession("dXNlcjpwYXNz"), logger)
+    nxql.engine_url_template = mock.engine_url_template
+    nxql.transport = transport
+    nxql.clear_poll_interval = 0.01
+    nxql.retry_policy = RetryPolicy(max_retries=0)
+    return nxql
+
+
+@pytest.mark.parametrize("transport", ["threads", "asyncio"])
+def test_engine_failing_after_its_clean_fails_the_file(tagger, logger, tmp_path, query_file, mock_nexthink,
+                                                        monkeypatch, transport):
+    mock = mock_nexthink([MockEngine(["PC1"]), MockEngine(["PC2"])])
+    engines = mock.get_engine_addresses()
+    failing_url = mock.engine_url_template.format(engines[1])
+    index_engine_objects = Nxql.index_engine_objects
+
+    def fail_on_one_engine(self, objects, engine_index=None):
+        objects = list(objects)
+        if any(obj["name"] == "PC2" for obj in objects):
+            raise ValueError("malformed id response from " + failing_url)
+        return index_engine_objects(self, objects, engine_index)
+
+    monkeypatch.setattr(Nxql, "index_engine_objects", fail_on_one_engine)
+    tags_file = tmp_path / "tags.csv"
+    tags_file.write_text(HEADER + "device,PC1,VIP,Gold\ndevice,PC2,VIP,Gold\n")
+    nxql = make_mock_nxql(logger, mock, transport)
+    success, missed_object_ids, expanded_ids = tagger.tag_device(query_file, str(tags_file), nxql, engines, logger)
+    # The Category of the failing Engine was cleaned but not tagged again
+    assert not success
+    assert missed_object_ids == ["PC2"]
+    assert mock.engines[0].get_keywords("VIP") == {"PC1": "Gold"}
+    nxql._websession.close()
+
+
+@pytest.mark.parametrize("transport", ["threads", "asyncio"])
+@pytest.mark.parametrize("diff", [False, True])
+def test_literal_row_takes_precedence_over_a_pattern(tagger, logger, tmp_path, query_file, mock_nexthink,
+                                                     transport, diff):
+    engine = MockEngine(["PC1", "PC2", "PC3"])
+    engine.keywords["VIP"] = {"PC1": "Silver"}
+    mock = mock_nexthink([engine])
+    tags_file = tmp_path / "tags.csv"
+    tags_file.write_text(HEADER + "device,PC1,VIP,Silver\ndevice,PC*,VIP,Gold\n")
+    nxql = make_mock_nxql(logger, mock, transport)
+    nxql.max_engine_requests = 4
+    success, missed_object_ids, expanded_ids = tagger.tag_device(query_file, str(tags_file), nxql,
+                                                                 mock.get_engine_addresses(), logger, diff=diff)
+    assert success
+    assert engine.get_keywords("VIP") == {"PC1": "Silver", "PC2": "Gold", "PC3": "Gold"}
+    nxql._websession.close()
+
+
+@pytest.mark.parametrize("transport", ["threads", "asyncio"])
+def test_mixed_file_shares_the_id_scans_of_its_partitions(tagger, logger, tmp_path, query_file, mock_nexthink,
+                                                          transport):
+    # The cleans are seen by the check queries after a while: the ids are fetched once they are applied
+    engines = [MockEngine(["PC1", "PC2", "PC9"], clear_delay=0.1), MockEngine(["PC3"], clear_delay=0.1)]
+    engines[0].keywords["VIP"] = {"PC9": "Old"}
+    queries = {number: [] for number in range(len(engines))}
+    for number, engine in enumerate(engines):
+        def handle(query, response_format, engine=engine, handled=queries[number], handle=engine.handle):
+            handled.append(query)
+            return handle(query, response_format)
+        engine.handle = handle
+    mock = mock_nexthink(engines)
+    tags_file = tmp_path / "mixed.csv"
+    tags_file.write_text(HEADER + "device,PC1,VIP,Gold\ndevice,PC2,Team,Blue\ndevice,PC3,VIP,Silver\n"
+                                  "device,PC3,Team,Red\ndevice,PC4,Team,Red\n")
+    nxql = make_mock_nxql(logger, mock, transport)
+    nxql.snapshot_cache = SnapshotCache(logger)
+    metrics = RunMetrics("mixed.csv", "R")
+    args = make_args(mixed=True, parallel_partitions=2, query_file=query_file)
+    success, missed_object_ids, expanded_ids, journals = tagger.tag_mixed_file(
+        args, str(tags_file), nxql, mock.get_engine_addresses(), logger, "R", metrics=metrics)
+    for journal in journals:
+        journal.close()
+    nxql._websession.close()
+
+    assert success
+    assert missed_object_ids == ["PC4"]
+    assert engines[0].get_keywords("VIP") == {"PC1": "Gold"}
+    assert engines[0].get_keywords("Team") == {"PC2": "Blue"}
+    assert engines[1].get_keywords("VIP") == {"PC3": "Silver"}
+    assert engines[1].get_keywords("Team") == {"PC3": "Red"}
+    # One id scan per Engine for the two Categories
+    for handled in queries.values():
+        assert handled.count("(select (name)(from device))") == 1
+        assert sum(query.startswith("(update (set #") and query.endswith(" nil) (from device))")
+                   for query in handled) == 2
+    assert nxql.snapshot_cache.get_stats()["misses"] == 2
+    # One journal per partition, both Engines done
+    assert sorted(journal.path for journal in journals) == [str(tags_file) + ".0.journal", str(tags_file) + ".1.journal"]
+    urls = sorted(mock.engine_url_template.format(address) for address in mock.get_engine_addresses())
+    categories = []
+    for journal in journals:
+        with open(journal.path) as file:
+            records = [json.loads(line) for line in file]
+        categories.append(records[0]["category"])
+        assert sorted(record["engine"] for record in records if record["event"] == "done") == urls
+    assert categories == ["Team", "VIP"]
+    # The measures of the partitions are merged into the ones of the file
+    report = metrics.get_report()
+    for url, engine in report["engines"].items():
+        assert engine["phases"]["clear"]["count"] == 2
+        assert engine["phases"]["fetch"]["count"] == 1
+        assert engine["phases"]["clear_wait"]["wall_time"] >= 0.05
@@ -0,0 +1,56 @@
+import os
+import threading
+import time
+
+import pytest
+
+from classes.watcher import TagDirectoryWatcher
+
+
+@pytest.fixture(params=[True, False], ids=["inotify", "polling"])
+def watcher(request, tmp_path, logger, monkeypatch):
+    if not request.param:
+        monkeypatch.setattr(TagDirectoryWatcher, "_start_inotify", lambda self: False)
+    watcher = TagDirectoryWatcher(str(tmp_path), logger, poll_interval=0.05, settle_time=0.1)
+    yield watcher
+    watcher.close()
+
+
+def write_file(path, text, age=0):
+    path.write_text(text)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+
+
+def test_existing_files_are_returned_oldest_first(tmp_path, watcher):
+    write_file(tmp_path / "b.csv", "b", age=10)
+    write_file(tmp_path / "a.csv", "a", age=5)
+    write_file(tmp_path / "c.txt", "c", age=10)
+    watcher.start()
+    assert watcher.wait_for_files() == [str(tmp_path / "b.csv"), str(tmp_path / "a.csv")]
+
+
+def test_new_file_is_returned_once_settled(tmp_path, watcher):
+    watcher.start()
+    threading.Timer(0.1, write_file, (tmp_path / "new.csv", "new")).start()
+    start = time.monotonic()
+    assert watcher.wait_for_files() == [str(tmp_path / "new.csv")]
+    assert time.monotonic() - start >= 0.2
+
+
+def test_returned_file_is_not_returned_again(tmp_path, watcher):
+    write_file(tmp_path / "a.csv", "a", age=10)
+    watcher.start()
+    assert watcher.wait_for_files() == [str(tmp_path / "a.csv")]
+    # A scan sees it again, unchanged: only the new file is returned
+    watcher._scan()
+    write_file(tmp_path / "b.csv", "b", age=10)
+    watcher._scan()
+    assert watcher.wait_for_files() == [str(tmp_path / "b.csv")]
+
+
+def test_stop_ends_the_wait(watcher):
+    watcher.start()
+    threading.Timer(0.1, watcher.stop).start()
+    assert watcher.wait_for_files() == []
+    assert watcher.stopped
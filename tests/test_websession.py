@@ -0,0 +1,39 @@
+import threading
+import time
+
+from classes.websession import WebSession
+
+
+def test_service_time_excludes_the_budget_wait(http_server):
+    websession = WebSession("dXNlcjpwYXNz", pool_size=2, max_requests=1)
+    session = websession.get_session(http_server)
+    responses = []
+    websession.request_budget.acquire()
+    thread = threading.Thread(target=lambda: responses.append(session.get(http_server, params={"delay": 0})))
+    start = time.monotonic()
+    thread.start()
+    time.sleep(0.3)
+    websession.request_budget.release()
+    thread.join()
+    total = time.monotonic() - start
+    assert responses[0].status_code == 200
+    assert total >= 0.3
+    assert responses[0].service_time < 0.2
+    websession.close()
+
+
+def test_service_time_excludes_the_pool_wait(http_server):
+    websession = WebSession("dXNlcjpwYXNz", pool_size=1)
+    session = websession.get_session(http_server)
+    responses = []
+    threads = [threading.Thread(target=lambda: responses.append(session.get(http_server, params={"delay": 0.3})))
+               for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The second request waited 0.3s for the only pooled connection
+    assert all(response.service_time < 0.5 for response in responses)
+    stats = websession.get_pool_stats()
+    assert stats["requests"] == 2 and stats["handshakes"] == 1
+    websession.close()